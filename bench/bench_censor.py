@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Micro benchmark of the censor rules matching.
+
+Loads the badwords and badnames of a censor configuration file and measures how many chat lines per second are
+checked by the CensorMatcher compared with the previous loop running two regular expression searches per rule.
+An AssertionError is raised as soon as a line is matched to another rule than the loop reports.
+
+Usage: python bench/bench_censor.py [config file] [number of lines]
+"""
+
+import random
+import sys
+import time
+
+from b3.config import XmlConfigParser
+from b3.plugins.censor import CensorMatcher
+from b3.plugins.censor import CensorPlugin
+from benchutil import WORDS
+from benchutil import make_plugin
+
+
+def load_rules(path):
+    """
+    Load the badwords and badnames rules from the given configuration file.
+    """
+    plugin = make_plugin(CensorPlugin)
+    plugin.config = XmlConfigParser()
+    plugin.config.load(path)
+    plugin.onLoadConfig()
+    return plugin
+
+
+def loop_search(rules, text, cleaned):
+    """
+    The matching loop used before CensorMatcher.
+    """
+    for rule in rules:
+        if rule.regexp.search(text):
+            return rule, True
+        if rule.regexp.search(cleaned):
+            return rule, False
+    return None, False
+
+
+def make_lines(rules, count, dirty=0.02):
+    """
+    Generate chat lines: a small share of them contain the name of a rule.
+    """
+    rnd = random.Random(42)
+    lines = []
+    for i in xrange(count):
+        words = [rnd.choice(WORDS) for x in xrange(rnd.randint(2, 12))]
+        if rules and rnd.random() < dirty:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(rules).name)
+        lines.append(' '.join(words))
+    return lines
+
+
+def bench(plugin, rules, lines):
+    texts = [(' ' + x + ' ', ' ' + plugin.clean(x) + ' ') for x in lines]
+    matcher = CensorMatcher(rules)
+
+    start = time.time()
+    expected = [loop_search(rules, text, cleaned) for text, cleaned in texts]
+    loop_time = time.time() - start
+
+    start = time.time()
+    results = [matcher.search(text, cleaned) for text, cleaned in texts]
+    matcher_time = time.time() - start
+
+    if results != expected:
+        raise AssertionError('CensorMatcher and the rules loop disagree')
+
+    matched = len([x for x in results if x[0] is not None])
+    print '  %d rules (%d without literal), %d lines, %d matching' % (len(rules), len(matcher.always),
+                                                                      len(lines), matched)
+    print '  loop    : %10.0f lines/s' % (len(lines) / loop_time)
+    print '  matcher : %10.0f lines/s' % (len(lines) / matcher_time)
+
+
+def main(args):
+    path = args[0] if len(args) > 0 else '@b3/conf/plugin_censor.xml'
+    count = int(args[1]) if len(args) > 1 else 20000
+    if path.startswith('@b3'):
+        import b3
+        path = b3.getAbsolutePath(path)
+    plugin = load_rules(path)
+    print 'badwords'
+    bench(plugin, plugin._badWords, make_lines(plugin._badWords, count))
+    print 'badnames'
+    bench(plugin, plugin._badNames, make_lines(plugin._badNames, count))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
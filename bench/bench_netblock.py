@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Micro benchmark of the netblocker range lookup.
+
+Compares the way the netblocker plugin used to check a connecting client, converting every configured block string
+and scanning them all on every connect, with the single IPRanges set merged once when the configuration is loaded.
+Random /16 to /28 CIDR blocks are generated (about the size of a full country dump by default) and random addresses
+are checked against them. The previous loop is only timed on a sample of the lookups since it is linear in the number
+of blocks, and the run stops with an error if both disagree on a sampled address.
+
+Usage: python bench/bench_netblock.py [number of blocks] [number of lookups]
+"""
+
+import random
+import sys
+
+from b3.plugins.netblocker.netblock import netblock
+from benchutil import timed
+
+
+def make_blocks(rnd, count):
+    blocks = []
+    for i in xrange(count):
+        size = rnd.randint(16, 28)
+        ip = rnd.randint(0, netblock.B32M) & netblock.lenmask(size)
+        blocks.append(netblock.cidrtostr(ip, size))
+    return blocks
+
+
+def old_check(blocks, ipstr):
+    """
+    The lookup used before IPRanges.
+    """
+    ip = netblock.convert(ipstr)
+    for block in blocks:
+        b = netblock.convert(block)
+        if b[0] <= ip[0] <= b[1]:
+            return True
+    return False
+
+
+def build(blocks):
+    ranges = netblock.IPRanges()
+    ranges.addlist([netblock.convert(b) for b in blocks])
+    return ranges
+
+
+def bench(count, lookups):
+    rnd = random.Random(1)
+    blocks = make_blocks(rnd, count)
+    ips = [netblock.ipstr(rnd.randint(0, netblock.B32M)) for i in xrange(lookups)]
+    sample = ips[:max(1, min(len(ips), 2000000 // count))]
+
+    ranges, build_time = timed(build, blocks)
+    new, new_time = timed(lambda: [ip in ranges for ip in ips])
+    old, old_time = timed(lambda: [old_check(blocks, ip) for ip in sample])
+
+    for ip, expected, found in zip(sample, old, new):
+        if expected != bool(found):
+            raise AssertionError('IPRanges and the blocks loop disagree on %s' % ip)
+
+    print '  %d blocks merged into %d ranges in %.3fs' % (count, len(ranges._l), build_time)
+    print '  blocks loop : %10.1f us/lookup (%d lookups)' % (old_time * 1e6 / len(sample), len(sample))
+    print '  IPRanges    : %10.1f us/lookup (%d lookups, %d blocked)' % (new_time * 1e6 / len(ips), len(ips),
+                                                                         len([x for x in new if x]))
+
+
+def main(args):
+    count = int(args[0]) if len(args) > 0 else 100000
+    lookups = int(args[1]) if len(args) > 1 else 10000
+    bench(count, lookups)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Micro benchmark of the spam scoring.
+
+Replays a synthetic chat made of regular players and flooders through the SpamState based scoring and through the
+previous scoring storing its state in client vars, and reports how many messages per second each one handles and
+how many messages each one vetoes. Half of the flooders cycle through a few lines, which the previous scoring could
+not see as repeated since it only compared a message with the last one.
+
+Usage: python bench/bench_spamcontrol.py [number of messages] [number of players]
+"""
+
+import random
+import re
+import sys
+import time
+
+import b3.events
+from b3.plugins.spamcontrol import SpamcontrolPlugin
+from benchutil import Event
+from benchutil import chat_line
+from benchutil import make_clients
+from benchutil import make_plugin
+
+
+class _Clock(object):
+
+    now = 0.0
+
+
+class _Admin(object):
+
+    def warnClient(self, client, keyword):
+        pass
+
+
+def make_spamcontrol(clock):
+    plugin = make_plugin(SpamcontrolPlugin)
+    plugin._adminPlugin = _Admin()
+    plugin._states = {}
+    plugin.getTime = lambda: clock.now
+    return plugin
+
+
+def old_add_spam_points(plugin, client, points, text):
+    """
+    The scoring used before SpamState.
+    """
+    now = plugin.getTime()
+    if client.var(plugin, 'ignore_till', now).value > now:
+        raise b3.events.VetoEvent
+
+    last_message_time = client.var(plugin, 'last_message_time', now).value
+    gap = now - last_message_time
+
+    if gap < 2:
+        points += 1
+
+    spamins = client.var(plugin, 'spamins', 0).value + points
+    spamins -= int(gap / plugin._falloffRate)
+
+    if spamins < 1:
+        spamins = 0
+
+    client.setvar(plugin, 'spamins', spamins)
+    client.setvar(plugin, 'last_message_time', now)
+    client.setvar(plugin, 'last_message', text)
+
+    if spamins >= plugin._maxSpamins:
+        client.setvar(plugin, 'ignore_till', now + 2)
+        plugin._adminPlugin.warnClient(client, 'spam')
+        spamins = int(spamins / 1.5)
+        client.setvar(plugin, 'spamins', spamins)
+        raise b3.events.VetoEvent
+
+
+def old_on_chat(plugin, event):
+    if not event.client or event.client.maxLevel >= plugin._modLevel:
+        return
+
+    points = 0
+    client = event.client
+    text = event.data
+    last_message = client.var(plugin, 'last_message').value
+    color = re.match(r'\^[0-9]', event.data)
+    if color and text == last_message:
+        points += 5
+    elif text == last_message:
+        points += 3
+    elif color:
+        points += 2
+    elif text.startswith('QUICKMESSAGE_'):
+        points += 2
+    else:
+        points += 1
+
+    if text[:1] == '!':
+        points += 1
+
+    old_add_spam_points(plugin, client, points, text)
+
+
+def make_chat(count, players, flooders=0.2):
+    """
+    Generate (time, player index, text) messages: flooders talk every half second, other players every few seconds.
+    """
+    rnd = random.Random(42)
+    kinds = []
+    for i in xrange(players):
+        if rnd.random() < flooders:
+            kinds.append('repeat' if i % 2 else 'cycle')
+        else:
+            kinds.append('chat')
+    lines = [chat_line(rnd, 2, 8) for i in xrange(3)]
+    chat = []
+    sent = [0] * players
+    clocks = [rnd.uniform(0, 10) for x in xrange(players)]
+    while len(chat) < count:
+        player = min(xrange(players), key=clocks.__getitem__)
+        if kinds[player] == 'repeat':
+            text = lines[0]
+        elif kinds[player] == 'cycle':
+            text = lines[sent[player] % len(lines)]
+        else:
+            text = chat_line(rnd)
+        chat.append((clocks[player], player, text))
+        sent[player] += 1
+        clocks[player] += rnd.uniform(0.3, 0.7) if kinds[player] != 'chat' else rnd.uniform(3, 15)
+    return chat, kinds
+
+
+def replay(clock, handler, clients, chat, kinds):
+    vetoed = dict((kind, 0) for kind in kinds)
+    events = [(now, player, Event(clients[player], text)) for now, player, text in chat]
+    start = time.time()
+    for now, player, event in events:
+        clock.now = now
+        try:
+            handler(event)
+        except b3.events.VetoEvent:
+            vetoed[kinds[player]] += 1
+    return time.time() - start, vetoed
+
+
+def bench(count, players):
+    chat, kinds = make_chat(count, players)
+    clock = _Clock()
+
+    old = make_spamcontrol(clock)
+    old_time, old_vetoed = replay(clock, lambda event: old_on_chat(old, event), make_clients(players), chat, kinds)
+
+    new = make_spamcontrol(clock)
+    new_time, new_vetoed = replay(clock, new.onChat, make_clients(players), chat, kinds)
+
+    print '  %d messages, %d players (%d repeating, %d cycling lines)' % (count, players, kinds.count('repeat'),
+                                                                         kinds.count('cycle'))
+    print '  client vars : %10.0f messages/s, vetoed %r' % (count / old_time, old_vetoed)
+    print '  SpamState   : %10.0f messages/s, vetoed %r' % (count / new_time, new_vetoed)
+
+
+def main(args):
+    count = int(args[0]) if len(args) > 0 else 100000
+    players = int(args[1]) if len(args) > 1 else 32
+    bench(count, players)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
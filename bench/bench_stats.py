@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Micro benchmark of the stats event handlers.
+
+Replays a synthetic round of damage and kill events through the ClientStats based handlers and through the previous
+handlers storing every counter in client vars, and reports how many events per second each one handles. The replay
+stops with an AssertionError if a player ends up with other skill points, experience or damage in ClientStats than
+in the client vars. The !topstats lookup is then timed against the previous sort of all the clients.
+
+Usage: python bench/bench_stats.py [number of events] [number of players]
+"""
+
+import random
+import sys
+import time
+
+from b3.plugins.stats import StatsPlugin
+from b3.plugins.stats import StatsRanking
+from benchutil import Event
+from benchutil import make_clients
+from benchutil import make_plugin
+
+
+def make_stats(clients):
+    plugin = make_plugin(StatsPlugin, clients)
+    plugin.startPoints = 100
+    plugin._stats = {}
+    plugin._pointsRanking = StatsRanking()
+    plugin._xpRanking = StatsRanking()
+    return plugin
+
+
+class OldHandlers(object):
+    """
+    The event handlers used before ClientStats.
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def onDamage(self, event):
+        p = self.plugin
+        killer = event.client
+        victim = event.target
+        points = int(event.data[0])
+        if points > 100:
+            points = 100
+        killer.var(p, 'shotsHit', 0).value += 1
+        killer.var(p, 'damageHit', 0).value += points
+        victim.var(p, 'shotsGot', 0).value += 1
+        victim.var(p, 'damageGot', 0).value += points
+
+    def onDamageTeam(self, event):
+        p = self.plugin
+        killer = event.client
+        points = int(event.data[0])
+        if points > 100:
+            points = 100
+        killer.var(p, 'shotsTeamHit', 0).value += 1
+        killer.var(p, 'damageTeamHit', 0).value += points
+
+    def onKill(self, event):
+        p = self.plugin
+        killer = event.client
+        victim = event.target
+        points = int(event.data[0])
+        if points > 100:
+            points = 100
+        killer.var(p, 'shotsHit', 0).value += 1
+        killer.var(p, 'damageHit', 0).value += points
+        victim.var(p, 'shotsGot', 0).value += 1
+        victim.var(p, 'damageGot', 0).value += points
+        killer.var(p, 'kills', 0).value += 1
+        victim.var(p, 'deaths', 0).value += 1
+        val = self.score(killer, victim)
+        killer.var(p, 'points', p.startPoints).value += val
+        killer.var(p, 'pointsWon', 0).value += val
+        victim.var(p, 'points', p.startPoints).value -= val
+        victim.var(p, 'pointsLost', 0).value += val
+        self.updateXP(killer)
+        self.updateXP(victim)
+
+    def onTeamKill(self, event):
+        p = self.plugin
+        killer = event.client
+        victim = event.target
+        points = int(event.data[0])
+        if points > 100:
+            points = 100
+        killer.var(p, 'shotsTeamHit', 0).value += 1
+        killer.var(p, 'damageTeamHit', 0).value += points
+        killer.var(p, 'teamKills', 0).value += 1
+        val = self.score(killer, victim)
+        killer.var(p, 'points', p.startPoints).value -= val
+        killer.var(p, 'pointsLost', 0).value += val
+        self.updateXP(killer)
+        self.updateXP(victim)
+
+    def updateXP(self, sclient):
+        p = self.plugin
+        realpoints = sclient.var(p, 'pointsWon', 0).value - sclient.var(p, 'pointsLost', 0).value
+        if sclient.var(p, 'deaths', 0).value != 0:
+            experience = (sclient.var(p, 'kills', 0).value * realpoints) / sclient.var(p, 'deaths', 0).value
+        else:
+            experience = sclient.var(p, 'kills', 0).value * realpoints
+        sclient.var(p, 'experience', 0).value = experience
+
+    def score(self, killer, victim):
+        p = self.plugin
+        return StatsPlugin.scorePoints(killer.var(p, 'points', p.startPoints).value,
+                                       victim.var(p, 'points', p.startPoints).value)
+
+    def topstats(self, clients):
+        p = self.plugin
+        scores = []
+        for c in clients.getList():
+            if c.isvar(p, 'points'):
+                scores.append((c.exactName, round(c.var(p, 'points', p.startPoints).value, 2)))
+        tmplist = [(x[1], x) for x in scores]
+        tmplist.sort()
+        scores = [x for (key, x) in tmplist]
+        scores.reverse()
+        return scores[:5]
+
+
+def make_events(count, players, kills=0.15, team=0.05):
+    """
+    Generate (kind, attacker index, victim index, damage) events: mostly damage, some kills and a few team hits.
+    """
+    rnd = random.Random(42)
+    events = []
+    for i in xrange(count):
+        attacker, victim = rnd.sample(xrange(players), 2)
+        roll = rnd.random()
+        if roll < team / 4:
+            kind = 'teamkill'
+        elif roll < team:
+            kind = 'damageteam'
+        elif roll < team + kills:
+            kind = 'kill'
+        else:
+            kind = 'damage'
+        events.append((kind, attacker, victim, str(rnd.randint(5, 120))))
+    return events
+
+
+def replay(handlers, clients, events):
+    dispatch = {'damage': handlers.onDamage, 'damageteam': handlers.onDamageTeam,
+                'kill': handlers.onKill, 'teamkill': handlers.onTeamKill}
+    events = [(dispatch[kind], Event(clients[a], (damage,), clients[v])) for kind, a, v, damage in events]
+    start = time.time()
+    for handler, event in events:
+        handler(event)
+    return time.time() - start
+
+
+def bench(count, players):
+    events = make_events(count, players)
+
+    old_clients = make_clients(players)
+    old = OldHandlers(make_stats(old_clients))
+    old_time = replay(old, old_clients, events)
+
+    new_clients = make_clients(players)
+    new = make_stats(new_clients)
+    new_time = replay(new, new_clients, events)
+
+    for o, n in zip(old_clients, new_clients):
+        stats = new.getClientStats(n)
+        expected = (o.var(old.plugin, 'points', 100).value, o.var(old.plugin, 'experience', 0).value,
+                    o.var(old.plugin, 'damageHit', 0).value)
+        if expected != (stats.points, stats.experience, stats.damageHit):
+            raise AssertionError('client vars and ClientStats disagree for %s' % n.name)
+
+    repeat = 1000
+    start = time.time()
+    for i in xrange(repeat):
+        old.topstats(old.plugin.console.clients)
+    old_top = time.time() - start
+    start = time.time()
+    for i in xrange(repeat):
+        new.getTopList(new._pointsRanking)
+    new_top = time.time() - start
+
+    print '  %d events, %d players' % (count, players)
+    print '  client vars : %10.0f events/s, %8.0f !topstats/s' % (count / old_time, repeat / old_top)
+    print '  ClientStats : %10.0f events/s, %8.0f !topstats/s' % (count / new_time, repeat / new_top)
+
+
+def main(args):
+    count = int(args[0]) if len(args) > 0 else 100000
+    players = int(args[1]) if len(args) > 1 else 32
+    bench(count, players)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
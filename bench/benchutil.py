@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Synthetic chat, clients and console stand-ins shared by the plugin micro benchmarks.
+"""
+
+import re
+import time
+
+from b3.clients import Client
+
+WORDS = ('hello', 'gg', 'nice', 'shot', 'lol', 'where', 'are', 'you', 'camping', 'again', 'map', 'next', 'please',
+         'team', 'balance', 'noob', 'ffs', 'thanks', 'admin', 'rush', 'b', 'flag', 'sniper', 'behind', 'us')
+
+
+class Clients(object):
+
+    def __init__(self, clients):
+        self._clients = dict((c.cid, c) for c in clients)
+
+    def getByCID(self, cid):
+        return self._clients.get(cid)
+
+    def getList(self):
+        return self._clients.values()
+
+
+class Console(object):
+
+    def __init__(self, clients=()):
+        self.clients = Clients(clients)
+
+    def stripColors(self, text):
+        return re.sub(r'\^[0-9a-z]', '', text)
+
+
+class Event(object):
+
+    def __init__(self, client, data, target=None):
+        self.client = client
+        self.data = data
+        self.target = target
+
+
+def make_plugin(cls, clients=()):
+    """
+    Create a plugin without going through its constructor, with a console stand-in and the logging disabled.
+    """
+    plugin = cls.__new__(cls)
+    for name in ('verbose', 'debug', 'info', 'warning', 'error'):
+        setattr(plugin, name, lambda *args, **kwargs: None)
+    plugin.console = Console(clients)
+    return plugin
+
+
+def make_clients(players):
+    clients = [Client(cid=str(i), name='player%s' % i) for i in xrange(players)]
+    for client in clients:
+        # guests: no need for the storage to compute their level
+        client._maxLevel = 0
+    return clients
+
+
+def chat_line(rnd, low=2, high=12):
+    """
+    Return a line of low to high random words.
+    """
+    return ' '.join(rnd.choice(WORDS) for x in xrange(rnd.randint(low, high)))
+
+
+def timed(func, *args):
+    """
+    Call func with the given arguments.
+    :return: tuple (result, elapsed seconds)
+    """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
@@ -22,7 +22,7 @@
 #                                                                     #
 # ################################################################### #
 
-__version__ = '1.35'
+__version__ = '1.36'
 __author__ = 'ThorN, xlr8or, Courgette, Ozon, Fenix'
 
 import re
@@ -47,6 +47,8 @@ from ConfigParser import NoOptionError
 class AdminPlugin(b3.plugin.Plugin):
 
     _commands = {}
+    _prefixModes = {}                   # dict<command prefix, name of the Command method executing the command>
+    _spellIndex = None
 
     _tkPlugin = None
     _parseUserCmdRE = re.compile(r"^(?P<cid>'[^']{2,}'|[0-9]+|[^\s]{2,}|@[0-9]+)(\s+(?P<parms>.*))?$")
@@ -425,6 +427,8 @@ class AdminPlugin(b3.plugin.Plugin):
             self.warning('could not find settings/command_prefix_private in config file, '
                          'using default: %s' % self.cmdPrefixPrivate)
 
+        self.buildPrefixModes()
+
         # register commands
         if 'commands' in self.config.sections():
             for cmd in self.config.options('commands'):
@@ -520,6 +524,7 @@ class AdminPlugin(b3.plugin.Plugin):
             self._commands[command].prefixLoud = self.cmdPrefixLoud
             self._commands[command].prefixPrivate = self.cmdPrefixPrivate
 
+            self._spellIndex = None
             self.debug('command "%s (%s)" registered with %s for level %s' % (command, alias,
                                                                               self._commands[command].func.__name__,
                                                                               self._commands[command].level))
@@ -542,6 +547,7 @@ class AdminPlugin(b3.plugin.Plugin):
             del self._commands[command.command]
             if alias and alias in self._commands:
                 del self._commands[alias]
+            self._spellIndex = None
             return True
         except KeyError:
             self.debug('command not found: %s' % name)
@@ -639,8 +645,7 @@ class AdminPlugin(b3.plugin.Plugin):
 
                     self.debug('end of teamkill info')
 
-        elif len(event.data) >= 2 and event.data[:1] in (self.cmdPrefix, self.cmdPrefixLoud,
-                                                         self.cmdPrefixBig, self.cmdPrefixPrivate):
+        elif len(event.data) >= 2 and event.data[:1] in self._prefixModes:
 
             # catch the confirm command for identification of the B3 devs
             if event.data[1:] == 'confirm':
@@ -650,7 +655,7 @@ class AdminPlugin(b3.plugin.Plugin):
             else:
                 self.debug('handle command %s' % event.data)
 
-            if event.data[1:2] in (self.cmdPrefix, self.cmdPrefixLoud, self.cmdPrefixBig, self.cmdPrefixPrivate):
+            if event.data[1:2] in self._prefixModes:
                 # self.is the alias for say
                 cmd = 'say'
                 data = event.data[2:]
@@ -699,15 +704,13 @@ class AdminPlugin(b3.plugin.Plugin):
 
             if command.canUse(event.client):
 
+                # loud, big and private commands are reserved to level 9 and above
+                mode = self._prefixModes[event.data[:1]]
+                if event.client.maxLevel < 9:
+                    mode = 'execute'
+
                 try:
-                    if event.data[:1] == self.cmdPrefixLoud and event.client.maxLevel >= 9:
-                        results = command.executeLoud(data, event.client)
-                    elif event.data[:1] == self.cmdPrefixBig and event.client.maxLevel >= 9:
-                        results = command.executeBig(data, event.client)
-                    elif event.data[:1] == self.cmdPrefixPrivate and event.client.maxLevel >= 9:
-                        results = command.executePrivate(data, event.client)
-                    else:
-                        results = command.execute(data, event.client)
+                    results = getattr(command, mode)(data, event.client)
                 except (KeyboardInterrupt, SystemExit):
                     pass
                 except:
@@ -763,18 +766,36 @@ class AdminPlugin(b3.plugin.Plugin):
         else:
             return False
 
+    def buildPrefixModes(self):
+        """
+        Build the table mapping every command prefix to the Command method executing the command.
+        """
+        modes = {}
+        # lowest precedence first so that a prefix configured twice keeps the mode it was always executed with
+        for prefix, mode in ((self.cmdPrefix, 'execute'), (self.cmdPrefixPrivate, 'executePrivate'),
+                             (self.cmdPrefixBig, 'executeBig'), (self.cmdPrefixLoud, 'executeLoud')):
+            if prefix:
+                modes[prefix] = mode
+        self._prefixModes = modes
+
     def get_cmdSoundingLike(self, c_word, client):
         """
-        Return a list of commands sounding like the spelled one.
+        Return the command sounding like the spelled one.
         :param c_word: The spelled command
         :param client: The client who executed the command
+        :return: The name of the closest command the client can use or False if none is close enough
         """
-        c_list = []
-        for c, cmd in self._commands.iteritems():
-            if cmd.canUse(client):
-                if cmd.command not in c_list:
-                    c_list.append(cmd.command)
-        result = functions.corrent_spell(c_word, ' '.join(c_list))
+        # other plugins may add or remove commands without going through registerCommand
+        if self._spellIndex is None or self._spellIndex.size != len(self._commands):
+            self._spellIndex = CommandSpellIndex(self._commands)
+
+        def usable(name):
+            command = self._commands.get(name)
+            return command is not None and command.command == name and command.canUse(client)
+
+        result = self._spellIndex.lookup(c_word.lower(), usable)
+        if result is None or result == c_word.lower():
+            return False
         return result
 
     def getAdmins(self):
@@ -2593,4 +2614,89 @@ class Command(object):
         return params
 
     def __repr__(self):
-        return "Command<" + self.command + ">"
\ No newline at end of file
+        return "Command<" + self.command + ">"
+
+class CommandSpellIndex(object):
+    """
+    Symmetric delete index of the command names.
+
+    Every name is indexed under all the strings obtained by deleting up to maxDistance characters from it: the names
+    within maxDistance edits of a misspelled word share at least one of those strings with it, so a lookup only
+    computes the edit distance of a handful of candidates instead of scanning all the commands.
+    """
+
+    maxDistance = 2
+
+    def __init__(self, commands):
+        """
+        Build the index of the given commands.
+        :param commands: The dict of registered commands (command and alias names as keys)
+        """
+        self.size = len(commands)
+        self._deletes = {}
+        for command in set(commands.itervalues()):
+            name = command.command.lower()
+            for variant in self._variants(name):
+                self._deletes.setdefault(variant, set()).add(name)
+
+    def _variants(self, word):
+        """
+        Return the given word and the strings obtained by deleting up to maxDistance characters from it.
+        """
+        variants = set([word])
+        edge = [word]
+        for i in xrange(self.maxDistance):
+            deletes = []
+            for w in edge:
+                for j in xrange(len(w)):
+                    d = w[:j] + w[j + 1:]
+                    if d not in variants:
+                        variants.add(d)
+                        deletes.append(d)
+            edge = deletes
+        return variants
+
+    def lookup(self, word, accept=None):
+        """
+        Return the closest indexed name: the lowest edit distance wins, then the alphabetical order.
+        :param word: The misspelled word
+        :param accept: Optional function filtering the candidate names
+        :return: The closest name or None if no name is within maxDistance edits
+        """
+        candidates = set()
+        for variant in self._variants(word):
+            candidates.update(self._deletes.get(variant, ()))
+
+        best = None
+        for name in candidates:
+            distance = editDistance(word, name)
+            if distance <= self.maxDistance and (best is None or (distance, name) < best):
+                if accept is None or accept(name):
+                    best = (distance, name)
+        return best[1] if best else None
+
+
+def editDistance(a, b):
+    """
+    Return the minimum number of insertions, deletions, substitutions and adjacent transpositions turning a into b.
+    """
+    # Lowrance-Wagner algorithm: unlike the optimal string alignment distance it allows editing a substring which
+    # has already been transposed ('kki' -> 'kik' -> 'kick')
+    inf = len(a) + len(b)
+    last = {}
+    d = [[inf] * (len(b) + 2)]
+    d += [[inf] + range(len(b) + 1)]
+    d += [[inf, i] + [0] * len(b) for i in xrange(1, len(a) + 1)]
+    for i in xrange(1, len(a) + 1):
+        match = 0
+        for j in xrange(1, len(b) + 1):
+            k = last.get(b[j - 1], 0)
+            l = match
+            cost = 1
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                match = j
+            d[i + 1][j + 1] = min(d[i][j] + cost, d[i + 1][j] + 1, d[i][j + 1] + 1,
+                                  d[k][l] + (i - k - 1) + 1 + (j - l - 1))
+        last[a[i - 1]] = i
+    return d[len(a) + 1][len(b) + 1]
@@ -23,17 +23,127 @@
 # ################################################################### #
 
 __author__ = "Thomas LEVEIL"
-__version__ = "1.10"
+__version__ = "1.12"
 
 
-from threading import Timer
+from collections import OrderedDict
 from time import time
 from b3 import TEAM_SPEC
 from b3.config import NoOptionError
 from b3.plugin import Plugin
+from b3.plugins.timerwheel import schedule
 from weakref import WeakKeyDictionary
 
 
+class ActivityRecord(object):
+    """
+    Activity of a client.
+    """
+    __slots__ = ('client', 'time', 'deaths')
+
+    def __init__(self, client, time):
+        self.client = client
+        self.time = time
+        self.deaths = 0
+
+
+class ActivityTracker(object):
+    """
+    Keep track of the clients last activity and of the humans playing.
+
+    Clients are indexed from the least recently active one: those inactive for too long are found at the beginning of
+    the index without looking at the active ones. The in-game humans are maintained from the client events, so that
+    counting them does not need to go through all the clients.
+    """
+
+    def __init__(self):
+        self._records = OrderedDict()   # cid -> ActivityRecord, least recently active first
+        self._latest = None
+        self._ingame_humans = set()     # cid of the humans who are not spectator
+
+    def touch(self, client, now):
+        """
+        Record a client activity.
+        :param client: b3.clients.Client
+        :param now: the time the activity happened
+        """
+        record = self._records.pop(client.cid, None)
+        if record is None or record.client is not client:
+            record = ActivityRecord(client, now)
+        record.time = now
+        record.deaths = 0
+        self._records[client.cid] = record
+        if self._latest is not None and now < self._latest:
+            # activity reported out of order: sort the index again
+            self._records = OrderedDict(sorted(self._records.iteritems(), key=lambda x: x[1].time))
+        else:
+            self._latest = now
+
+    def add_death(self, client):
+        """
+        Count a death of a client since its last activity.
+        :return: int the number of consecutive deaths, 0 if the client activity is unknown
+        """
+        record = self._records.get(client.cid)
+        if record is None or record.client is not client:
+            return 0
+        record.deaths += 1
+        return record.deaths
+
+    def last_activity(self, client):
+        """
+        :return: the time of the client last activity or None if unknown
+        """
+        record = self._records.get(client.cid)
+        if record is None or record.client is not client:
+            return None
+        return record.time
+
+    def inactive_clients(self, before):
+        """
+        :param before: the time of the last activity for a client to be considered inactive
+        :return: list of the clients with no activity since the given time, least recently active first
+        """
+        clients = []
+        for record in self._records.itervalues():
+            if record.time >= before:
+                break
+            clients.append(record.client)
+        return clients
+
+    def update_client(self, client):
+        """
+        Update the in-game status of a client after a connection or a team change.
+        """
+        if client.bot or client.team == TEAM_SPEC:
+            self._ingame_humans.discard(client.cid)
+        else:
+            self._ingame_humans.add(client.cid)
+
+    def update_clients(self, clients):
+        """
+        Compute the in-game status of all the clients again.
+        """
+        self._ingame_humans = set(x.cid for x in clients if not x.bot and x.team != TEAM_SPEC)
+
+    def count_ingame_humans(self):
+        return len(self._ingame_humans)
+
+    def forget(self, cid):
+        """
+        Remove a disconnected client.
+        """
+        self._records.pop(cid, None)
+        self._ingame_humans.discard(cid)
+
+    def clear(self):
+        """
+        Forget the activity of all the clients.
+        """
+        self._records.clear()
+        self._latest = None
+
+
 class AfkPlugin(Plugin):
 
     loadAfterPlugins = ['urtposition']
@@ -72,11 +182,14 @@ class AfkPlugin(Plugin):
         """:type : int"""
 
         self.kick_timers = WeakKeyDictionary()
-        """:type : dict[Client, threading.Timer]"""
+        """:type : dict[Client, b3.plugins.timerwheel.WheelTimer]"""
 
         self.last_global_check_time = time()
         """:type : int"""
 
+        self.activity_tracker = ActivityTracker()
+        """:type : ActivityTracker"""
+
     def onStartup(self):
         """
         Initialize plugin.
@@ -142,6 +255,8 @@ class AfkPlugin(Plugin):
             if event_id is not None:
                 self.registerEvent(event_id, self.on_client_activity)
 
+        self.activity_tracker.update_clients(self.console.clients.getList())
+
     def onDisable(self):
         """
         Executed when the plugin is disabled.
@@ -277,14 +392,13 @@ class AfkPlugin(Plugin):
         :param event: b3.events.Event
         """
         self.clear_kick_timer_for_client(event.client)
-        if hasattr(event.client, 'last_activity_time'):
-            del event.client.last_activity_time
+        self.activity_tracker.forget(event.data)
 
     def count_ingame_humans(self):
         """
         :return: int the number of humans who are not spectator
         """
-        return len([x for x in self.console.clients.getList() if not x.bot and x.team != TEAM_SPEC])
+        return self.activity_tracker.count_ingame_humans()
 
     def on_kill(self, event):
         """
@@ -294,17 +408,17 @@ class AfkPlugin(Plugin):
         if event.target and event.target == event.client:
             self.verbose2("suicide: not considered as a death as player is active")
             return
-        if not hasattr(event.target, "afk_death_count"):
-            event.target.afk_death_count = 0
-        event.target.afk_death_count += 1
+        self.activity_tracker.update_client(event.target)
+        death_count = self.activity_tracker.add_death(event.target)
+        last_activity_time = self.activity_tracker.last_activity(event.target)
         ingame_humans = self.count_ingame_humans()
-        self.verbose2("%r.afk_death_count: %s, last activity: %.1fs ago, in-game humans: %s" % (
+        self.verbose2("%r death count: %s, last activity: %.1fs ago, in-game humans: %s" % (
             event.target,
-            event.target.afk_death_count,
-            (time() - getattr(event.target, 'last_activity_time', time())),
+            death_count,
+            (time() - last_activity_time) if last_activity_time is not None else 0,
             ingame_humans
         ))
-        if event.target.afk_death_count >= self.consecutive_deaths_threshold and \
+        if death_count >= self.consecutive_deaths_threshold and \
            ingame_humans > self.min_ingame_humans:
             self.check_client(event.target)
 
@@ -320,8 +434,8 @@ class AfkPlugin(Plugin):
             now = time()
         if event.client in self.kick_timers:
             event.client.message("OK, you are not AFK")
-        event.client.last_activity_time = now
-        event.client.afk_death_count = 0
+        self.activity_tracker.touch(event.client, now)
+        self.activity_tracker.update_client(event.client)
         self.clear_kick_timer_for_client(event.client)
 
     def on_client_standing(self, event):
@@ -341,9 +455,8 @@ class AfkPlugin(Plugin):
         """
         self.info("game break, clearing afk timers")
         self.stop_kick_timers()
-        for client in [x for x in self.console.clients.getList() if hasattr(x, 'last_activity_time')]:
-            del client.last_activity_time
-            del client.afk_death_count
+        self.activity_tracker.clear()
+        self.activity_tracker.update_clients(self.console.clients.getList())
 
     def on_say(self, event):
         if "afk" in event.data.lower():
@@ -357,7 +470,7 @@ class AfkPlugin(Plugin):
 
     def check_all_clients(self, now=None):
         """
-        If last check was older than 15s ago, check all clients for inactivity
+        If last check was older than 15s ago, check the clients inactive for too long
         :param now: int (optional) the time the activity happened. If None, current time is used.
         """
         if now is None:
@@ -365,11 +478,9 @@ class AfkPlugin(Plugin):
         last_check_ago = now - self.last_global_check_time
 
         if last_check_ago > 15:
-            list_of_players = [x for x in self.console.clients.getList()
-                               if x.team != TEAM_SPEC and not getattr(x, 'bot', False)]
             self.info("looking for afk players...")
             self.last_global_check_time = now
-            for client in list_of_players:
+            for client in self.activity_tracker.inactive_clients(now - self.inactivity_threshold_second):
                 self.check_client(client)
 
     def check_client(self, client):
@@ -394,10 +505,11 @@ class AfkPlugin(Plugin):
         if client.team in (TEAM_SPEC,):
             self.verbose2("%s is in %s team" % (client.name, client.team))
             return False
-        if not hasattr(client, 'last_activity_time'):
+        last_activity_time = self.activity_tracker.last_activity(client)
+        if last_activity_time is None:
             self.verbose2("%s has no last activity time recorded, cannot check" % client.name)
             return False
-        inactivity_duration = time() - client.last_activity_time
+        inactivity_duration = time() - last_activity_time
         if inactivity_duration > self.inactivity_threshold_second:
             self.verbose2("last activity {:5.1f} ago for {!r}".format(inactivity_duration, client))
             return True
@@ -414,9 +526,7 @@ class AfkPlugin(Plugin):
         self.info("%r suspected of being AFK" % client)
         client.message(self.are_you_afk)
         self.console.say(self.suspicion_announcement.format(name=client.name, last_chance_delay=self.last_chance_delay))
-        t = Timer(self.last_chance_delay, self.kick_client, (client, ))
-        t.start()
-        self.kick_timers[client] = t
+        self.kick_timers[client] = schedule(self, self.last_chance_delay, self.kick_client, (client, ))
 
     def kick_client(self, client):
         """
@@ -22,7 +22,7 @@
 #                                                                     #
 # ################################################################### #
 
-__version__ = '2.8'
+__version__ = '2.9'
 __author__  = 'Courgette'
 
 import b3
@@ -343,7 +343,6 @@ class Banlist(object):
         :param config: the banlist plugin configuration file instance
         """
         self.plugin = plugin
-        self.file_content = ""  # the banlist file content
         self.cache = {}  # used to cache isBanned results. Must be cleared after banlist file change/update
         self.cache_time = 0  # holds the modifed time of the banlist file used to fill that cache
 
@@ -504,14 +503,23 @@ class Banlist(object):
 
         if self.cache_time != self.getModifiedTime():
             with open(self.file) as f:
-                self.plugin.verbose("updating %s content cache from %s" % (self, self.file))
-                self.file_content = f.read()
+                self.plugin.verbose("updating %s index from %s" % (self, self.file))
+                self.buildIndex(f)
             self.clear_cache()
 
+    def buildIndex(self, lines):
+        """
+        Parse the banlist file once into the structures used to lookup clients.
+        Called only when the banlist file modified time changes.
+        :param lines: iterable over the banlist file lines
+        """
+        pass
+
 
 class IpBanlist(Banlist):
 
     _forceRange = None
+    _re_ip = re.compile(r'^(\d+)\.(\d+)\.(\d+)\.(\d+)')
 
     def __init__(self, plugin, config):
         """
@@ -519,6 +527,8 @@ class IpBanlist(Banlist):
         :param plugin: the banlist plugin instance
         :param config: the banlist plugin configuration file instance
         """
+        # banlist entries indexed by ip, by /24, /16 and /8 range and by /24 range for forced range lookups
+        self._index = ({}, {}, {}, {}, {})
         Banlist.__init__(self, plugin, config)
         # set specific settings
         node = config.find('force_ip_range')
@@ -547,42 +557,97 @@ class IpBanlist(Banlist):
             self.plugin.verbose(msg)
         return rv
 
+    def buildIndex(self, lines):
+        """
+        Index the banlist entries (lines starting with an IP address) by ip and by range.
+        An entry ending with '.0' bans a /24 range, with '.0.0' a /16 range and with '.0.0.0' a /8 range.
+        """
+        exact, range24, range16, range8, forced = {}, {}, {}, {}, {}
+        for line in lines:
+            m = self._re_ip.match(line)
+            if not m:
+                continue
+            # keep the first entry found in the file, as a search would
+            entry = line.strip()
+            a, b, c, d = m.groups()
+            exact.setdefault(m.group(0), entry)
+            if d == '0':
+                range24.setdefault('%s.%s.%s' % (a, b, c), entry)
+                if c == '0':
+                    range16.setdefault('%s.%s' % (a, b), entry)
+                    if b == '0':
+                        range8.setdefault(a, entry)
+            if len(d) <= 3:
+                forced.setdefault('%s.%s.%s' % (a, b, c), entry)
+        self._index = (exact, range24, range16, range8, forced)
+
     def isIpInBanlist(self, ip):
+        exact, range24, range16, range8, forced = self._index
+        parts = ip.split('.')
+
         # search the exact ip
-        rStrict = re.compile(r'''^(?P<entry>%s(?:[^\d\n\r].*)?)$''' % re.escape(ip), re.MULTILINE)
-        m = rStrict.search(self.file_content)
-        if m:
-            return ip, "ip '%s' matches banlist entry %r (%s %s)" % (ip, m.group('entry').strip(), self.name, self.getHumanModifiedTime())
-
-        # search the ip with .0 at the end
-        rRange = re.compile(r'''^(?P<entry>%s\.0(?:[^\d\n\r].*)?)$''' % re.escape('.'.join(ip.split('.')[0:3])), re.MULTILINE)
-        m = rRange.search(self.file_content)
-        if m:
-            return ip, "ip '%s' matches (by range) banlist entry %r (%s %s)" % (ip, m.group('entry').strip(), self.name, self.getHumanModifiedTime())
-
-        # search the ip with .0.0 at the end
-        rRange = re.compile(r'''^(?P<entry>%s\.0\.0(?:[^\d\n\r].*)?)$''' % re.escape('.'.join(ip.split('.')[0:2])), re.MULTILINE)
-        m = rRange.search(self.file_content)
-        if m:
-            return ip, "ip '%s' matches (by range) banlist entry %r (%s %s)" % (ip, m.group('entry').strip(), self.name, self.getHumanModifiedTime())
-
-        # search the ip with .0.0.0 at the end
-        rRange = re.compile(r'''^(?P<entry>%s\.0\.0\.0(?:[^\d\n\r].*)?)$''' % re.escape('.'.join(ip.split('.')[0:1])), re.MULTILINE)
-        m = rRange.search(self.file_content)
-        if m:
-            return ip, "ip '%s' matches (by range) banlist entry %r (%s %s)" % (ip, m.group('entry').strip(), self.name, self.getHumanModifiedTime())
+        entry = exact.get(ip)
+        if entry is not None:
+            return ip, "ip '%s' matches banlist entry %r (%s %s)" % (ip, entry, self.name, self.getHumanModifiedTime())
+
+        # search the ip with .0, .0.0 and .0.0.0 at the end
+        for index, length in ((range24, 3), (range16, 2), (range8, 1)):
+            entry = index.get('.'.join(parts[0:length]))
+            if entry is not None:
+                return ip, "ip '%s' matches (by range) banlist entry %r (%s %s)" % (ip, entry, self.name, self.getHumanModifiedTime())
 
         # if force range is set, enforce search by range even if banlist ip are not ending with ".0"
         if self._forceRange:
-            rForceRange = re.compile(r'''^(?P<entry>%s\.\d{1,3}(?:[^\d\n\r].*)?)$''' % re.escape('.'.join(ip.split('.')[0:3])), re.MULTILINE)
-            m = rForceRange.search(self.file_content)
-            if m:
-                return ip, "ip '%s' matches (by forced range) banlist entry %r (%s %s)" % (ip, m.group('entry').strip(), self.name, self.getHumanModifiedTime())
+            entry = forced.get('.'.join(parts[0:3]))
+            if entry is not None:
+                return ip, "ip '%s' matches (by forced range) banlist entry %r (%s %s)" % (ip, entry, self.name, self.getHumanModifiedTime())
 
         return False, "ip '%s' not found in banlist (%s %s)" % (ip, self.name, self.getHumanModifiedTime())
 
 
-class GuidBanlist(Banlist):
+class IdBanlist(Banlist):
+    """
+    Base class for the banlists made of one id (guid, PBid) per line.
+    """
+
+    _re_entry = re.compile(r'^\s*(\S+)')
+    _re_word = re.compile(r'^\w+')
+
+    def __init__(self, plugin, config):
+        """
+        Create a new IdBanlist
+        :param plugin: the banlist plugin instance
+        :param config: the banlist plugin configuration file instance
+        """
+        self._index = {}  # banlist entries indexed by lowercase id
+        Banlist.__init__(self, plugin, config)
+
+    def buildIndex(self, lines):
+        """
+        Index the banlist entries by the (case insensitive) id they start with.
+        An id followed by punctuation (ie: 'abc123,comment') is indexed both with and without it.
+        """
+        index = {}
+        for line in lines:
+            m = self._re_entry.match(line)
+            if not m:
+                continue
+            entry = line.rstrip('\r\n')
+            token = m.group(1).lower()
+            index.setdefault(token, entry)
+            m = self._re_word.match(token)
+            if m and m.group(0) != token:
+                index.setdefault(m.group(0), entry)
+        self._index = index
+
+    def findEntry(self, value):
+        """
+        Return the banlist entry matching the given id or None.
+        """
+        return self._index.get(value.lower())
+
+
+class GuidBanlist(IdBanlist):
 
     def isBanned(self, client):
         """
@@ -604,14 +669,13 @@ class GuidBanlist(Banlist):
         return rv
 
     def isGuidInBanlist(self, guid):
-        re_guid = re.compile(r'''^(?P<entry>\s*%s\b.*)$''' % re.escape(guid), re.IGNORECASE | re.MULTILINE)
-        m = re_guid.search(self.file_content)
-        if m:
-            return guid, "guid '%s' matches banlist entry %r (%s %s)" % (guid, m.group('entry'), self.name, self.getHumanModifiedTime())
+        entry = self.findEntry(guid)
+        if entry is not None:
+            return guid, "guid '%s' matches banlist entry %r (%s %s)" % (guid, entry, self.name, self.getHumanModifiedTime())
         return False, "guid '%s' not found in banlist (%s %s)" % (guid, self.name, self.getHumanModifiedTime())
 
 
-class PbidBanlist(Banlist):
+class PbidBanlist(IdBanlist):
 
     def isBanned(self, client):
         """
@@ -633,10 +697,9 @@ class PbidBanlist(Banlist):
         return rv
 
     def isPbidInBanlist(self, pbid):
-        re_guid = re.compile(r'''^(?P<entry>\s*%s\b.*)$''' % re.escape(pbid), re.IGNORECASE | re.MULTILINE)
-        m = re_guid.search(self.file_content)
-        if m:
-            return pbid, "PBid '%s' matches banlist entry %r (%s %s)" % (pbid, m.group('entry'), self.name, self.getHumanModifiedTime())
+        entry = self.findEntry(pbid)
+        if entry is not None:
+            return pbid, "PBid '%s' matches banlist entry %r (%s %s)" % (pbid, entry, self.name, self.getHumanModifiedTime())
         return False, "PBid '%s' not found in banlist (%s %s)" % (pbid, self.name, self.getHumanModifiedTime())
 
 
@@ -22,7 +22,11 @@
 
 import b3
 import os
+import json
 import logging
+import Queue
+import threading
+import time
 
 from b3.cron import PluginCronTab
 from b3.plugin import Plugin
@@ -30,7 +34,7 @@ from b3.config import ConfigParser
 from b3.timezones import timezones
 from logging.handlers import TimedRotatingFileHandler
 
-__version__ = '1.5'
+__version__ = '1.6'
 __author__ = 'Courgette, xlr8or, BlackMamba, OliverWieland'
 
 
@@ -48,6 +52,26 @@ class ChatloggerPlugin(Plugin):
     _save2db = None
     _save2file = None
     _file_rotation_rate = None
+    _writer = None
+    _batch_size = 50
+    _flush_interval = 2.0
+    _queue_size = 5000
+    _overflow = 'drop'
+    _spill_file = '@conf/chatlog_spill.log'
+    _spill_max_size = 10
+    _chunk_size = 10000
+    _chunk_pause = 0.5
+    _purge_duration = 60
+    _partitions = False
+    _partitions_ahead = 7
+    _purge_thread = None
+
+    def __init__(self, console, config=None):
+        """
+        Build the plugin object.
+        """
+        Plugin.__init__(self, console, config)
+        self._purge_abort = threading.Event()
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -187,6 +211,14 @@ class ChatloggerPlugin(Plugin):
             self._minutes = 0
             self.debug('using default value (%s) for minutes', self._minutes)
 
+        self._chunk_size = self.getSetting('purge', 'chunk_size', b3.INT, self._chunk_size, lambda x: max(0, x))
+        self._chunk_pause = self.getSetting('purge', 'chunk_pause', b3.FLOAT, self._chunk_pause, lambda x: max(0.0, x))
+        self._purge_duration = self.getSetting('purge', 'max_duration', b3.DURATION, self._purge_duration,
+                                               lambda x: max(0, x))
+        self._partitions = self.getSetting('purge', 'partitions', b3.BOOL, self._partitions)
+        self._partitions_ahead = self.getSetting('purge', 'partitions_ahead', b3.INT, self._partitions_ahead,
+                                                 lambda x: max(1, x))
+
         if self._max_age_in_days != 0 or self._max_age_cmd_in_days != 0:
             # get time_zone from main B3 config
             tzName = self.console.config.get('b3', 'time_zone').upper()
@@ -202,6 +234,18 @@ class ChatloggerPlugin(Plugin):
         else:
             self.info("chat log messages are kept forever")
 
+        self._batch_size = self.getSetting('database', 'batch_size', b3.INT, self._batch_size, lambda x: max(1, x))
+        self._flush_interval = self.getSetting('database', 'flush_interval', b3.FLOAT, self._flush_interval,
+                                               lambda x: max(0.0, x))
+        self._queue_size = self.getSetting('database', 'queue_size', b3.INT, self._queue_size, lambda x: max(1, x))
+        self._overflow = self.getSetting('database', 'overflow', b3.STR, self._overflow, lambda x: x.lower())
+        if self._overflow not in ('drop', 'spill'):
+            self.warning("unexpected value for overflow: using default value 'drop' instead (%s)", self._overflow)
+            self._overflow = 'drop'
+        self._spill_file = self.getSetting('database', 'spill_file', b3.STR, self._spill_file)
+        self._spill_max_size = self.getSetting('database', 'spill_max_size', b3.INT, self._spill_max_size,
+                                               lambda x: max(1, x))
+
     def onStartup(self):
         """
         Startup the plugin
@@ -213,6 +257,25 @@ class ChatloggerPlugin(Plugin):
             sql_path = os.path.join(sql_path_main, self.console.storage.dsnDict['protocol'], 'chatlogger.sql')
             self.console.storage.queryFromFile(sql_path)
 
+        # the partitions of the days to come must exist before rows are written: they would otherwise land in the
+        # catch-all partition, which can only be split by copying them
+        if self._save2db and self._partitions and self.console.storage.protocol == 'mysql':
+            for table, column in ((self._db_table, 'msg_time'), (self._db_table_cmdlog, 'cmd_time')):
+                try:
+                    self.createPartitions(table, column)
+                except Exception, e:
+                    self.error('could not create the partitions of table %s: %s' % (table, e))
+
+        # rows are written to the database by a dedicated thread so that event handling never waits for the storage
+        if self._save2db and not self._writer:
+            spill_file = None
+            if self._overflow == 'spill':
+                spill_file = b3.getWritableFilePath(b3.getAbsolutePath(self._spill_file))
+            self._writer = ChatlogWriter(self, batch_size=self._batch_size, flush_interval=self._flush_interval,
+                                         queue_size=self._queue_size, spill_file=spill_file,
+                                         spill_max_size=self._spill_max_size * 1024 * 1024)
+            self._writer.start()
+
         # listen for client events
         self.registerEvent('EVT_CLIENT_SAY', self.onSay)
         self.registerEvent('EVT_CLIENT_TEAM_SAY', self.onTeamSay)
@@ -231,6 +294,20 @@ class ChatloggerPlugin(Plugin):
     #                                                                                                                  #
     ####################################################################################################################
 
+    def onStop(self, event):
+        """
+        Handle EVT_STOP
+        """
+        self.stopPurge()
+        self.stopWriter()
+
+    def onExit(self, event):
+        """
+        Handle EVT_EXIT
+        """
+        self.stopPurge()
+        self.stopWriter()
+
     def onSay(self, event):
         """
         Handle EVT_CLIENT_SAY
@@ -295,23 +372,195 @@ class ChatloggerPlugin(Plugin):
         """
         Clear log data from database
         """
+        # the purge may take a while on big tables: run it in its own thread not to block the other cron tasks
+        if self._purge_thread and self._purge_thread.isAlive():
+            self.warning('previous purge still running: skipping')
+            return
+        self._purge_abort.clear()
+        self._purge_thread = threading.Thread(target=self._purge, name='chatlogger-purge')
+        self._purge_thread.setDaemon(True)
+        self._purge_thread.start()
+
+    def _purge(self):
+        """
+        Clear log data from database, one table after the other
+        """
+        deadline = time.time() + self._purge_duration * 60 if self._purge_duration else None
+
         if self._max_age_in_days and (self._max_age_in_days != 0):
             self.info('purge of chat messages older than %s days ...' % self._max_age_in_days)
-            q = "DELETE FROM %s WHERE msg_time < %i" % (self._db_table,
-                                                        self.console.time() - (self._max_age_in_days * 24 * 60 * 60))
-            self.debug(q)
-            self.console.storage.query(q)
+            self.purgeTable(self._db_table, 'msg_time',
+                            self.console.time() - (self._max_age_in_days * 24 * 60 * 60), deadline)
         else:
             self.warning('max_age is invalid [%s]' % self._max_age_in_days)
 
         if self._max_age_cmd_in_days and (self._max_age_cmd_in_days != 0):
             self.info('purge of commands older than %s days ...' % self._max_age_cmd_in_days)
-            q = "DELETE FROM %s WHERE cmd_time < %i" % (self._db_table_cmdlog,
-                                                        self.console.time() - (self._max_age_cmd_in_days * 24 * 60 * 60))
+            self.purgeTable(self._db_table_cmdlog, 'cmd_time',
+                            self.console.time() - (self._max_age_cmd_in_days * 24 * 60 * 60), deadline)
+        else:
+            self.warning('max_age_cmd is invalid [%s]' % self._max_age_cmd_in_days)
+
+    def purgeTable(self, table, column, before, deadline=None):
+        """
+        Delete the rows of a table older than the given timestamp.
+        :param table: The name of the table
+        :param column: The name of the timestamp column
+        :param before: The timestamp before which rows are deleted
+        :param deadline: The time after which the purge stops, to resume at the next purge, or None
+        """
+        # the rows of the partition made at conversion time are older than any daily partition: they are deleted
+        # by chunks below rather than kept until the whole partition expires
+        if self._partitions:
+            if self.console.storage.protocol != 'mysql':
+                self.warning('table partitioning is only supported with MySQL: falling back to chunked delete')
+            elif self.purgePartitions(table, column, before) and not self._chunk_size:
+                return
+
+        if not self._chunk_size:
+            q = "DELETE FROM %s WHERE %s < %i" % (table, column, before)
             self.debug(q)
             self.console.storage.query(q)
+            return
+
+        # ids grow with time: walk the table by primary key ranges from the oldest row and stop at the first range
+        # still holding rows after the delete. Each query only touches chunk_size ids so live inserts barely wait
+        start = time.time()
+        deleted = 0
+        chunks = 0
+        low = self._getMinId(table)
+        while low is not None:
+            high = low + self._chunk_size
+            q = "DELETE FROM %s WHERE id >= %i AND id < %i AND %s < %i" % (table, low, high, column, before)
+            cursor = self.console.storage.query(q)
+            deleted += max(0, cursor.rowcount)
+            chunks += 1
+            low = self._getMinId(table)
+            if low is None or low < high:
+                break
+            if chunks % 10 == 0:
+                self.debug('purge of %s in progress: %s rows deleted, resuming from id %s' % (table, deleted, low))
+            if deadline and time.time() >= deadline:
+                self.info('purge of %s stopped after %s minutes: will resume at next purge (id %s)' % (
+                          table, self._purge_duration, low))
+                break
+            if self._purge_abort.wait(self._chunk_pause):
+                self.info('purge of %s interrupted (id %s)' % (table, low))
+                break
+
+        self.info('purged %s rows from %s in %s chunks (%.1fs)' % (deleted, table, chunks, time.time() - start))
+
+    def purgePartitions(self, table, column, before):
+        """
+        Drop the daily partitions of a table holding rows older than the given timestamp only and create the
+        partitions of the days to come.
+        :param table: The name of the table
+        :param column: The name of the timestamp column the table is partitioned by
+        :param before: The timestamp before which rows are deleted
+        :return: False if the table is not partitioned, True otherwise
+        """
+        partitions = self._getPartitions(table)
+        if not partitions:
+            self.warning('table %s is not partitioned: falling back to chunked delete' % table)
+            return False
+
+        old = [name for name, bound in partitions if bound is not None and bound <= before]
+        if old:
+            q = "ALTER TABLE %s DROP PARTITION %s" % (table, ', '.join(old))
+            self.debug(q)
+            self.console.storage.query(q)
+            self.info('dropped %s partitions from %s' % (len(old), table))
+            partitions = [x for x in partitions if x[0] not in old]
+
+        self.createPartitions(table, column, partitions)
+        return True
+
+    def createPartitions(self, table, column, partitions=None):
+        """
+        Create the daily partitions of the days to come, ahead of the rows, so that the catch-all partition split
+        to make them is always empty and no row gets copied.
+        :param table: The name of the table
+        :param column: The name of the timestamp column the table is partitioned by
+        :param partitions: The partitions of the table, as returned by _getPartitions, or None to look them up
+        """
+        if partitions is None:
+            partitions = self._getPartitions(table)
+        if not partitions:
+            return
+
+        bounds = [bound for name, bound in partitions if bound is not None]
+        day = 24 * 60 * 60
+        last = max(bounds) if bounds else 0
+        target = (self.console.time() // day + 1) * day + self._partitions_ahead * day
+        if last >= target:
+            return
+
+        name, bound = partitions[-1]
+        if bound is None:
+            cursor = self.console.storage.query("SELECT %s FROM %s WHERE %s >= %i LIMIT 1" % (column, table,
+                                                                                            column, last))
+            empty = cursor.EOF
+            cursor.close()
+            if not empty:
+                self.warning('partition %s of table %s holds rows: not creating the partitions of the days to come '
+                             'since it would copy them (see sql/mysql/partitions.sql)' % (name, table))
+                return
+
+        # the first partition made at conversion time ends at midnight, like all the daily ones
+        last = max(last, self.console.time() // day * day)
+        new = []
+        while last < target:
+            last += day
+            new.append("PARTITION p%s VALUES LESS THAN (%i)" % (time.strftime('%Y%m%d', time.gmtime(last - day)), last))
+        if bound is None:
+            new.append("PARTITION %s VALUES LESS THAN MAXVALUE" % name)
+            q = "ALTER TABLE %s REORGANIZE PARTITION %s INTO (%s)" % (table, name, ', '.join(new))
         else:
-            self.warning('max_age_cmd is invalid [%s]' % self._max_age_cmd_in_days)
+            q = "ALTER TABLE %s ADD PARTITION (%s)" % (table, ', '.join(new))
+        self.debug(q)
+        self.console.storage.query(q)
+
+    def _getPartitions(self, table):
+        """
+        Return the (name, upper bound) list of the partitions of the given table, in order. The bound of the
+        catch-all partition is None. The list is empty if the table is not partitioned.
+        """
+        q = """SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound FROM INFORMATION_SCHEMA.PARTITIONS
+               WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '%s' AND PARTITION_NAME IS NOT NULL
+               ORDER BY PARTITION_ORDINAL_POSITION""" % table
+        partitions = []
+        cursor = self.console.storage.query(q)
+        while not cursor.EOF:
+            r = cursor.getRow()
+            partitions.append((r['name'], None if r['bound'] == 'MAXVALUE' else int(r['bound'])))
+            cursor.moveNext()
+        cursor.close()
+        return partitions
+
+    def _getMinId(self, table):
+        """
+        Return the smallest id of the given table or None if the table is empty
+        """
+        cursor = self.console.storage.query("SELECT MIN(id) AS min_id FROM %s" % table)
+        r = cursor.getOneRow()
+        return r.get('min_id') if r else None
+
+    def stopPurge(self):
+        """
+        Interrupt the running purge
+        """
+        if self._purge_thread:
+            self._purge_abort.set()
+            self._purge_thread.join(10)
+            self._purge_thread = None
+
+    def stopWriter(self):
+        """
+        Write the pending rows to the database and stop the writer thread
+        """
+        if self._writer:
+            self._writer.stop()
+            self._writer = None
 
     def string2days(self, text):
         """
@@ -334,38 +583,282 @@ class ChatloggerPlugin(Plugin):
         return days
 
 
+class ChatlogWriter(object):
+    """
+    Write chatlog rows to the database from a dedicated thread.
+
+    Rows are buffered in a bounded queue and written with a single multi-row INSERT per table when batch_size rows
+    are pending or flush_interval seconds elapsed since the first pending row. Rows which cannot be written, because
+    the queue is full or the database is not available, are dropped or, when a spill file is given, appended to it
+    and written to the database once it accepts inserts again. When the database rejects a multi-row INSERT while
+    still being available, the rows are written one at a time and those it keeps rejecting are dropped.
+    """
+
+    def __init__(self, plugin, batch_size=50, flush_interval=2.0, queue_size=5000, spill_file=None,
+                 spill_max_size=10485760):
+        """
+        Object constructor.
+        :param plugin: The chatlogger plugin instance
+        :param batch_size: The maximum number of rows written with a single query
+        :param flush_interval: The maximum number of seconds a row waits in the queue before being written
+        :param queue_size: The maximum number of rows waiting to be written
+        :param spill_file: The file where to save the rows which cannot be written or None to drop them
+        :param spill_max_size: The maximum size of the spill file in bytes: rows are dropped once it is reached
+        """
+        self.plugin = plugin
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval)
+        self.spill_file = spill_file
+        self.spill_max_size = max(1, spill_max_size)
+        self.dropped = 0
+        self._queue = Queue.Queue(max(1, queue_size))
+        self._spill_lock = threading.Lock()
+        self._spilled = spill_file is not None and (os.path.isfile(spill_file) or
+                                                    os.path.isfile(spill_file + '.replay'))
+        self._thread = None
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='chatlogger-writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Write the pending rows and stop the writer thread.
+        """
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except Queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.isAlive():
+            self.plugin.warning('chatlog writer did not stop in time: %s rows may be lost', self._queue.qsize())
+        self._thread = None
+
+    def put(self, table, columns, row):
+        """
+        Queue a row to be written to the database.
+        :param table: The name of the table
+        :param columns: The tuple of column names
+        :param row: The tuple of values, in the same order as the columns
+        """
+        try:
+            self._queue.put_nowait((table, columns, row))
+        except Queue.Full:
+            self._discard([(table, columns, row)], 'chatlog writer queue is full')
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #   OTHER METHODS                                                                                                  #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def _run(self):
+        """
+        Write the queued rows until a None item is received.
+        """
+        rows = []
+        expires = 0
+        while True:
+            try:
+                if not rows:
+                    item = self._queue.get()
+                    expires = time.time() + self.flush_interval
+                else:
+                    item = self._queue.get(True, max(0.0, expires - time.time()))
+            except Queue.Empty:
+                item = ()
+
+            if item:
+                rows.append(item)
+            if item is None or len(rows) >= self.batch_size or (rows and time.time() >= expires):
+                if self._flush(rows) and self._spilled:
+                    self._replay()
+                rows = []
+            if item is None:
+                break
+
+    def _flush(self, rows):
+        """
+        Write the given rows to the database, one query per table.
+        :return: True if all the rows have been written, False otherwise
+        """
+        groups = {}
+        order = []
+        for table, columns, row in rows:
+            key = (table, columns)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(row)
+
+        written = True
+        for table, columns in order:
+            if not self._write(table, columns, groups[(table, columns)]):
+                written = False
+        return written
+
+    def _write(self, table, columns, rows):
+        """
+        Insert the given rows into the given table, one at a time if the database rejects the multi-row query.
+        Rows the database keeps rejecting while being available are dropped: they would otherwise fail every replay.
+        :return: True if the rows have been written or dropped, False if the database is not available
+        """
+        try:
+            self._insert(table, columns, rows)
+            return True
+        except Exception, e:
+            error = e
+
+        for i, row in enumerate(rows):
+            if len(rows) > 1:
+                try:
+                    self._insert(table, columns, [row])
+                    continue
+                except Exception, e:
+                    error = e
+            if not self._isAvailable():
+                self._discard([(table, columns, x) for x in rows[i:]], 'could not save to database (%s)' % error)
+                return False
+            self.dropped += 1
+            self.plugin.error('dropping chatlog row rejected by the database: %s %r (%s)' % (table, row, error))
+        return True
+
+    def _isAvailable(self):
+        """
+        Tell whether the connection with the database is active.
+        """
+        try:
+            return bool(self.plugin.console.storage.status())
+        except Exception:
+            return False
+
+    def _insert(self, table, columns, rows):
+        """
+        Insert the given rows into the given table with a single query.
+        """
+        storage = self.plugin.console.storage
+        # sqlite does not understand the pyformat parameter style used by the other database modules
+        placeholder = ':%s' if storage.protocol == 'sqlite' else '%%(%s)s'
+        values = []
+        data = {}
+        for i, row in enumerate(rows):
+            names = ['p%s_%s' % (i, j) for j in xrange(len(columns))]
+            values.append('(%s)' % ', '.join(placeholder % x for x in names))
+            data.update(zip(names, row))
+
+        q = "INSERT INTO %s (%s) VALUES %s" % (table, ', '.join(columns), ', '.join(values))
+        try:
+            cursor = storage.query(q, data)
+        except Exception, e:
+            if e.args and e[0] == 1146:
+                self.plugin.error("could not save to database : %s" % e[1])
+                self.plugin.info("refer to this plugin readme file for instruction on how to create the required tables")
+            raise
+        self.plugin.verbose("inserted %s rows into %s" % (cursor.rowcount, table))
+
+    def _discard(self, rows, reason):
+        """
+        Append the given rows to the spill file or drop them.
+        """
+        if self.spill_file:
+            try:
+                lines = [json.dumps([table, columns, row]) + '\n' for table, columns, row in rows]
+                saved = False
+                with self._spill_lock:
+                    size = os.path.getsize(self.spill_file) if os.path.isfile(self.spill_file) else 0
+                    if size + sum(len(x) for x in lines) <= self.spill_max_size:
+                        with open(self.spill_file, 'a') as f:
+                            f.writelines(lines)
+                        self._spilled = True
+                        saved = True
+                if saved:
+                    self.plugin.debug('%s: %s rows saved to %s' % (reason, len(rows), self.spill_file))
+                    return
+                reason = '%s, %s is full' % (reason, self.spill_file)
+            except (IOError, OSError, ValueError, UnicodeDecodeError), e:
+                self.plugin.error('could not write chatlog rows to %s: %s' % (self.spill_file, e))
+
+        # warn once in a while only: a database outage could otherwise flood the log
+        if self.dropped % 100 == 0:
+            self.plugin.warning('%s: dropping chatlog rows (%s dropped so far)' % (reason, self.dropped + len(rows)))
+        self.dropped += len(rows)
+
+    def _replay(self):
+        """
+        Write the rows saved in the spill file to the database.
+        """
+        replay_file = self.spill_file + '.replay'
+        with self._spill_lock:
+            self._spilled = False
+            try:
+                # a previous replay may have been interrupted: its file must be processed first
+                if not os.path.isfile(replay_file):
+                    os.rename(self.spill_file, replay_file)
+                else:
+                    self._spilled = os.path.isfile(self.spill_file)
+            except OSError, e:
+                self.plugin.error('could not replay chatlog rows from %s: %s' % (self.spill_file, e))
+                return
+
+        rows = []
+        try:
+            with open(replay_file) as f:
+                for line in f:
+                    try:
+                        table, columns, row = json.loads(line)
+                        rows.append((str(table), tuple(str(x) for x in columns), tuple(row)))
+                    except (ValueError, TypeError), e:
+                        self.plugin.warning('ignoring invalid chatlog row %r: %s' % (line, e))
+        except IOError, e:
+            self.plugin.error('could not replay chatlog rows from %s: %s' % (replay_file, e))
+            return
+
+        self.plugin.info('writing %s chatlog rows saved in %s to the database' % (len(rows), self.spill_file))
+        for i in xrange(0, len(rows), self.batch_size):
+            if not self._flush(rows[i:i + self.batch_size]):
+                # the database is gone again: keep the remaining rows for the next replay
+                if rows[i + self.batch_size:]:
+                    self._discard(rows[i + self.batch_size:], 'could not save to database')
+                break
+        try:
+            os.remove(replay_file)
+        except OSError, e:
+            self.plugin.error('could not remove %s: %s' % (replay_file, e))
+
+
 class AbstractData(object):
 
+    # (column name, data key) pairs of the table for this data object
+    _columns = ()
+
     def __init__(self, plugin):
         # default name of the table for this data object
         self._table = None
         self.plugin = plugin
 
-    def _insertquery(self):
-        raise NotImplementedError
-
     def save(self):
         """Should call self._save2db with correct parameters"""
         raise NotImplementedError
 
     def _save2db(self, data):
-        q = self._insertquery()
-        try:
-            cursor = self.plugin.console.storage.query(q, data)
-            if cursor.rowcount > 0:
-                self.plugin.debug("rowcount: %s, id:%s" % (cursor.rowcount, cursor.lastrowid))
-            else:
-                self.plugin.warning("inserting into %s failed" % self._table)
-        except Exception, e:
-            if e[0] == 1146:
-                self.plugin.error("could not save to database : %s" % e[1])
-                self.plugin.info("refer to this plugin readme file for instruction on how to create the required tables")
-            else:
-                raise e
+        if self.plugin._writer:
+            self.plugin._writer.put(self._table, tuple(c for c, k in self._columns),
+                                    tuple(data[k] for c, k in self._columns))
+        else:
+            self.plugin.warning("chatlog writer is not running: could not save to %s" % self._table)
 
 
 class CmdData(AbstractData):
 
+    _columns = (('cmd_time', 'time'), ('admin_id', 'admin_id'), ('admin_name', 'admin_name'),
+                ('command', 'command'), ('data', 'data'), ('result', 'result'))
+
     def __init__(self, plugin, event):
         AbstractData.__init__(self, plugin)
         # default name of the table for this data object
@@ -379,11 +872,6 @@ class CmdData(AbstractData):
         self.result = event.data[2]
         self.event = event
 
-    def _insertquery(self):
-        return """INSERT INTO {table_name} (cmd_time, admin_id, admin_name, command, data, result)
-                  VALUES (%(time)s, %(admin_id)s, %(admin_name)s, %(command)s, %(data)s, %(result)s) """.format(
-                  table_name=self._table)
-
     def save(self):
         self.plugin.verbose("%s, %s, %s, %s, %s" % (self.admin_id, self.admin_name, self.command, self.data, self.result))
         data = {'time': self.plugin.console.time(),
@@ -399,6 +887,10 @@ class CmdData(AbstractData):
 
 class ChatData(AbstractData):
 
+    _columns = (('msg_time', 'time'), ('msg_type', 'type'), ('client_id', 'client_id'),
+                ('client_name', 'client_name'), ('client_team', 'client_team'), ('msg', 'msg'),
+                ('target_id', 'target_id'), ('target_name', 'target_name'), ('target_team', 'target_team'))
+
     #fields of the table
     msg_type = 'ALL' # ALL, TEAM or PM
     client_id = None
@@ -418,12 +910,6 @@ class ChatData(AbstractData):
         self.target_name = None
         self.target_team = None
 
-    def _insertquery(self):
-        return """INSERT INTO {table_name}
-                  (msg_time, msg_type, client_id, client_name, client_team, msg, target_id, target_name, target_team)
-                  VALUES (%(time)s, %(type)s, %(client_id)s, %(client_name)s, %(client_team)s, %(msg)s, %(target_id)s,
-                  %(target_name)s, %(target_team)s )""".format(table_name=self._table)
-
     def save(self):
         self.plugin.verbose("%s, %s, %s, %s" % (self.msg_type, self.client_id, self.client_name, self.msg))
         data = {'time': self.plugin.console.time(),
@@ -0,0 +1,22 @@
+-- Convert the chatlog and cmdlog tables to tables partitioned by day, to be used with the [purge] partitions setting.
+-- Every row is rewritten: run this once, while B3 is stopped. The plugin then creates the daily partitions ahead
+-- and drops the ones older than max_age / max_age_cmd instead of deleting rows.
+-- The rows existing at conversion time go to the p0 partition, bounded at the next midnight (UTC), so that the
+-- catch-all pmax partition starts empty and the daily partitions are created without copying any row. The plugin
+-- deletes the rows of p0 older than max_age / max_age_cmd by chunks, until p0 expires and is dropped.
+
+SET @p0 = (UNIX_TIMESTAMP() DIV 86400 + 1) * 86400;
+
+SET @q = CONCAT('ALTER TABLE chatlog ENGINE=InnoDB, DROP PRIMARY KEY, ADD PRIMARY KEY (id, msg_time) ',
+                'PARTITION BY RANGE (msg_time) (PARTITION p0 VALUES LESS THAN (', @p0, '), ',
+                'PARTITION pmax VALUES LESS THAN MAXVALUE)');
+PREPARE stmt FROM @q;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+SET @q = CONCAT('ALTER TABLE cmdlog ENGINE=InnoDB, DROP PRIMARY KEY, ADD PRIMARY KEY (id, cmd_time) ',
+                'PARTITION BY RANGE (cmd_time) (PARTITION p0 VALUES LESS THAN (', @p0, '), ',
+                'PARTITION pmax VALUES LESS THAN MAXVALUE)');
+PREPARE stmt FROM @q;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
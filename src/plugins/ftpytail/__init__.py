@@ -22,7 +22,7 @@
 #                                                                     #
 # ################################################################### #
  
-__version__ = '1.10'
+__version__ = '1.11'
 __author__ = 'Bakes, Courgette'
 
 import b3
@@ -40,7 +40,6 @@ from b3 import functions
 class FtpytailPlugin(b3.plugin.Plugin):
 
     requiresConfigFile = False
-    buffer = None
     file = None
     ftpconfig = None
     lgame_log = None
@@ -67,6 +66,19 @@ class FtpytailPlugin(b3.plugin.Plugin):
     _use_windows_cache_fix = False
     _cache_refresh_delay = 1
 
+    # the delay between two polls grows by _delay_factor after every poll returning no data, up to _max_read_delay
+    # seconds, and falls back to _gamelog_read_delay as soon as new data is downloaded
+    _max_read_delay = 2.0
+    _delay_factor = 1.5
+    _stats_interval = 300           # time (in sec) between two logs of the polling statistics
+
+    _polls = 0
+    _emptyPolls = 0
+    _bytes = 0
+    _pollTime = 0.0
+    _lastPollTime = 0.0
+    _readDelay = None
+
     ####################################################################################################################
     #                                                                                                                  #
     #    STARTUP                                                                                                       #
@@ -177,6 +189,29 @@ class FtpytailPlugin(b3.plugin.Plugin):
             self.error('could not load settings/long_delay config value: %s' % e)
             self.debug('using default value (%s) for settings/long_delay' % self._long_delay)
 
+        try:
+            self._max_read_delay = self.config.getfloat('settings', 'max_delay')
+            self.debug('loaded settings/max_delay: %s' % self._max_read_delay)
+        except NoOptionError:
+            self.warning('could not find settings/max_delay in config file, '
+                         'using default: %s' % self._max_read_delay)
+        except ValueError, e:
+            self.error('could not load settings/max_delay config value: %s' % e)
+            self.debug('using default value (%s) for settings/max_delay' % self._max_read_delay)
+
+        try:
+            self._delay_factor = self.config.getfloat('settings', 'delay_factor')
+            if self._delay_factor < 1:
+                raise ValueError('delay_factor must be at least 1 (%s)' % self._delay_factor)
+            self.debug('loaded settings/delay_factor: %s' % self._delay_factor)
+        except NoOptionError:
+            self.warning('could not find settings/delay_factor in config file, '
+                         'using default: %s' % self._delay_factor)
+        except ValueError, e:
+            self._delay_factor = FtpytailPlugin._delay_factor
+            self.error('could not load settings/delay_factor config value: %s' % e)
+            self.debug('using default value (%s) for settings/delay_factor' % self._delay_factor)
+
         self.info("until %s consecutive errors are met, the bot will wait for %s seconds (short_delay), "
                   "then it will wait for %s seconds (long_delay)" % (self._maxConsecutiveConnFailure,
                                                                      self._short_delay, self._long_delay))
@@ -195,6 +230,17 @@ class FtpytailPlugin(b3.plugin.Plugin):
     #                                                                                                                  #
     ####################################################################################################################
 
+    def getStats(self):
+        """
+        Return the polling statistics of the FTP log tail.
+        """
+        return {'polls': self._polls,
+                'empty_polls': self._emptyPolls,
+                'bytes': self._bytes,
+                'avg_latency': self._pollTime / self._polls if self._polls else 0.0,
+                'last_latency': self._lastPollTime,
+                'delay': self._readDelay}
+
     def update(self):
         """
         Update the local log file.
@@ -202,16 +248,16 @@ class FtpytailPlugin(b3.plugin.Plugin):
         def handle_download(block):
             #self.debug('received %s bytes' % len(block))
             self._remoteFileOffset += len(block)
-            if self.buffer is None:
-                self.buffer = block
-            else:
-                self.buffer = self.buffer + block
+            blocks.append(block)
         
         def force_windows_cache_reload(_):
             # no need to do anything here so
             return
             
         ftp = None
+        blocks = []
+        self._readDelay = self._gamelog_read_delay
+        nextStats = time.time() + self._stats_interval
         self.file = open(self.lgame_log, 'ab')
         self.file.write('\r\n')
         self.file.write('B3 has been restarted\r\n')
@@ -241,7 +287,8 @@ class FtpytailPlugin(b3.plugin.Plugin):
                     ftp.retrbinary('RETR ' + os.path.basename(self.url_path),
                                    force_windows_cache_reload, 1,
                                    rest=self._remoteFileOffset)
-                    
+
+                start = time.time()
                 remotesize = ftp.size(os.path.basename(self.url_path))
                 if remotesize < self._remoteFileOffset:
                     self.debug("remote file rotation detected")
@@ -258,17 +305,34 @@ class FtpytailPlugin(b3.plugin.Plugin):
                                    handle_download,
                                    rest=self._remoteFileOffset)
 
-                    if self.buffer:
-                        self.file.write(self.buffer)
-                        self.buffer = None
-                        self.file.flush()
-
                     if self.console._paused:
                         self.console.unpause()
                         self.debug('unpausing')
 
+                    self._readDelay = self._gamelog_read_delay
+                else:
+                    # nothing happening on the game server: poll it less often
+                    self._emptyPolls += 1
+                    self._readDelay = min(self._readDelay * self._delay_factor,
+                                          max(self._max_read_delay, self._gamelog_read_delay))
+
+                if blocks:
+                    # blocks received before an FTP error are kept and written by the next successful poll: they are
+                    # already counted in the remote file offset. Joining the blocks once is linear in the downloaded
+                    # size, appending them one by one is not
+                    data = ''.join(blocks)
+                    del blocks[:]
+                    self.file.write(data)
+                    self.file.flush()
+                    self._bytes += len(data)
+
+                self._lastPollTime = time.time() - start
+                self._pollTime += self._lastPollTime
+                self._polls += 1
+
             except ftplib.all_errors, e:
                 self.debug(str(e))
+                self._readDelay = self._gamelog_read_delay
                 self._nbConsecutiveConnFailure += 1
                 if self.console._paused is False:
                     self.console.pause()
@@ -301,7 +365,13 @@ class FtpytailPlugin(b3.plugin.Plugin):
                 else:
                     self.debug('too many failures: sleeping %s sec' % self._long_delay)
                     time.sleep(self._long_delay)
-            time.sleep(self._gamelog_read_delay)
+
+            if time.time() >= nextStats:
+                nextStats = time.time() + self._stats_interval
+                self.debug('%(polls)s polls (%(empty_polls)s empty), %(bytes)s bytes downloaded, '
+                           'average latency %(avg_latency).3fs, current delay %(delay).3fs' % self.getStats())
+
+            time.sleep(self._readDelay)
 
         self.verbose("stopping Ftpytail update thread")
 
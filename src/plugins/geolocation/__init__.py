@@ -23,38 +23,77 @@
 # ################################################################### #
 
 __author__ = 'Fenix'
-__version__ = '1.5'
+__version__ = '1.7'
 
 import b3
 import b3.clients
 import b3.plugin
 import b3.events
+import Queue
 import threading
 
+from .cache import LocationCache
 from .exceptions import GeolocalizationError
 from .geolocators import FreeGeoIpGeolocator
 from .geolocators import IpApiGeolocator
 from .geolocators import MaxMindGeolocator
 from .geolocators import TelizeGeolocator
 
+GEOLOCATORS = {
+    'ipapi': IpApiGeolocator,
+    'telize': TelizeGeolocator,
+    'freegeoip': FreeGeoIpGeolocator,
+    'maxmind': MaxMindGeolocator,
+}
+
 
 class GeolocationPlugin(b3.plugin.Plugin):
 
     requiresConfigFile = False
 
+    _geolocatorNames = ['ipapi', 'telize', 'freegeoip', 'maxmind']
+    _cachePath = '@home/geolocation.sqlite'
+    _cacheTtl = 604800
+    _cacheMemorySize = 1000
+    _cacheMaxSize = 50000
+    _workers = 4
+    _queueSize = 256
+
     def __init__(self, console, config=None):
         """
         Build the plugin object.
         """
         b3.plugin.Plugin.__init__(self, console, config)
-        # create geolocators instances
+        self._geolocators = []
+        self._cache = None
+        self._queue = None
+        self._threads = []
+
+    def onLoadConfig(self):
+        """
+        Load plugin configuration.
+        """
+        self._geolocatorNames = self.getSetting('settings', 'geolocators', b3.LIST, self._geolocatorNames)
+        self._cachePath = self.getSetting('settings', 'cache_file', b3.STR, self._cachePath)
+        self._cacheTtl = int(self.getSetting('settings', 'cache_ttl', b3.DURATION, self._cacheTtl / 60, lambda x: max(1, x)) * 60)
+        self._cacheMemorySize = self.getSetting('settings', 'cache_memory_size', b3.INT, self._cacheMemorySize, lambda x: max(1, x))
+        self._cacheMaxSize = self.getSetting('settings', 'cache_max_size', b3.INT, self._cacheMaxSize, lambda x: max(1, x))
+        self._workers = self.getSetting('settings', 'workers', b3.INT, self._workers, lambda x: max(1, min(32, x)))
+        self._queueSize = self.getSetting('settings', 'queue_size', b3.INT, self._queueSize, lambda x: max(1, x))
+
+        # create geolocators instances in the configured order
         self.info('creating geolocators object instances...')
-        self._geolocators = [IpApiGeolocator(), TelizeGeolocator(), FreeGeoIpGeolocator()]
-        try:
-            # append this one separately since db may be missing
-            self._geolocators.append(MaxMindGeolocator())
-        except IOError, e:
-            self.debug('MaxMind geolocation not available: %s' % e)
+        self._geolocators = []
+        for name in self._geolocatorNames:
+            name = name.strip().lower()
+            if name not in GEOLOCATORS:
+                self.warning('unknown geolocator %r: expecting one of (%s)', name, ', '.join(sorted(GEOLOCATORS)))
+                continue
+            try:
+                self._geolocators.append(GEOLOCATORS[name]())
+            except IOError, e:
+                # MaxMind database may be missing
+                self.debug('%s geolocation not available: %s', name, e)
 
     def onStartup(self):
         """
@@ -72,25 +111,135 @@ class GeolocationPlugin(b3.plugin.Plugin):
         self.console.createEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', 'Event client geolocation success')
         self.console.createEvent('EVT_CLIENT_GEOLOCATION_FAILURE', 'Event client geolocation failure')
 
+        path = b3.getWritableFilePath(self._cachePath) if self._cachePath else None
+        self._cache = LocationCache(path, ttl=self._cacheTtl, memorySize=self._cacheMemorySize,
+                                    maxSize=self._cacheMaxSize, logger=self)
+        self.debug('loaded %s cached locations', len(self._cache))
+
+        # geolocation is performed by a fixed number of threads instead of one thread per event
+        self._queue = Queue.Queue(self._queueSize)
+        for i in range(self._workers):
+            t = threading.Thread(target=self._worker, args=(self._queue,), name='geolocation-%s' % i)
+            t.daemon = True  # won't prevent B3 from exiting
+            t.start()
+            self._threads.append(t)
+
     ####################################################################################################################
     #                                                                                                                  #
     #   EVENTS                                                                                                         #
     #                                                                                                                  #
     ####################################################################################################################
 
+    def onStop(self, event):
+        """
+        Handle EVT_STOP.
+        """
+        self.stopWorkers()
+
+    def onExit(self, event):
+        """
+        Handle EVT_EXIT.
+        """
+        self.stopWorkers()
+
     def geolocate(self, event):
         """
         Handle EVT_CLIENT_AUTH and EVT_CLIENT_UPDATE.
         """
-        def _threaded_geolocate(client):
+        client = event.client
+        # do not use hasattr or try except here: we'd better try to get geodata also when a previous attempt failed
+        # and we ended up with NoneType object in client.location (so we have an attribute but it's not useful).
+        # also make sure to launch geolocation only if we have a valid ip address.
+        if getattr(client, 'location', None) or not client.ip:
+            return
+
+        # cached locations are served right away: no need to bother the worker threads
+        location = self._cache.get(client.ip) if self._cache else None
+        if location is not None:
+            client.location = location
+            self.debug('retrieved cached geolocation data for %s <@%s>: %r', client.name, client.id, client.location)
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+            return
 
+        # local geolocators (MaxMind database) are fast enough to be queried right away when they come first
+        if self._geolocators and self._geolocators[0].local:
             client.location = None
+            try:
+                client.location = self._geolocators[0].getLocation(client.ip)
+            except Exception, e:
+                self.debug('could not retrieve geolocation data for %s <@%s> from %s: %s', client.name, client.id,
+                           self._geolocators[0].__class__.__name__, e)
+            if client.location is not None:
+                self.debug('retrieved geolocation data for %s <@%s>: %r', client.name, client.id, client.location)
+                self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+                return
+
+        queue = self._queue
+        if queue is None:
+            return
+
+        try:
+            queue.put_nowait(client)
+        except Queue.Full:
+            self.warning('geolocation queue is full: could not geolocate %s <@%s>', client.name, client.id)
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_FAILURE', client=client))
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #   OTHER METHODS                                                                                                  #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def stopWorkers(self):
+        """
+        Stop the geolocation threads and close the location cache once they all exited.
+        """
+        queue = self._queue
+        self._queue = None
+        if queue is not None:
+            for t in self._threads:
+                try:
+                    queue.put(None, timeout=1)
+                except Queue.Full:
+                    break
+
+        for t in self._threads:
+            t.join(5)
+        # a thread may still be waiting for a slow geolocation service: it keeps using the cache until it is done
+        self._threads = [t for t in self._threads if t.isAlive()]
+        if self._threads:
+            self.warning('%s geolocation threads did not stop in time: leaving the location cache open',
+                         len(self._threads))
+        elif self._cache is not None:
+            self._cache.close()
+
+    def _worker(self, queue):
+        """
+        Geolocate the clients found in the given queue until a None item is received.
+        """
+        while True:
+            client = queue.get()
+            if client is None:
+                break
+            try:
+                self._geolocateClient(client)
+            except Exception, e:
+                self.error('client %s <@%s> geolocation terminated unexpectedly: %s', client.name, client.id, e)
+
+    def _geolocateClient(self, client):
+        """
+        Retrieve the location of the given client using the configured geolocators, in order.
+        """
+        ip = client.ip
+        # the same client may have been queued twice: the first job filled the cache
+        client.location = self._cache.get(ip) if self._cache else None
 
+        if client.location is None:
             for geotool in self._geolocators:
 
                 try:
                     self.debug('retrieving geolocation data for %s <@%s>...', client.name, client.id)
-                    client.location = geotool.getLocation(client)
+                    client.location = geotool.getLocation(ip)
                     self.debug('retrieved geolocation data for %s <@%s>: %r', client.name, client.id, client.location)
                     break # stop iterating if we collect valid data
                 except GeolocalizationError, e:
@@ -99,15 +248,10 @@ class GeolocationPlugin(b3.plugin.Plugin):
                     self.error('client %s <@%s> geolocation terminated unexpectedtly when using %s service: %s',
                                client.name, client.id, geotool.__class__.__name__, e)
 
-            if client.location is not None:
-                self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
-            else:
-                self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_FAILURE', client=client))
+            if client.location is not None and self._cache is not None:
+                self._cache.put(ip, client.location)
 
-        # do not use hasattr or try except here: we'd better try to get geodata also when a previous attempt failed
-        # and we ended up with NoneType object in client.location (so we have an attribute but it's not useful).
-        # also make sure to launch geolocation only if we have a valid ip address.
-        if not getattr(event.client, 'location', None) and event.client.ip:
-            t = threading.Thread(target=_threaded_geolocate, args=(event.client,))
-            t.daemon = True  # won't prevent B3 from exiting
-            t.start()
\ No newline at end of file
+        if client.location is not None:
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        else:
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_FAILURE', client=client))
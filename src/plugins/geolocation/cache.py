@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from .location import Location
+
+
+class LocationCache(object):
+    """
+    IP address to Location cache with time to live and least recently used eviction.
+
+    The most recently used entries are kept in memory so that a lookup does not need any I/O. When a database path
+    is given, every entry is also stored in a sqlite database which survives B3 restarts: the database is trimmed to
+    maxSize entries by dropping the least recently used ones.
+    """
+
+    _trimEvery = 100
+
+    def __init__(self, path=None, ttl=604800, memorySize=1000, maxSize=50000, logger=None):
+        """
+        Object constructor.
+        :param path: The sqlite database file path or None to keep the cache in memory only
+        :param ttl: The number of seconds a location is valid for
+        :param memorySize: The maximum number of entries kept in memory
+        :param maxSize: The maximum number of entries kept in the database
+        :param logger: The owning plugin, used for logging
+        """
+        self._ttl = max(1, ttl)
+        self._memorySize = max(1, memorySize)
+        self._maxSize = max(self._memorySize, maxSize)
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # ip -> (expires, Location), least recently used first
+        self._writes = 0
+        self._db = None
+        if path:
+            self._open(path)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def get(self, ip):
+        """
+        Return the cached location of the given ip address.
+        :param ip: The ip address string
+        :return: A Location object or None if the ip address is not cached or its location expired
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.pop(ip, None)
+            if entry is not None:
+                if entry[0] > now:
+                    # re-insert to mark it as the most recently used
+                    self._memory[ip] = entry
+                    return entry[1]
+                self._execute('DELETE FROM geolocation WHERE ip = ?', (ip,))
+                return None
+
+            row = self._fetchone('SELECT location, expires FROM geolocation WHERE ip = ?', (ip,))
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._execute('DELETE FROM geolocation WHERE ip = ?', (ip,))
+                return None
+            location = self._decode(row[0])
+            if location is None:
+                return None
+            self._execute('UPDATE geolocation SET accessed = ? WHERE ip = ?', (int(now), ip))
+            self._remember(ip, row[1], location)
+            return location
+
+    def put(self, ip, location):
+        """
+        Store the location of the given ip address.
+        :param ip: The ip address string
+        :param location: The Location object
+        """
+        now = time.time()
+        expires = int(now + self._ttl)
+        with self._lock:
+            self._remember(ip, expires, location)
+            self._execute('INSERT OR REPLACE INTO geolocation (ip, location, expires, accessed) VALUES (?, ?, ?, ?)',
+                          (ip, json.dumps(location.__dict__), expires, int(now)))
+            self._writes += 1
+            if self._writes % self._trimEvery == 0:
+                self._trim(now)
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #   OTHER METHODS                                                                                                  #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def _open(self, path):
+        """
+        Open the database, drop the expired entries and load the most recently used ones in memory.
+        """
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS geolocation (ip TEXT PRIMARY KEY, location TEXT NOT NULL, '
+                             'expires INTEGER NOT NULL, accessed INTEGER NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS geolocation_accessed ON geolocation (accessed)')
+            self._db.commit()
+        except sqlite3.Error, e:
+            self._warning('could not open geolocation cache database %s: %s' % (path, e))
+            self._db = None
+            return
+
+        now = time.time()
+        self._trim(now)
+        rows = self._fetchall('SELECT ip, location, expires FROM geolocation ORDER BY accessed DESC LIMIT ?',
+                              (self._memorySize,))
+        for ip, data, expires in reversed(rows):
+            location = self._decode(data)
+            if location is not None:
+                self._memory[ip] = (expires, location)
+
+    def _remember(self, ip, expires, location):
+        """
+        Add an entry to the in-memory cache, evicting the least recently used entries if needed.
+        """
+        self._memory.pop(ip, None)
+        self._memory[ip] = (expires, location)
+        while len(self._memory) > self._memorySize:
+            self._memory.popitem(last=False)
+
+    def _trim(self, now):
+        """
+        Remove the expired entries and the least recently used ones exceeding the database size limit.
+        """
+        if self._db is None:
+            return
+        # memory hits do not touch the database: mark the entries held in memory as recently used before trimming
+        try:
+            self._db.executemany('UPDATE geolocation SET accessed = ? WHERE ip = ?', [(int(now), ip) for ip in self._memory])
+            self._db.commit()
+        except sqlite3.Error, e:
+            self._warning('geolocation cache query failed: %s' % e)
+        self._execute('DELETE FROM geolocation WHERE expires <= ?', (int(now),))
+        row = self._fetchone('SELECT COUNT(*) FROM geolocation')
+        if row is not None and row[0] > self._maxSize:
+            self._execute('DELETE FROM geolocation WHERE ip IN (SELECT ip FROM geolocation ORDER BY accessed LIMIT ?)',
+                          (row[0] - self._maxSize,))
+
+    def _decode(self, data):
+        try:
+            return Location(**dict((str(k), v) for k, v in json.loads(data).iteritems()))
+        except (ValueError, TypeError), e:
+            self._warning('ignoring invalid geolocation cache entry %r: %s' % (data, e))
+            return None
+
+    def _execute(self, query, args=()):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(query, args)
+            self._db.commit()
+        except sqlite3.Error, e:
+            self._warning('geolocation cache query failed: %s' % e)
+
+    def _fetchone(self, query, args=()):
+        rows = self._fetchall(query, args)
+        return rows[0] if rows else None
+
+    def _fetchall(self, query, args=()):
+        if self._db is None:
+            return []
+        try:
+            return self._db.execute(query, args).fetchall()
+        except sqlite3.Error, e:
+            self._warning('geolocation cache query failed: %s' % e)
+            return []
+
+    def _warning(self, message):
+        if self._logger:
+            self._logger.warning(message)
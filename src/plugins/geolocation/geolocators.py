@@ -38,6 +38,9 @@ class Geolocator(object):
 
     _timeout = 5
 
+    # whether the geolocator resolves addresses locally (fast enough to be used from within an event handler)
+    local = False
+
     def __init__(self, *args, **kwargs):
         """
         Object constructor.
@@ -156,6 +159,8 @@ class MaxMindGeolocator(Geolocator):
     _path = None
     _geoip = None
 
+    local = True
+
     def __init__(self, *args, **kwargs):
         """
         Object constructor.
@@ -170,7 +175,11 @@ class MaxMindGeolocator(Geolocator):
             if not os.path.isfile('/usr/local/share/GeoIP/GeoIP.dat'):
                 raise IOError('no MaxMind GeoIP.dat database available: put the database file in %s' % self._path)
             self._path = '/usr/local/share/GeoIP/GeoIP.dat'
-        self.geoip = GeoIP.open(self._path, GeoIP.GEOIP_STANDARD)
+        try:
+            # memory mapped database: lookups need neither I/O nor locking
+            self.geoip = GeoIP.open(self._path, GeoIP.GEOIP_MMAP_CACHE)
+        except EnvironmentError:
+            self.geoip = GeoIP.open(self._path, GeoIP.GEOIP_MEMORY_CACHE)
 
     def getLocation(self, data):
         """
@@ -19,8 +19,10 @@
 # http://www.maxmind.com/app/python
 # http://www.maxmind.com/download/geoip/api/pureperl
 
+import mmap
 import re
 import struct
+import threading
 
 def nreverse(sequence):
     """nreverse in Common Lisp. :)"""
@@ -30,6 +32,8 @@ def nreverse(sequence):
 class GeoIP(object):
 
     fh = None
+    buf = None
+    lock = None
     record_length = None
     databaseSegments = None
 
@@ -102,33 +106,76 @@ class GeoIP(object):
 
     __RE_IP_DOTTED_FORM = re.compile("^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
 
-    GEOIP_STANDARD = 0 # TODO
+    # same values as the MaxMind C API flags
+    GEOIP_STANDARD = 0      # seek and read the database file for every lookup
+    GEOIP_MEMORY_CACHE = 1  # load the whole database in memory
+    GEOIP_MMAP_CACHE = 8    # memory map the database file
+
+    # a record is a 3 bytes little endian number: read as a short and a byte
+    __RECORD = struct.Struct('<HB')
 
     @staticmethod
     def addr_to_num(ip_address):
         """Convert IP-address to number."""
-        # a = [int(s) for s in re.split('\.', ip_address)]
-        a = map(int, re.split('\.', ip_address))
-        return a[0] * 16777216L + a[1] * 65536L + a[2] * 256L + a[3]
+        a, b, c, d = ip_address.split('.')
+        return (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
 
     @staticmethod
     def open(db_file, flags):
         """Create a new GeoIP object."""
         gi = GeoIP()
         gi.db_file = db_file
-        gi.flags = flags # TODO
-        gi.fh = open(db_file, 'rb')
+        gi.flags = flags
+        if flags & GeoIP.GEOIP_MMAP_CACHE:
+            with open(db_file, 'rb') as fh:
+                gi.buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        elif flags & GeoIP.GEOIP_MEMORY_CACHE:
+            with open(db_file, 'rb') as fh:
+                gi.buf = fh.read()
+        else:
+            gi.fh = open(db_file, 'rb')
+            gi.lock = threading.Lock()  # lookups share the file offset
         gi.databaseType = GeoIP.__GEOIP_COUNTRY_EDITION # TODO
         gi.record_length = GeoIP.__STANDARD_RECORD_LENGTH # TODO
         gi.databaseSegments = GeoIP.__GEOIP_COUNTRY_BEGIN # TODO
         return gi
 
+    def close(self):
+        """Release the database file."""
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.buf = None
+
     @staticmethod
     def new(db_file, flags):
         """Create a new GeoIP object."""
         return GeoIP.open(db_file, flags)
 
     def __seek_country(self, ipnum):
+        """Seek GeoIP data file to find country id."""
+        if self.buf is not None:
+            return self.__walk_buffer(ipnum)
+        with self.lock:
+            return self.__seek_file(ipnum)
+
+    def __walk_buffer(self, ipnum):
+        """Walk the in-memory (or memory mapped) GeoIP data to find country id: no lock and no copy needed."""
+        buf = self.buf
+        unpack_from = self.__RECORD.unpack_from
+        databaseSegments = self.databaseSegments
+        offset = 0
+        for depth in xrange(31, -1, -1):
+            # each node is a pair of records: the left one for a 0 bit, the right one for a 1 bit
+            lo, hi = unpack_from(buf, offset * 6 + 3 if (ipnum >> depth) & 1 else offset * 6)
+            offset = lo | (hi << 16)
+            if offset >= databaseSegments:
+                return offset
+        raise Exception('error traversing db for ipnum = %d - perhaps db is corrupt?' % ipnum) # TODO
+
+    def __seek_file(self, ipnum):
         """Seek GeoIP data file to find country id."""
         fh = self.fh
         record_length = self.record_length
@@ -157,6 +204,10 @@ class GeoIP(object):
         else:
             return 0
 
+    def ids_by_addrs(self, ip_addresses):
+        """Find country ids of a list of IP-addresses."""
+        return [self.id_by_addr(x) for x in ip_addresses]
+
     @staticmethod
     def id_to_country_code(v):
         """Convert country id to country code."""
@@ -176,6 +227,10 @@ class GeoIP(object):
         """Find country code by IP-address."""
         return GeoIP.id_to_country_code(self.id_by_addr(v))
 
+    def country_codes_by_addrs(self, v):
+        """Find country codes of a list of IP-addresses."""
+        return [GeoIP.id_to_country_code(x) for x in self.ids_by_addrs(v)]
+
     def country_code3_by_addr(self, v):
         """Find country code3 by IP-address."""
         return GeoIP.id_to_country_code3(self.id_by_addr(v))
@@ -25,18 +25,19 @@
 # netblocker module provided by siebenmann: https://github.com/siebenmann/python-netblock
 
 
-__version__ = '1.0.2beta'
+__version__ = '1.1.0beta'
 __author__ = 'xlr8or'
 
 import b3
 import b3.events
 import b3.plugin
-import b3.plugins.netblocker.netblock as netblock
+from b3.plugins.netblocker.netblock import netblock
 
 class NetblockerPlugin(b3.plugin.Plugin):
 
     _adminPlugin = None
-    _blocks = []
+    _blocks = None
+    _blocks6 = None
     _maxLevel = 1
 
     ####################################################################################################################
@@ -65,8 +66,11 @@ class NetblockerPlugin(b3.plugin.Plugin):
         """
         Load plugin configuration
         """
-        self._blocks = self.getSetting('settings', 'netblock', b3.LIST, [])
+        blocks = self.getSetting('settings', 'netblock', b3.LIST, [])
+        files = self.getSetting('settings', 'netblock_file', b3.LIST, [])
         self._maxLevel = self.getSetting('settings', 'maxlevel', b3.LEVEL, self._maxLevel)
+        self._blocks, self._blocks6 = self.buildRanges(blocks, files)
+        self.debug('loaded %s IPv4 and %s IPv6 blocked ranges', len(self._blocks._l), len(self._blocks6._l))
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -84,15 +88,76 @@ class NetblockerPlugin(b3.plugin.Plugin):
         # check the level of the connecting client before applying the filters
         if client.maxLevel > self._maxLevel:
             self.debug('%s is a higher level user, and allowed to connect', client.name)
-        else:
-            # transform ip address
-            ip = netblock.convert(client.ip)
-            # cycle through our blocks
-            for block in self._blocks:
-                # convert each block
-                b = netblock.convert(block)
-                # check if clients ip is in the disallowed range
-                if b[0] <= ip[0] <= b[1]:
-                    # client not allowed to connect
-                    self.debug('client refused: %s (%s)', client.ip, client.name)
-                    client.kick("Netblocker: Client %s refused!" % client.name)
\ No newline at end of file
+        elif self.isBlocked(client.ip):
+            # client not allowed to connect
+            self.debug('client refused: %s (%s)', client.ip, client.name)
+            client.kick("Netblocker: Client %s refused!" % client.name)
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #    OTHER METHODS                                                                                                 #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def buildRanges(self, blocks, files):
+        """
+        Merge the given blocks and the content of the given files into one set of IPv4 and one set of IPv6 ranges.
+        :param blocks: list of ip addresses, ip ranges and CIDR netblocks
+        :param files: list of files containing an ip address, ip range or CIDR netblock per line
+        :return: tuple (IPRanges, IP6Ranges)
+        """
+        ranges4 = []
+        ranges6 = []
+        for block in blocks:
+            self._parseBlock(block, 'netblock setting', ranges4, ranges6)
+
+        for path in files:
+            if not path.strip():
+                continue
+            path = b3.getAbsolutePath(path.strip())
+            try:
+                with open(path) as f:
+                    for num, line in enumerate(f, 1):
+                        # everything after a '#' is a comment
+                        self._parseBlock(line.split('#', 1)[0], '%s line %s' % (path, num), ranges4, ranges6)
+            except IOError, e:
+                self.error('could not read netblock file %s: %s', path, e)
+
+        # sorting and merging everything at once is much faster than adding the ranges one by one
+        blocks4 = netblock.IPRanges()
+        blocks4.addlist(ranges4)
+        blocks6 = netblock.IP6Ranges()
+        blocks6.addlist(ranges6)
+        return blocks4, blocks6
+
+    def _parseBlock(self, block, source, ranges4, ranges6):
+        """
+        Convert a block string into a (low, high) range appended to the list matching its address family.
+        """
+        block = block.strip()
+        if not block:
+            return
+        try:
+            if netblock.isip6(block):
+                ranges6.append(netblock.convert6(block, 0))
+            else:
+                ranges4.append(netblock.convert(block, 0))
+        except netblock.NBError, e:
+            self.warning('ignoring invalid netblock %r (%s): %s', block, source, e)
+
+    def isBlocked(self, ip):
+        """
+        Tell whether the given ip address is in one of the blocked ranges.
+        :param ip: the IPv4 or IPv6 address to check
+        """
+        try:
+            if netblock.isip6(ip):
+                ip6 = netblock.strtoip6(ip)
+                ip4 = netblock.ip6toip4(ip6)
+                if ip4 is not None:
+                    return ip4 in self._blocks
+                return ip6 in self._blocks6
+            return netblock.strtoip(ip) in self._blocks
+        except netblock.NBError:
+            self.debug('could not check invalid ip address: %r', ip)
+            return False
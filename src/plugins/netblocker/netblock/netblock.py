@@ -128,6 +128,116 @@ def convert(s, strict = 1):
 	else:
 		return convip(s)
 
+# IPv6 addresses are 128-bit numbers. They get their own set of
+# conversion functions and their own IP6Ranges class, since IPv4 and
+# IPv6 addresses cannot be mixed in a single set of ranges.
+B128M = (1L<<128) - 1
+HEXDIGITS = '0123456789abcdefABCDEF'
+
+def isip6(s):
+	"""Return true if the string s is (meant to be) in IPv6 notation."""
+	return ':' in s
+
+def lenmask6(len):
+	"""Return the mask for a given IPv6 network length."""
+	return B128M ^ ((1L<<(128-len)) - 1)
+
+def cidrrange6(addr, length):
+	"""Given an IPv6 address and a network size, return the low and
+	high addresses in it."""
+	m = lenmask6(length)
+	l = addr&m
+	h = l + (B128M ^ m)
+	return (l, h)
+
+def hexgroups(s):
+	"""Convert a string of colon separated hex groups to a list of
+	16-bit numbers."""
+	if not s:
+		return []
+	res = []
+	for g in s.split(':'):
+		if not (1 <= len(g) <= 4) or g.strip(HEXDIGITS):
+			raise NBError("invalid IPv6 group")
+		res.append(int(g, 16))
+	return res
+
+def strtoip6(ipstr):
+	"""Convert an IPv6 address in string form to numeric form (an
+	unsigned 128-bit integer). The '::' shorthand and a trailing
+	IPv4 address (eg '::ffff:127.0.0.1') are accepted."""
+	tail = []
+	if '.' in ipstr:
+		pos = ipstr.rfind(':')
+		if pos < 0:
+			raise NBError("invalid IPv6 address")
+		ip = strtoip(ipstr[pos+1:])
+		tail = [ip >> 16, ip & 0xffff]
+		ipstr = ipstr[:pos]
+		# put back the second colon of a '::' we cut in half.
+		if ipstr.endswith(':'):
+			ipstr = ipstr + ':'
+	halves = ipstr.split('::')
+	if len(halves) > 2:
+		raise NBError("invalid IPv6 address")
+	if len(halves) == 2:
+		left = hexgroups(halves[0])
+		right = hexgroups(halves[1]) + tail
+		if len(left) + len(right) > 7:
+			raise NBError("invalid number of IPv6 groups")
+		groups = left + [0] * (8 - len(left) - len(right)) + right
+	else:
+		groups = hexgroups(ipstr) + tail
+		if len(groups) != 8:
+			raise NBError("invalid number of IPv6 groups")
+	res = 0L
+	for g in groups:
+		res = (res << 16) | g
+	return res
+def convcidr6(cstr, strict = 1):
+	"""Returns the start and end IPs of an IPv6 CIDR from a string.
+	strict is whether the CIDR must be a proper one."""
+	pos = cstr.find('/')
+	ip = strtoip6(cstr[:pos])
+	try:
+		size = int(cstr[pos+1:])
+	except ValueError:
+		raise NBError("invalid CIDR size")
+	if size < 0 or size > 128:
+		raise NBError("CIDR size not in 0 to 128")
+	res = cidrrange6(ip, size)
+	if strict and res[0] != ip:
+		raise BadCIDRError("CIDR start IP is not properly aligned: "+cstr)
+	return res
+def convrange6(s):
+	"""Returns the start and end IPs from an IPv6 string range."""
+	pos = s.find('-')
+	low = strtoip6(s[:pos])
+	high = strtoip6(s[pos+1:])
+	if low > high:
+		raise NBError("IP range has start larger than end.")
+	return (low, high)
+
+def convert6(s, strict = 1):
+	"""Return a (low,high) IPv6 number tuple for s, regardless of
+	whether s is a CIDR, an IPv6 address, or a range."""
+	if '/' in s:
+		return convcidr6(s, strict)
+	elif '-' in s:
+		return convrange6(s)
+	else:
+		res = strtoip6(s)
+		return (res, res)
+
+# An IPv4-mapped IPv6 address (::ffff:0:0/96) is how a dual stack
+# socket reports an IPv4 client.
+def ip6toip4(ip):
+	"""Return the IPv4 address number mapped in the IPv6 address
+	number ip, or None if it is not an IPv4-mapped address."""
+	if ip >> 32 == 0xffff:
+		return ip & B32M
+	return None
+
 
 # These functions go the other way.
 def octet(ip, n):
@@ -140,6 +250,36 @@ def ipstr(ip):
 	o1, o2, o3, o4 = octet(ip,0), octet(ip,1), octet(ip,2), octet(ip,3)
 	return '%d.%d.%d.%d' % (o1, o2, o3, o4)
 
+def ipstr6(ip):
+	"""Convert an IPv6 address in numeric form to its canonical
+	(RFC 5952) string form."""
+	groups = [(ip >> (16 * (7-i))) & 0xffff for i in range(8)]
+	# find the longest run of at least two zero groups; it becomes '::'.
+	best, bestlen = -1, 1
+	i = 0
+	while i < 8:
+		if groups[i]:
+			i += 1
+			continue
+		j = i
+		while j < 8 and not groups[j]:
+			j += 1
+		if j - i > bestlen:
+			best, bestlen = i, j - i
+		i = j
+	parts = ['%x' % g for g in groups]
+	if best < 0:
+		return ':'.join(parts)
+	return ':'.join(parts[:best]) + '::' + ':'.join(parts[best+bestlen:])
+
+def cidrtostr6(ip, len):
+	"""Convert an IPv6 number and a length to CIDR string, or to a
+	simple IPv6 address string if len is 128."""
+	if len == 128:
+		return ipstr6(ip)
+	else:
+		return '%s/%d' % (ipstr6(ip), len)
+
 def cidrtostr(ip, len):
 	"""Convert an IP number and a length to CIDR string, or to a simple
 	IP address string if len is 32."""
@@ -150,16 +290,21 @@ def cidrtostr(ip, len):
 
 # This finds the largest CIDR length that can start with the IP address,
 # based on what the first bit set is.
-def fmaxlen(ip):
+def fmaxlen(ip, width = 32):
 	# Range excludes the high, so use 0,33 so we go 0 .. 32.
-	for i in range(0, 33):
+	for i in range(0, width+1):
 		if ip & (1L<<i):
-			return 32-i
+			return width-i
 	return 0
 # For internal use, we append the results to a list.
-def lhcidrs(lip, hip, lst):
+def lhcidrs(lip, hip, lst, width = 32):
 	"""Convert a range from lowip to highip to a list of CIDR
-	address/length values that are appended to lst."""
+	address/length values that are appended to lst. width is the
+	size of the addresses in bits (32 for IPv4, 128 for IPv6)."""
+	if width == 32:
+		crange = cidrrange
+	else:
+		crange = cidrrange6
 	while lip <= hip:
 		# algorithm:
 		# try successively smaller length blocks starting at lip
@@ -167,13 +312,13 @@ def lhcidrs(lip, hip, lst):
 		# the list, set lip to one plus its end, keep going.
 		# we must insure that the chosen mask has lip as its proper
 		# lower end, and doesn't go lower.
-		lb = fmaxlen(lip)
-		while lb <= 32:
-			(lt, ht) = cidrrange(lip, lb)
+		lb = fmaxlen(lip, width)
+		while lb <= width:
+			(lt, ht) = crange(lip, lb)
 			if lt == lip and ht <= hip:
 				break
 			lb = lb + 1
-		assert (0 <= lb <= 32) and (lt == lip and ht <= hip), \
+		assert (0 <= lb <= width) and (lt == lip and ht <= hip), \
 		       "failed to generate a valid, fitting CIDR"
 		lst.append((lip, lb))
 		lip = ht+1
@@ -258,3 +403,58 @@ class IPRanges(ranges.Ranges):
 		for irng in self._l:
 			lhcidrs(irng[0], irng[1], r)
 		return [cidrtostr(x[0], x[1]) for x in r]
+
+class IP6Ranges(ranges.Ranges):
+	"""Sets of IPv6 address ranges (or single IPv6 addresses, or both).
+
+	This is the IPv6 counterpart of IPRanges and has the same
+	interface. Addresses may be given as single addresses, CIDRs
+	or LOWIP-HIGHIP ranges; tcpwrappers style prefixes are not
+	supported."""
+	def __init__(self, ival = None):
+		"""Optional ival is the initial IPv6 address (range); it is
+		passed to .add()."""
+		ranges.Ranges.__init__(self)
+		if ival:
+			self.add(ival)
+
+	def _rel(self, val):
+		return ipstr6(val)
+	def __str__(self):
+		return "<IP6Ranges: %s>" % (" ".join(map(self._rrange, self._l)),)
+
+	def add(self, val):
+		"""Add any form of IPv6 address that we accept to this set
+		of IPv6 address ranges."""
+		(low, high) = convert6(val)
+		self.addrange(low, high)
+	def addoddcidr(self, val):
+		"""Add an improper 'odd' CIDR to this set of IPv6 address
+		ranges."""
+		(low, high) = convert6(val, 0)
+		self.addrange(low, high)
+
+	def remove(self, val):
+		"""Remove any form of IPv6 address that we accept from this
+		set of IPv6 address ranges."""
+		(low, high) = convert6(val)
+		self.delrange(low, high)
+	def removeoddcidr(self, val):
+		"""Remove an odd CIDR from this set of IPv6 address ranges."""
+		(low, high) = convert6(val, 0)
+		self.delrange(low, high)
+
+	def __contains__(self, val):
+		"""Our argument is an IPv6 address string or number."""
+		if isinstance(val, (int, long)):
+			return ranges.Ranges.__contains__(self, val)
+		else:
+			return ranges.Ranges.__contains__(self, strtoip6(val))
+
+	def tocidr(self):
+		"""Return a list of CIDR netblocks (as strings) that represent
+		this set of IPv6 address ranges."""
+		r = []
+		for irng in self._l:
+			lhcidrs(irng[0], irng[1], r, 128)
+		return [cidrtostr6(x[0], x[1]) for x in r]
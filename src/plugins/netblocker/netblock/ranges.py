@@ -149,10 +149,29 @@ class Ranges:
 			else:
 				r[0] = end+1
 
+	# Adding ranges one at a time shifts the list on every insert,
+	# which is quadratic for large lists (eg a country's worth of
+	# netblocks). Instead we sort everything once and merge in a
+	# single pass.
 	def addlist(self, l):
 		"""Add a list of [start,end] ranges to the set."""
+		new = []
 		for s,e in l:
-			self.addrange(s, e)
+			self._good(s, e)
+			new.append([s, e])
+		if not new:
+			return
+		new.extend(self._l)
+		new.sort()
+		res = [new[0]]
+		for r in new[1:]:
+			ro = res[-1]
+			# adjacent or overlapping entries are merged.
+			if r[0]-1 <= ro[1]:
+				ro[1] = max(r[1], ro[1])
+			else:
+				res.append(r)
+		self._l = res
 	def dellist(self, l):
 		"""Remove a list of [start,end] ranges from the set."""
 		for s,e in l:
@@ -161,8 +180,7 @@ class Ranges:
 	# NOTE: these use internal implementation details. You lose if
 	# you pass bogus objects to them.
 	def addRanges(self, rng):
-		for s,e in rng._l:
-			self.addrange(s, e)
+		self.addlist(rng._l)
 	def delRanges(self, rng):
 		for s,e in rng._l:
 			self.delrange(s, e)
@@ -202,8 +220,7 @@ class Ranges:
 		return n
 	def __add__(self, other):
 		n = self.copy()
-		for s,e in other._l:
-			n.addrange(s,e)
+		n.addlist(other._l)
 		return n
 	def __sub__(self, other):
 		n = self.copy()
@@ -116,6 +116,63 @@ class basicTests(unittest.TestCase):
 		n.removeoddcidr('127.0.0.1/24')
 		self.assertEqual(str(n), '<IPRanges: 127.0.1.0-127.0.1.255>')
 
+class ipv6Tests(unittest.TestCase):
+	knownIP6Strs = (
+		('::1', "<IP6Ranges: ::1>"),
+		('2001:db8::/32', "<IP6Ranges: 2001:db8::-2001:db8:ffff:ffff:ffff:ffff:ffff:ffff>"),
+		('2001:DB8:0:0:1:0:0:1', "<IP6Ranges: 2001:db8::1:0:0:1>"),
+		('2001:db8::1-2001:db8::ff', "<IP6Ranges: 2001:db8::1-2001:db8::ff>"),
+		('::ffff:127.0.0.1', "<IP6Ranges: ::ffff:7f00:1>"),
+		('::/0', "<IP6Ranges: ::-ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff>"),
+		)
+	def testStrResults(self):
+		"Test the result of str() of IP6Ranges on known values."
+		for i, res in self.knownIP6Strs:
+			r = netblock.IP6Ranges(i)
+			self.assertEqual(str(r), res)
+			r.remove(i)
+			self.assertEqual(r.len(), 0)
+
+	def testInOperator(self):
+		"""Test the 'in' operator for IP6Ranges."""
+		r = netblock.IP6Ranges('2001:db8::/32')
+		self.assertEqual('2001:db8:1::1' in r, 1)
+		self.assertEqual('2001:db9::' in r, 0)
+		self.assertEqual(netblock.strtoip6('2001:db8::') in r, 1)
+
+	knownCIDRValues = (
+		('2001:db8::/32', ['2001:db8::/32']),
+		('::-::3', ['::/126']),
+		('2001:db8::1-2001:db8::4', ['2001:db8::1', '2001:db8::2/127', '2001:db8::4']),
+		)
+	def testCIDROutput(self):
+		"Test IP6Ranges.tocidr for correct operation on basic input."
+		for ival, res in self.knownCIDRValues:
+			self.assertEqual(netblock.IP6Ranges(ival).tocidr(), res)
+
+	def testIp6toip4(self):
+		"Test the IPv4-mapped address conversion."
+		self.assertEqual(netblock.ip6toip4(netblock.strtoip6('::ffff:10.0.0.1')), netblock.strtoip('10.0.0.1'))
+		self.assertEqual(netblock.ip6toip4(netblock.strtoip6('2001:db8::1')), None)
+
+	knownBadInitArgs = (
+		"1::2::3",
+		"1:2:3:4:5:6:7:8:9",
+		"1:2:3:4:5:6:7",
+		"1:2:3:4:5:6:7::8",
+		"12345::",
+		"0x1::",
+		"::g",
+		"::1.2.3",
+		"2001:db8::1/64",
+		"2001:db8::/129",
+		"2001:db8::ff-2001:db8::1",
+		)
+	def testKnownInitFailures(self):
+		"Test that IP6Ranges fails to initialize in known situations."
+		for a in self.knownBadInitArgs:
+			self.assertRaises(netblock.NBError, netblock.IP6Ranges, a)
+
 class failureTests(unittest.TestCase):
 	knownBadInitArgs = (
 		# Runt and perverse IP addresses.
@@ -1,4 +1,5 @@
 #
+import random
 import unittest
 
 from b3.plugins.netblocker.netblock import ranges
@@ -68,6 +69,32 @@ class basicTests(unittest.TestCase):
 			r.addlist(elist)
 			self.assertEqual(r._l, rval)
 
+	def testAddlistMatchesAddrange(self):
+		"Test that the bulk .addlist() merge gives the same list as adding the ranges one by one."
+		rnd = random.Random(42)
+		for n in (1, 10, 1000):
+			elist = []
+			for i in xrange(n):
+				s = rnd.randint(0, 5000)
+				elist.append((s, s + rnd.randint(0, 20)))
+			r1 = ranges.Ranges()
+			r1.addlist(elist)
+			r2 = ranges.Ranges()
+			for s, e in elist:
+				r2.addrange(s, e)
+			self.assertEqual(r1._l, r2._l)
+			# and on top of an existing set
+			r1.addlist([(6000, 6010), (2, 3)])
+			r2.addrange(6000, 6010)
+			r2.addrange(2, 3)
+			self.assertEqual(r1._l, r2._l)
+
+	def testAddlistBadRange(self):
+		"Test that .addlist() rejects a bad range without changing the set."
+		r = ranges.Ranges(1, 10)
+		self.assertRaises(ranges.BadRange, r.addlist, [(20, 30), (15, 12)])
+		self.assertEqual(r._l, [[1, 10]])
+
 	# This will fail if the iteration support is broken.
 	def testInOperator(self):
 		"""Test the 'in' operator of Ranges."""
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 __author__  = 'Fraser Molyneux'
-__version__ = '1.0'
+__version__ = '1.3'
 
 import b3
 import b3.clients
@@ -12,7 +12,7 @@ import requests
 import json
 import os
 import tempfile
-from datetime import datetime, timedelta
+from datetime import datetime
 from requests.adapters import HTTPAdapter
 try:
     from urllib3.util import Retry
@@ -20,6 +20,13 @@ except ImportError:
     # Older environments may vendor urllib3 under requests
     from requests.packages.urllib3.util import Retry
 
+from .auth import TokenManager
+from .shipper import EventShipper
+from .shipper import BACKPRESSURE_POLICIES
+from .shipper import BACKPRESSURE_SPOOL
+from .spool import SegmentedSpool
+from .spool import SpoolDrainer
+
 
 class PortalPlugin(b3.plugin.Plugin):
 
@@ -36,9 +43,21 @@ class PortalPlugin(b3.plugin.Plugin):
     _pemFilePath = ""
     _spoolPath = ""
     _session = None
-    _accessToken = None
-    _accessTokenExpiryUtc = None
+    _tokenManager = None
+    _tokenCachePath = ""
+    _tokenRefreshAhead = 300
     _spool = None
+    _spoolDrainer = None
+    _spoolSegmentSize = 1048576
+    _spoolDrainRate = 10.0
+    _spoolRetryInterval = 30.0
+    _shipper = None
+    _queueSize = 1000
+    _batchSize = 25
+    _flushInterval = 1.0
+    _workers = 1
+    _backpressure = BACKPRESSURE_SPOOL
+    _bulkPath = ""
 
 ## --- LOADCONFIG
 
@@ -55,18 +74,35 @@ class PortalPlugin(b3.plugin.Plugin):
         self._spoolPath = self.getSetting('settings', 'spoolPath', b3.STR, self._spoolPath)
         if not self._spoolPath:
             self.error('spoolPath must be configured for portal plugin; offline queue will be disabled')
+        self._spoolSegmentSize = self.getSetting('settings', 'spoolSegmentSize', b3.INT, self._spoolSegmentSize, lambda x: max(4096, x))
+        self._spoolDrainRate = self.getSetting('settings', 'spoolDrainRate', b3.FLOAT, self._spoolDrainRate, lambda x: max(0.1, x))
+        self._spoolRetryInterval = self.getSetting('settings', 'spoolRetryInterval', b3.FLOAT, self._spoolRetryInterval, lambda x: max(1.0, x))
+
+        self._tokenCachePath = self.getSetting('settings', 'tokenCachePath', b3.STR, self._tokenCachePath)
+        if not self._tokenCachePath and self._spoolPath:
+            self._tokenCachePath = self._spoolPath + '.token'
+        self._tokenRefreshAhead = self.getSetting('settings', 'tokenRefreshAhead', b3.INT, self._tokenRefreshAhead, lambda x: max(0, x))
+
+        self._queueSize = self.getSetting('settings', 'queueSize', b3.INT, self._queueSize, lambda x: max(1, x))
+        self._batchSize = self.getSetting('settings', 'batchSize', b3.INT, self._batchSize, lambda x: max(1, x))
+        self._flushInterval = self.getSetting('settings', 'flushInterval', b3.FLOAT, self._flushInterval, lambda x: max(0.0, x))
+        self._workers = self.getSetting('settings', 'workers', b3.INT, self._workers, lambda x: max(1, x))
+        self._backpressure = self.getSetting('settings', 'backpressure', b3.STR, self._backpressure, self._validateBackpressure)
+        self._bulkPath = self.getSetting('settings', 'bulkPath', b3.STR, self._bulkPath)
 
         if not self._apimUrlBase or not self._tenantId or not self._clientId or not self._clientSecret:
             self.error('Portal plugin configuration is missing required settings; outbound calls will fail until fixed')
 
 ## --- PORTAL AUTH
-    def generateAccessToken(self):
-        if self._session is None:
-            self._setupSession()
-
-        if self._accessToken and self._accessTokenExpiryUtc and datetime.utcnow() < (self._accessTokenExpiryUtc - timedelta(seconds=60)):
-            return self._accessToken
+    def generateAccessToken(self, timeout=5):
+        """
+        Return a cached access token, waiting up to timeout seconds if a refresh is in flight.
+        """
+        if self._tokenManager is None:
+            return None
+        return self._tokenManager.getToken(timeout)
 
+    def _requestAccessToken(self):
         data = {
             'grant_type': "client_credentials",
             'scope': self._scope,
@@ -74,25 +110,14 @@ class PortalPlugin(b3.plugin.Plugin):
             'client_secret': self._clientSecret
         }
 
-        try:
-            response = self._session.post(
-                "https://login.microsoftonline.com/" + self._tenantId + "/oauth2/v2.0/token",
-                data=data,
-                verify=self._pemFilePath,
-                timeout=5
-            )
-            response.raise_for_status()
-            tokenData = response.json()
-            self._accessToken = tokenData.get('access_token')
-            expires_in = tokenData.get('expires_in', 0)
-            if self._accessToken and expires_in:
-                self._accessTokenExpiryUtc = datetime.utcnow() + timedelta(seconds=int(expires_in))
-            else:
-                self._accessTokenExpiryUtc = None
-            return self._accessToken
-        except Exception as e:
-            self.error('Failed to acquire access token: %s' % e)
-            return None
+        response = self._session.post(
+            "https://login.microsoftonline.com/" + self._tenantId + "/oauth2/v2.0/token",
+            data=data,
+            verify=self._pemFilePath,
+            timeout=5
+        )
+        response.raise_for_status()
+        return response.json()
 
 ## --- STARTUP
 
@@ -101,7 +126,16 @@ class PortalPlugin(b3.plugin.Plugin):
         Initialize the plugin.
         """
         self._setupSession()
-        self._loadSpool()
+        self._openSpool()
+
+        self._tokenManager = TokenManager(
+            self._requestAccessToken,
+            '|'.join((self._tenantId, self._clientId, self._scope)),
+            cachePath=self._tokenCachePath or None,
+            refreshAhead=self._tokenRefreshAhead,
+            logger=self
+        )
+        self._tokenManager.start()
 
         self.adminPlugin = self.console.getPlugin('admin')
         if not self.adminPlugin:
@@ -117,8 +151,19 @@ class PortalPlugin(b3.plugin.Plugin):
         self.registerEvent('EVT_CLIENT_CONNECT', self.onConnect)
         self.registerEvent('EVT_GAME_MAP_CHANGE', self.onMapChange)
 
+        self._shipper = EventShipper(
+            self._sendBatch,
+            self._spoolRecord,
+            queueSize=self._queueSize,
+            batchSize=self._batchSize,
+            flushInterval=self._flushInterval,
+            workers=self._workers,
+            backpressure=self._backpressure,
+            logger=self
+        )
+        self._shipper.start()
+
         url = self._apimUrlBase + '/OnServerConnected'
-        headers = self._defaultHeaders()
 
         eventData = {
             'eventGeneratedUtc': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
@@ -126,14 +171,45 @@ class PortalPlugin(b3.plugin.Plugin):
             'gameType': self._gameType
         }
 
-        self._postEvent(url, eventData, headers)
-        self._drainSpool()
+        self._queueEvent(url, eventData)
+
+        if self._spoolDrainer:
+            self._spoolDrainer.start()
+
+## --- SHUTDOWN
+
+    def onStop(self, event):
+        """
+        Handle EVT_STOP
+        """
+        self.onShutdown(event)
+
+    def onExit(self, event):
+        """
+        Handle EVT_EXIT
+        """
+        self.onShutdown(event)
+
+    def onShutdown(self, _):
+        """
+        Flush queued events; anything left undelivered is spooled for replay.
+        """
+        if self._shipper:
+            self.debug('Flushing %s queued portal events' % self._shipper.pending)
+            self._shipper.stop()
+            self._shipper = None
+        if self._spoolDrainer:
+            self._spoolDrainer.stop()
+            self._spoolDrainer = None
+        if self._spool:
+            self._spool.close()
+        if self._tokenManager:
+            self._tokenManager.stop()
 
 ## --- COMMANDS
 
     def cmd_like(self, data, client, _):
         url = self._apimUrlBase + '/OnMapVote'
-        headers = self._defaultHeaders()
 
         eventData = {
             'eventGeneratedUtc': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
@@ -143,13 +219,12 @@ class PortalPlugin(b3.plugin.Plugin):
             'mapName': self.console.game.mapName,
             'like': 'true'
         }
-        self._postEvent(url, eventData, headers)
+        self._queueEvent(url, eventData)
 
         client.message("Thanks for your positive feedback - we have stored this in the map popularity database!")
 
     def cmd_dislike(self, data, client, _):
         url = self._apimUrlBase + '/OnMapVote'
-        headers = self._defaultHeaders()
 
         eventData = {
             'eventGeneratedUtc': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
@@ -159,7 +234,7 @@ class PortalPlugin(b3.plugin.Plugin):
             'mapName': self.console.game.mapName,
             'like': 'false'
         }
-        self._postEvent(url, eventData, headers)
+        self._queueEvent(url, eventData)
 
         client.message("Thanks for your negative feedback - we have stored this in the map popularity database!")
 
@@ -170,7 +245,6 @@ class PortalPlugin(b3.plugin.Plugin):
         Handle EVT_CLIENT_SAY
         """
         url = self._apimUrlBase + '/OnChatMessage'
-        headers = self._defaultHeaders()
 
         eventData = {
             'eventGeneratedUtc': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
@@ -182,14 +256,13 @@ class PortalPlugin(b3.plugin.Plugin):
             'type': 'All'
         }
 
-        self._postEvent(url, eventData, headers)
+        self._queueEvent(url, eventData)
 
     def onTeamSay(self, event):
         """
         Handle EVT_CLIENT_TEAM_SAY
         """
         url = self._apimUrlBase + '/OnChatMessage'
-        headers = self._defaultHeaders()
 
         eventData = {
             'eventGeneratedUtc': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
@@ -201,14 +274,13 @@ class PortalPlugin(b3.plugin.Plugin):
             'type': 'Team'
         }
 
-        self._postEvent(url, eventData, headers)
+        self._queueEvent(url, eventData)
 
     def onConnect(self, event):
         """
         Handle EVT_CLIENT_CONNECT
         """
         url = self._apimUrlBase + '/OnPlayerConnected'
-        headers = self._defaultHeaders()
 
         eventData = {
             'eventGeneratedUtc': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
@@ -219,14 +291,13 @@ class PortalPlugin(b3.plugin.Plugin):
             'ipAddress': event.client.ip
         }
 
-        self._postEvent(url, eventData, headers)
+        self._queueEvent(url, eventData)
 
     def onMapChange(self, event):
         """
         Handle EVT_GAME_MAP_CHANGE
         """
         url = self._apimUrlBase + '/OnMapChange'
-        headers = self._defaultHeaders()
 
         console = self.console.game
 
@@ -242,7 +313,7 @@ class PortalPlugin(b3.plugin.Plugin):
             'mapName': str(mapName)
         }
 
-        self._postEvent(url, eventData, headers)
+        self._queueEvent(url, eventData)
 
 ## --- INTERNAL
 
@@ -262,6 +333,65 @@ class PortalPlugin(b3.plugin.Plugin):
         self._session.mount('https://', adapter)
         self._session.mount('http://', adapter)
 
+    def _queueEvent(self, url, payload):
+        record = {'url': url, 'payload': payload}
+        if self._shipper is None:
+            self._sendBatch([record])
+        else:
+            self._shipper.enqueue(record)
+
+    def _sendBatch(self, records):
+        headers = self._defaultHeaders()
+        if not headers.get('Authorization'):
+            for record in records:
+                self._spoolRecord(record)
+            return
+
+        if self._bulkPath:
+            if not self._postBulk(records, headers):
+                for record in records:
+                    self._spoolRecord(record)
+        else:
+            for record in records:
+                if not self._postEvent(record.get('url'), record.get('payload'), headers):
+                    self._spoolRecord(record)
+
+    def _deliverSpooled(self, records):
+        """
+        Replay spooled records in order; returns how many were delivered before the first failure.
+        """
+        headers = self._defaultHeaders()
+        if not headers.get('Authorization'):
+            return 0
+
+        if self._bulkPath:
+            return len(records) if self._postBulk(records, headers) else 0
+
+        delivered = 0
+        for record in records:
+            if not self._postEvent(record.get('url'), record.get('payload'), headers):
+                break
+            delivered += 1
+        return delivered
+
+    def _postBulk(self, records, headers):
+        url = self._apimUrlBase + self._bulkPath
+        bulkPayload = {
+            'events': [{
+                'eventType': record.get('url', '').rsplit('/', 1)[-1],
+                'payload': record.get('payload')
+            } for record in records]
+        }
+
+        try:
+            response = self._session.post(url, json=bulkPayload, headers=headers, verify=self._pemFilePath, timeout=5)
+            if response.ok:
+                return True
+            self.warning('Portal API returned %s for %s' % (response.status_code, url))
+        except Exception as e:
+            self.warning('Portal API bulk call failed: %s' % e)
+        return False
+
     def _postEvent(self, url, payload, headers):
         if headers is None:
             headers = self._defaultHeaders()
@@ -269,69 +399,50 @@ class PortalPlugin(b3.plugin.Plugin):
         if not headers.get('Authorization'):
             token = self.generateAccessToken()
             if not token:
-                self._enqueueSpool(url, payload)
-                return
+                return False
             headers['Authorization'] = 'Bearer ' + token
 
         try:
             response = self._session.post(url, json=payload, headers=headers, verify=self._pemFilePath, timeout=5)
-            if not response.ok:
-                self.warning('Portal API returned %s for %s' % (response.status_code, url))
-                self._enqueueSpool(url, payload)
+            if response.ok:
+                return True
+            self.warning('Portal API returned %s for %s' % (response.status_code, url))
         except Exception as e:
             self.warning('Portal API call failed: %s' % e)
-            self._enqueueSpool(url, payload)
+        return False
 
-    def _enqueueSpool(self, url, payload):
+    def _spoolRecord(self, record):
         if self._spool is None:
-            self._spool = []
-        record = {'url': url, 'payload': payload}
-        self._spool.append(record)
-        try:
-            with open(self._spoolPath, 'a') as f:
-                f.write(json.dumps(record) + "\n")
-        except Exception as e:
-            self.error('Failed to write spool file %s: %s' % (self._spoolPath, e))
-
-    def _loadSpool(self):
-        self._spool = []
-        if not os.path.isfile(self._spoolPath):
+            self.warning('Portal spool is not available; dropping event for %s' % record.get('url'))
             return
         try:
-            with open(self._spoolPath, 'r') as f:
-                for line in f:
-                    try:
-                        self._spool.append(json.loads(line))
-                    except ValueError:
-                        continue
+            self._spool.append(record)
         except Exception as e:
-            self.error('Failed to read spool file %s: %s' % (self._spoolPath, e))
+            self.error('Failed to write spool %s: %s' % (self._spoolPath, e))
 
-    def _drainSpool(self):
-        if not self._spool:
+    def _openSpool(self):
+        self._spool = None
+        if not self._spoolPath:
             return
-        remaining = []
-        headers = self._defaultHeaders()
-        for record in self._spool:
-            try:
-                response = self._session.post(
-                    record.get('url'),
-                    json=record.get('payload'),
-                    headers=headers,
-                    verify=self._pemFilePath,
-                    timeout=5
-                )
-                if not response.ok:
-                    remaining.append(record)
-            except Exception:
-                remaining.append(record)
-        self._spool = remaining
         try:
-            with open(self._spoolPath, 'w') as f:
-                for record in self._spool:
-                    f.write(json.dumps(record) + "\n")
+            self._spool = SegmentedSpool(self._spoolPath, segmentSize=self._spoolSegmentSize, logger=self)
         except Exception as e:
-            self.error('Failed to rewrite spool file %s: %s' % (self._spoolPath, e))
+            self.error('Failed to open spool %s: %s' % (self._spoolPath, e))
+            return
+
+        self._spoolDrainer = SpoolDrainer(
+            self._spool,
+            self._deliverSpooled,
+            batchSize=self._batchSize,
+            rate=self._spoolDrainRate,
+            retryInterval=self._spoolRetryInterval,
+            logger=self
+        )
+
+    def _validateBackpressure(self, value):
+        if value not in BACKPRESSURE_POLICIES:
+            raise ValueError('backpressure must be one of: %s' % ', '.join(BACKPRESSURE_POLICIES))
+        return value
 
     def _defaultHeaders(self):
         token = self.generateAccessToken()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+
+class TokenManager(object):
+    """
+    Caches an OAuth access token and refreshes it from a dedicated thread.
+
+    The token is refreshed refreshAhead seconds before it expires, but never before half of its
+    lifetime has elapsed, so callers normally get a cached token without any network round-trip.
+    Only the refresh thread talks to the token endpoint: concurrent callers that find no valid
+    token share the same refresh instead of issuing their own. The token and its expiry are
+    persisted to cachePath, readable by the owner only, so a restart can reuse it.
+    """
+
+    # tokens this close to expiry are never handed out
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, fetch, identity, cachePath=None, refreshAhead=300, retryInterval=30, logger=None):
+        """
+        :param fetch: callable returning the token endpoint response as a dict; raises on failure
+        :param identity: string identifying the credentials, a cached token for other credentials is ignored
+        :param cachePath: file the token is persisted to, or None to keep it in memory only
+        :param refreshAhead: seconds before expiry at which the token is refreshed
+        :param retryInterval: seconds to wait after a failed refresh
+        :param logger: the owning plugin, used for logging
+        """
+        self._fetch = fetch
+        self._identity = identity
+        self._cachePath = cachePath
+        self._refreshAhead = max(0, refreshAhead)
+        self._retryInterval = max(1, retryInterval)
+        self._logger = logger
+        self._token = None
+        self._expiresAt = 0
+        self._refreshAt = 0
+        self._condition = threading.Condition()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._loadCache()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='portal-token-refresh')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def getToken(self, timeout=0):
+        """
+        Return a valid access token, or None if there is none.
+        :param timeout: seconds to wait for a refresh when no valid token is cached; 0 never waits
+        """
+        with self._condition:
+            if self._isValid():
+                return self._token
+            self._wakeup.set()
+            if timeout > 0:
+                self._condition.wait(timeout)
+            return self._token if self._isValid() else None
+
+    def _isValid(self):
+        return self._token is not None and time.time() < self._expiresAt - self.EXPIRY_MARGIN
+
+    def _secondsUntilRefresh(self):
+        with self._condition:
+            if not self._isValid():
+                return 0
+            return self._refreshAt - time.time()
+
+    def _refreshTime(self, expiresAt):
+        # a refreshAhead longer than the token lifetime would otherwise fetch tokens in a tight loop
+        lifetime = expiresAt - time.time()
+        return expiresAt - min(self._refreshAhead, lifetime / 2.0)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            delay = self._secondsUntilRefresh()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+
+            self._wakeup.clear()
+            if not self._refresh():
+                self._stopping.wait(self._retryInterval)
+
+    def _refresh(self):
+        try:
+            tokenData = self._fetch()
+            token = tokenData.get('access_token')
+            expiresIn = int(tokenData.get('expires_in', 0))
+            if not token or not expiresIn:
+                raise ValueError('token response did not contain access_token and expires_in')
+        except Exception as e:
+            if self._logger:
+                self._logger.error('Failed to acquire access token: %s' % e)
+            with self._condition:
+                self._condition.notify_all()
+            return False
+
+        with self._condition:
+            self._token = token
+            self._expiresAt = time.time() + expiresIn
+            self._refreshAt = self._refreshTime(self._expiresAt)
+            self._condition.notify_all()
+
+        self._saveCache(token, self._expiresAt)
+        return True
+
+    def _loadCache(self):
+        if not self._cachePath or not os.path.isfile(self._cachePath):
+            return
+        try:
+            with open(self._cachePath, 'r') as f:
+                data = json.load(f)
+            if data.get('identity') != self._identity:
+                return
+            with self._condition:
+                self._token = data.get('accessToken')
+                self._expiresAt = float(data.get('expiresAt', 0))
+                self._refreshAt = self._refreshTime(self._expiresAt)
+        except Exception as e:
+            if self._logger:
+                self._logger.warning('Ignoring unreadable token cache %s: %s' % (self._cachePath, e))
+
+    def _saveCache(self, token, expiresAt):
+        if not self._cachePath:
+            return
+        # the token is a credential: only the owner may read it, and readers never see a partial file
+        tmpPath = self._cachePath + '.tmp'
+        try:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'identity': self._identity, 'accessToken': token, 'expiresAt': expiresAt}, f)
+            try:
+                os.rename(tmpPath, self._cachePath)
+            except OSError:
+                # windows does not rename over an existing file
+                os.remove(self._cachePath)
+                os.rename(tmpPath, self._cachePath)
+        except Exception as e:
+            if self._logger:
+                self._logger.warning('Failed to write token cache %s: %s' % (self._cachePath, e))
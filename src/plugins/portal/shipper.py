@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+BACKPRESSURE_SPOOL = 'spool'
+BACKPRESSURE_DROP_OLDEST = 'drop_oldest'
+BACKPRESSURE_DROP_NEWEST = 'drop_newest'
+BACKPRESSURE_BLOCK = 'block'
+
+BACKPRESSURE_POLICIES = (
+    BACKPRESSURE_SPOOL,
+    BACKPRESSURE_DROP_OLDEST,
+    BACKPRESSURE_DROP_NEWEST,
+    BACKPRESSURE_BLOCK,
+)
+
+
+class EventShipper(object):
+    """
+    Bounded in-memory queue drained by background worker threads.
+
+    Event handlers only call enqueue(); workers collect records into batches of up to
+    batchSize (or whatever arrived within flushInterval seconds) and hand them to the
+    send callable. Records that cannot be queued or delivered are handed to overflow.
+    """
+
+    def __init__(self, send, overflow, queueSize=1000, batchSize=25, flushInterval=1.0,
+                 workers=1, backpressure=BACKPRESSURE_SPOOL, blockTimeout=0.5, logger=None):
+        """
+        :param send: callable receiving a list of records, invoked from worker threads
+        :param overflow: callable receiving a single record that could not be shipped
+        :param queueSize: maximum number of records held in memory
+        :param batchSize: maximum number of records handed to send in one call
+        :param flushInterval: maximum seconds a partial batch waits for more records
+        :param workers: number of worker threads
+        :param backpressure: one of BACKPRESSURE_POLICIES, applied when the queue is full
+        :param blockTimeout: seconds the 'block' policy waits before falling back to overflow
+        :param logger: the owning plugin, used for logging
+        """
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError('unknown backpressure policy: %s' % backpressure)
+
+        self._send = send
+        self._overflow = overflow
+        self._queue = queue.Queue(max(1, queueSize))
+        self._batchSize = max(1, batchSize)
+        self._flushInterval = max(0.0, flushInterval)
+        self._workerCount = max(1, workers)
+        self._backpressure = backpressure
+        self._blockTimeout = blockTimeout
+        self._logger = logger
+        self._workers = []
+        self._stopping = threading.Event()
+        self._dropped = 0
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def start(self):
+        if self._workers:
+            return
+        self._stopping.clear()
+        for i in range(self._workerCount):
+            worker = threading.Thread(target=self._run, name='portal-shipper-%s' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=5.0):
+        """
+        Stop the workers, letting them flush what is queued for up to timeout seconds.
+        Anything still queued afterwards is handed to overflow.
+        """
+        self._stopping.set()
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.time()))
+        self._workers = []
+
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._safeOverflow(record)
+
+    def enqueue(self, record):
+        """
+        Queue a record for delivery without blocking the caller (except under the
+        'block' policy, which waits at most blockTimeout seconds).
+        """
+        if self._stopping.is_set():
+            self._safeOverflow(record)
+            return
+
+        if self._backpressure == BACKPRESSURE_BLOCK:
+            try:
+                self._queue.put(record, True, self._blockTimeout)
+            except queue.Full:
+                self._safeOverflow(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self._backpressure == BACKPRESSURE_DROP_NEWEST:
+            self._drop()
+        elif self._backpressure == BACKPRESSURE_DROP_OLDEST:
+            try:
+                self._queue.get_nowait()
+                self._drop()
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                self._drop()
+        else:
+            self._safeOverflow(record)
+
+    def _drop(self):
+        self._dropped += 1
+        if self._logger and self._dropped % 100 == 1:
+            self._logger.warning('Portal event queue is full; %s events dropped so far' % self._dropped)
+
+    def _safeOverflow(self, record):
+        try:
+            self._overflow(record)
+        except Exception as e:
+            if self._logger:
+                self._logger.error('Failed to hand over portal event: %s' % e)
+
+    def _nextBatch(self):
+        try:
+            first = self._queue.get(True, 0.5)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.time() + self._flushInterval
+        while len(batch) < self._batchSize:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0 or self._stopping.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(True, remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            if self._stopping.is_set() and self._queue.empty():
+                return
+
+            batch = self._nextBatch()
+            if not batch:
+                continue
+
+            try:
+                self._send(batch)
+            except Exception as e:
+                if self._logger:
+                    self._logger.error('Portal event batch delivery failed: %s' % e)
+                for record in batch:
+                    self._safeOverflow(record)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+
+class SegmentedSpool(object):
+    """
+    Append-only on-disk queue made of fixed-size segment files.
+
+    Records are written as JSON lines to '<path>.<sequence>' files; a new segment is started
+    once the current one reaches segmentSize bytes. Readers always start from the acknowledged
+    cursor persisted in '<path>.cursor', and segments are deleted once the cursor moves past
+    them, so neither memory usage nor acknowledgement cost grows with the size of the backlog.
+    """
+
+    SEQUENCE_DIGITS = 10
+
+    def __init__(self, path, segmentSize=1048576, logger=None):
+        """
+        :param path: base path of the spool; segment and cursor files are created next to it
+        :param segmentSize: size in bytes after which a new segment file is started
+        :param logger: the owning plugin, used for logging
+        """
+        self._path = path
+        self._directory = os.path.dirname(os.path.abspath(path))
+        self._prefix = os.path.basename(path) + '.'
+        self._cursorPath = path + '.cursor'
+        self._segmentSize = max(1, segmentSize)
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writeSeq = 0
+        self._writeOffset = 0
+        self._cursor = (0, 0)
+        self._segments = []
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        self._segments = self._scanSegments()
+        self._importLegacyFile()
+        self._cursor = self._loadCursor()
+
+        if self._segments:
+            self._writeSeq = self._segments[-1]
+            if os.path.isfile(self._segmentPath(self._writeSeq)):
+                self._writeOffset = os.path.getsize(self._segmentPath(self._writeSeq))
+        else:
+            self._writeSeq = 1
+            self._writeOffset = 0
+            self._segments.append(self._writeSeq)
+
+        if self._cursor[0] < self._segments[0]:
+            self._cursor = (self._segments[0], 0)
+
+        if self._writeOffset:
+            # never append behind a possibly torn line left by an earlier crash
+            self._roll()
+
+    @property
+    def pending(self):
+        """
+        Whether there are records written that have not been acknowledged yet.
+        """
+        with self._lock:
+            return self._cursor != (self._writeSeq, self._writeOffset)
+
+    @property
+    def segmentCount(self):
+        with self._lock:
+            return len(self._segments)
+
+    def append(self, record):
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        with self._lock:
+            if self._writeOffset >= self._segmentSize:
+                self._roll()
+            if self._writer is None:
+                self._writer = open(self._segmentPath(self._writeSeq), 'ab')
+            self._writer.write(line)
+            self._writer.flush()
+            self._writeOffset += len(line)
+
+    def read(self, maxRecords):
+        """
+        Read up to maxRecords records starting at the acknowledged cursor.
+        :return: list of (record, position) tuples; pass a position to ack() once delivered
+        """
+        results = []
+        with self._lock:
+            seq, offset = self._cursor
+            while len(results) < maxRecords:
+                path = self._segmentPath(seq)
+                lastSegment = seq >= self._writeSeq
+                end = self._writeOffset if lastSegment else None
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        f.seek(offset)
+                        while len(results) < maxRecords:
+                            if end is not None and offset >= end:
+                                break
+                            line = f.readline()
+                            if not line.endswith(b"\n"):
+                                # torn write from an earlier crash; only skip it once the segment is sealed
+                                if not lastSegment:
+                                    offset += len(line)
+                                break
+                            offset += len(line)
+                            try:
+                                record = json.loads(line.decode('utf-8'))
+                            except ValueError:
+                                continue
+                            results.append((record, (seq, offset)))
+                if lastSegment or len(results) >= maxRecords:
+                    break
+                # move on to the next sealed segment
+                nextSeqs = [s for s in self._segments if s > seq]
+                if not nextSeqs:
+                    break
+                seq, offset = nextSeqs[0], 0
+                if not results:
+                    # nothing readable was left in the previous segment, release it right away
+                    self._advance((seq, offset))
+        return results
+
+    def ack(self, position):
+        """
+        Mark everything up to position as delivered and delete fully consumed segments.
+        """
+        with self._lock:
+            self._advance(position)
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _advance(self, position):
+        if position <= self._cursor:
+            return
+        self._cursor = position
+        self._saveCursor()
+        while self._segments and self._segments[0] < position[0]:
+            seq = self._segments.pop(0)
+            try:
+                os.remove(self._segmentPath(seq))
+            except OSError as e:
+                if self._logger:
+                    self._logger.warning('Failed to delete spool segment %s: %s' % (self._segmentPath(seq), e))
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._writeSeq += 1
+        self._writeOffset = 0
+        self._segments.append(self._writeSeq)
+
+    def _segmentPath(self, seq):
+        return os.path.join(self._directory, self._prefix + str(seq).zfill(self.SEQUENCE_DIGITS))
+
+    def _scanSegments(self):
+        segments = []
+        for name in os.listdir(self._directory):
+            if not name.startswith(self._prefix):
+                continue
+            suffix = name[len(self._prefix):]
+            if len(suffix) == self.SEQUENCE_DIGITS and suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    def _importLegacyFile(self):
+        # earlier versions kept the whole spool in a single JSON lines file at the base path;
+        # adopt it as a sealed segment so it is replayed without being rewritten
+        if not os.path.isfile(self._path):
+            return
+        seq = (self._segments[-1] + 1) if self._segments else 1
+        os.rename(self._path, self._segmentPath(seq))
+        self._segments.append(seq)
+        # make sure new records never land in the adopted segment
+        self._segments.append(seq + 1)
+        if self._logger:
+            self._logger.info('Imported legacy spool file %s as segment %s' % (self._path, seq))
+
+    def _loadCursor(self):
+        if not os.path.isfile(self._cursorPath):
+            return (0, 0)
+        try:
+            with open(self._cursorPath, 'r') as f:
+                data = json.load(f)
+            return (int(data['segment']), int(data['offset']))
+        except Exception as e:
+            if self._logger:
+                self._logger.warning('Spool cursor %s is unreadable, replaying from the oldest segment: %s' % (self._cursorPath, e))
+            return (0, 0)
+
+    def _saveCursor(self):
+        try:
+            with open(self._cursorPath, 'w') as f:
+                json.dump({'segment': self._cursor[0], 'offset': self._cursor[1]}, f)
+        except Exception as e:
+            if self._logger:
+                self._logger.error('Failed to write spool cursor %s: %s' % (self._cursorPath, e))
+
+
+class SpoolDrainer(object):
+    """
+    Background thread replaying a SegmentedSpool at a bounded rate.
+
+    The deliver callable receives a list of records and returns how many of them, counted
+    from the front of the list, were delivered; only those are acknowledged. When nothing
+    could be delivered the drainer waits retryInterval seconds before trying again.
+    """
+
+    def __init__(self, spool, deliver, batchSize=25, rate=10.0, retryInterval=30.0, logger=None):
+        """
+        :param spool: the SegmentedSpool to replay
+        :param deliver: callable receiving a list of records, returning the number delivered
+        :param batchSize: maximum number of records read and delivered at once
+        :param rate: maximum number of records replayed per second
+        :param retryInterval: seconds to wait after a failed delivery or when the spool is empty
+        :param logger: the owning plugin, used for logging
+        """
+        self._spool = spool
+        self._deliver = deliver
+        self._batchSize = max(1, batchSize)
+        self._rate = max(0.1, rate)
+        self._retryInterval = max(0.0, retryInterval)
+        self._logger = logger
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._replayed = 0
+
+    @property
+    def replayed(self):
+        return self._replayed
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='portal-spool-drainer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _sleep(self, seconds):
+        self._wakeup.wait(seconds)
+        self._wakeup.clear()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not self._spool.pending:
+                self._sleep(self._retryInterval)
+                continue
+
+            batch = self._spool.read(self._batchSize)
+            if not batch:
+                self._sleep(self._retryInterval)
+                continue
+
+            started = time.time()
+            try:
+                delivered = self._deliver([record for record, _ in batch])
+            except Exception as e:
+                if self._logger:
+                    self._logger.error('Spool replay failed: %s' % e)
+                delivered = 0
+
+            if delivered:
+                self._spool.ack(batch[delivered - 1][1])
+                self._replayed += delivered
+
+            if delivered < len(batch):
+                # the portal is still unavailable: back off instead of hammering it
+                self._stopping.wait(self._retryInterval)
+                continue
+
+            # pace the replay so a large backlog does not compete with live traffic
+            delay = (delivered / self._rate) - (time.time() - started)
+            if delay > 0:
+                self._stopping.wait(delay)
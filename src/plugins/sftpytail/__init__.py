@@ -43,7 +43,7 @@ except ImportError, ee:
                  "paramiko from http://www.lag.net/paramiko/")
     raise ee
 
-__version__ = '1.3'
+__version__ = '1.4'
 __author__ = 'Courgette'
 
 
@@ -52,6 +52,10 @@ class SftpytailPlugin(b3.plugin.Plugin):
     requiresConfigFile = False
     default_connection_timeout = 30  # time (in sec) to wait before reconnecting after loosing FTP connection
     default_maxGap = 20480           # max gap in bytes between remote file and local file
+    default_max_bandwidth = 0        # max download rate in bytes per second (0: unlimited)
+    chunk_size = 32768               # size in bytes of a read request, the largest one most SFTP servers accept
+    window_chunks = 16               # number of read requests pipelined at once
+    stats_interval = 300             # time (in sec) between two logs of the polling statistics
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -74,7 +78,12 @@ class SftpytailPlugin(b3.plugin.Plugin):
         self._publicIp = None
         self._remoteFileOffset = None
         self._sftpdelay = 0.150
-        self.buffer = None
+        self._maxBandwidth = SftpytailPlugin.default_max_bandwidth
+        self._polls = 0
+        self._emptyPolls = 0
+        self._bytes = 0
+        self._pollTime = 0.0
+        self._lastPollTime = 0.0
         self.file = None
         self.lgame_log = None
         self.sftpconfig = None
@@ -141,6 +150,19 @@ class SftpytailPlugin(b3.plugin.Plugin):
             self.error('could not load settings/maxGapBytes config value: %s' % e)
             self.debug('using default value (%s) for settings/maxGapBytes' % self._maxGap)
 
+        try:
+            self._maxBandwidth = self.config.getint('settings', 'max_bandwidth')
+            if self._maxBandwidth < 0:
+                raise ValueError("max_bandwidth cannot be negative")
+            self.debug('loaded settings/max_bandwidth: %s' % self._maxBandwidth)
+        except NoOptionError:
+            self.debug('could not find settings/max_bandwidth in config file, '
+                       'using default: %s' % self._maxBandwidth)
+        except ValueError, e:
+            self._maxBandwidth = SftpytailPlugin.default_max_bandwidth
+            self.error('could not load settings/max_bandwidth config value: %s' % e)
+            self.debug('using default value (%s) for settings/max_bandwidth' % self._maxBandwidth)
+
         try:
             self.known_hosts_file = self.config.getpath('settings', 'known_hosts_file')
             if not os.path.isfile(self.known_hosts_file):
@@ -178,19 +200,63 @@ class SftpytailPlugin(b3.plugin.Plugin):
     #                                                                                                                  #
     ####################################################################################################################
 
+    def getStats(self):
+        """
+        Return the polling statistics of the SFTP log tail.
+        """
+        return {'polls': self._polls,
+                'empty_polls': self._emptyPolls,
+                'bytes': self._bytes,
+                'avg_latency': self._pollTime / self._polls if self._polls else 0.0,
+                'last_latency': self._lastPollTime}
+
+    def download(self, rfile, length):
+        """
+        Copy the given number of bytes from the remote file, starting at the current offset, to the local game log.
+        Read requests are pipelined by windows of window_chunks requests and every chunk is written to the local game
+        log as soon as it is received, so that memory usage is bounded and the parser gets the first lines early.
+        :param rfile: The remote file
+        :param length: The number of bytes to download
+        :return: The number of bytes downloaded
+        """
+        window = self.chunk_size * self.window_chunks
+        if self._maxBandwidth:
+            # do not request more than a second worth of data at once, or the cap would only apply to our reads
+            window = max(self.chunk_size, min(window, self._maxBandwidth))
+
+        start = time.time()
+        written = 0
+        while written < length:
+            size = min(window, length - written)
+            offset = self._remoteFileOffset
+            chunks = [(offset + i, min(self.chunk_size, size - i)) for i in xrange(0, size, self.chunk_size)]
+            received = 0
+            for block in rfile.readv(chunks):
+                if not block:
+                    break
+                self.file.write(block)
+                self.file.flush()
+                received += len(block)
+                self._remoteFileOffset += len(block)
+            written += received
+            if received < size:
+                # the remote file has been truncated in the meantime
+                break
+            if self._maxBandwidth:
+                delay = start + float(written) / self._maxBandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.verbose('received %s bytes' % written)
+        return written
+
     def update(self):
         """
         Update the local log file.
         """
-        def handle_download(block):
-            self.verbose('received %s bytes' % len(block))
-            self._remoteFileOffset += len(block)
-            if self.buffer is None:
-                self.buffer = block
-            else:
-                self.buffer = self.buffer + block
         transport = sftp = None
         rfile = None
+        nextStats = time.time() + self.stats_interval
         self.file = open(self.lgame_log, 'ab')
         self.file.write('\r\n')
         self.file.write('B3 has been restarted\r\n')
@@ -201,6 +267,7 @@ class SftpytailPlugin(b3.plugin.Plugin):
                     transport, sftp = self.sftpconnect()
                     rfile = None
                     self._nbConsecutiveConnFailure = 0
+                start = time.time()
                 try:
                     #self.verbose("Getting remote file size for %s" % self.sftpconfig['path'])
                     remotesize = sftp.stat(self.sftpconfig['path']).st_size
@@ -224,16 +291,16 @@ class SftpytailPlugin(b3.plugin.Plugin):
                     if not rfile:
                         self.debug('opening remote game log file %s for reading' % self.sftpconfig['path'])
                         rfile = sftp.open(self.sftpconfig['path'], 'r')
-                    rfile.seek(self._remoteFileOffset)
                     self.debug('reading remote game log file from offset %s' % self._remoteFileOffset)
-                    handle_download(rfile.read())
-                    if self.buffer:
-                        self.file.write(self.buffer)
-                        self.buffer = None
-                        self.file.flush()
+                    self._bytes += self.download(rfile, remotesize - self._remoteFileOffset)
                     if self.console._paused:
                         self.console.unpause()
                         self.debug('Unpausing')
+                else:
+                    self._emptyPolls += 1
+                self._lastPollTime = time.time() - start
+                self._pollTime += self._lastPollTime
+                self._polls += 1
             except paramiko.SSHException, err:
                 self.warning(str(err))
                 self._nbConsecutiveConnFailure += 1
@@ -269,6 +336,12 @@ class SftpytailPlugin(b3.plugin.Plugin):
                 else:
                     self.debug('too many failures: sleeping %s sec' % self._waitBeforeReconnect)
                     time.sleep(self._waitBeforeReconnect)
+
+            if time.time() >= nextStats:
+                nextStats = time.time() + self.stats_interval
+                self.debug('%(polls)s polls (%(empty_polls)s empty), %(bytes)s bytes downloaded, '
+                           'average latency %(avg_latency).3fs' % self.getStats())
+
             time.sleep(self._sftpdelay)
 
         self.verbose("B3 is down: stopping sFtpytail thread")
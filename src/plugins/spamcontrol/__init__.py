@@ -31,7 +31,58 @@ from b3.functions import getCmd
 from b3.functions import clamp
 
 __author__ = 'ThorN, Courgette'
-__version__ = '1.4.4'
+__version__ = '1.5'
+
+
+class SpamState(object):
+    """
+    Spam scoring state of a client: the spam points and a ring of the hashes and times of the last messages.
+    """
+    __slots__ = ('spamins', 'lastTime', 'ignoreTill', '_hashes', '_times', '_pos')
+
+    def __init__(self, size, now):
+        """
+        Object constructor.
+        :param size: The number of messages remembered
+        :param now: The current time
+        """
+        self.spamins = 0
+        self.lastTime = now
+        self.ignoreTill = 0
+        self._hashes = [None] * size
+        self._times = [None] * size
+        self._pos = 0
+
+    def isRepeated(self, text):
+        """
+        Tell whether the given text is one of the remembered messages.
+        """
+        return hash(text) in self._hashes
+
+    def countSince(self, since):
+        """
+        Return the number of remembered messages sent after the given time.
+        """
+        # walk the ring from the newest message and stop at the first one which is too old
+        times = self._times
+        pos = self._pos
+        count = 0
+        while count < len(times):
+            pos -= 1
+            t = times[pos]
+            if t is None or t <= since:
+                break
+            count += 1
+        return count
+
+    def push(self, text, now):
+        """
+        Remember a message, replacing the oldest one.
+        """
+        self._hashes[self._pos] = hash(text)
+        self._times[self._pos] = now
+        self._pos = (self._pos + 1) % len(self._hashes)
+        self.lastTime = now
 
 
 class SpamcontrolPlugin(b3.plugin.Plugin):
@@ -41,6 +92,17 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
     _maxSpamins = 10
     _modLevel = 20
     _falloffRate = 6.5
+    _history = 5
+    _rateWindow = 10
+    _rateLimit = 5
+    _reColor = re.compile(r'\^[0-9]')
+
+    def __init__(self, console, config=None):
+        """
+        Build the plugin object.
+        """
+        b3.plugin.Plugin.__init__(self, console, config)
+        self._states = {}  # client cid -> SpamState
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -55,6 +117,11 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
         self._maxSpamins = self.getSetting('settings', 'max_spamins', b3.INTEGER, self._maxSpamins, lambda x: clamp(x, minv=0))
         self._modLevel = self.getSetting('settings', 'mod_level', b3.LEVEL, self._modLevel)
         self._falloffRate = self.getSetting('settings', 'falloff_rate', b3.FLOAT, self._falloffRate)
+        self._history = self.getSetting('settings', 'message_history', b3.INTEGER, self._history, lambda x: clamp(x, minv=1))
+        self._rateWindow = self.getSetting('settings', 'rate_window', b3.FLOAT, self._rateWindow, lambda x: clamp(x, minv=0))
+        self._rateLimit = self.getSetting('settings', 'rate_limit', b3.INTEGER, self._rateLimit, lambda x: clamp(x, minv=0, maxv=self._history))
+        # the states are sized after message_history
+        self._states = {}
 
     def onStartup(self):
         """
@@ -64,6 +131,7 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
         self.registerEvent('EVT_CLIENT_SAY', self.onChat)
         self.registerEvent('EVT_CLIENT_TEAM_SAY', self.onChat)
         self.registerEvent('EVT_CLIENT_PRIVATE_SAY', self.onChat)
+        self.registerEvent('EVT_CLIENT_DISCONNECT', self.onDisconnect)
 
         self._adminPlugin = self.console.getPlugin('admin')
 
@@ -92,22 +160,35 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
         """
         return self.console.time()
 
+    def getSpamState(self, client):
+        """
+        Return the spam scoring state of the given client.
+        """
+        state = self._states.get(client.cid)
+        if state is None:
+            state = self._states[client.cid] = SpamState(self._history, self.getTime())
+        return state
+
     def add_spam_points(self, client, points, text):
         """
         Add spam points to the given client.
         """
         now = self.getTime()
-        if client.var(self, 'ignore_till', now).value > now:
+        state = self.getSpamState(client)
+        if state.ignoreTill > now:
             # ignore the user
             raise b3.events.VetoEvent
 
-        last_message_time = client.var(self, 'last_message_time', now).value
-        gap = now - last_message_time
+        gap = now - state.lastTime
 
         if gap < 2:
             points += 1
 
-        spamins = client.var(self, 'spamins', 0).value + points
+        # every message sent above the allowed rate is worth one more point
+        if self._rateLimit and state.countSince(now - self._rateWindow) >= self._rateLimit:
+            points += 1
+
+        spamins = state.spamins + points
 
         # apply natural points decrease due to time
         spamins -= int(gap / self._falloffRate)
@@ -116,16 +197,14 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
             spamins = 0
 
         # set new values
-        client.setvar(self, 'spamins', spamins)
-        client.setvar(self, 'last_message_time', now)
-        client.setvar(self, 'last_message', text)
+        state.spamins = spamins
+        state.push(text, now)
 
         # should we warn ?
         if spamins >= self._maxSpamins:
-            client.setvar(self, 'ignore_till', now + 2)
+            state.ignoreTill = now + 2
             self._adminPlugin.warnClient(client, 'spam')
-            spamins = int(spamins / 1.5)
-            client.setvar(self, 'spamins', spamins)
+            state.spamins = int(spamins / 1.5)
             raise b3.events.VetoEvent
 
     ####################################################################################################################
@@ -144,11 +223,11 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
         points = 0
         client = event.client
         text = event.data
-        last_message = client.var(self, 'last_message').value
-        color = re.match(r'\^[0-9]', event.data)
-        if color and text == last_message:
+        repeated = self.getSpamState(client).isRepeated(text)
+        color = self._reColor.match(text)
+        if color and repeated:
             points += 5
-        elif text == last_message:
+        elif repeated:
             points += 3
         elif color:
             points += 2
@@ -162,6 +241,12 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
 
         self.add_spam_points(client, points, text)
 
+    def onDisconnect(self, event):
+        """
+        Handle EVT_CLIENT_DISCONNECT
+        """
+        self._states.pop(event.data, None)
+
     ####################################################################################################################
     #                                                                                                                  #
     #    COMMANDS                                                                                                      #
@@ -183,10 +268,10 @@ class SpamcontrolPlugin(b3.plugin.Plugin):
             cmd.sayLoudOrPM(client, '%s ^7is too cool to spam' % sclient.exactName)
         else:
             now = self.getTime()
-            last_message_time = sclient.var(self, 'last_message_time', now).value
-            gap = now - last_message_time
+            state = self.getSpamState(sclient)
+            gap = now - state.lastTime
 
-            msmin = smin = sclient.var(self, 'spamins', 0).value
+            msmin = smin = state.spamins
             smin -= int(gap / self._falloffRate)
 
             if smin < 1:
@@ -25,13 +25,99 @@
 import b3
 import b3.events
 import b3.plugin
+import heapq
 import string
 
 from b3.functions import getCmd
 from ConfigParser import NoOptionError, NoSectionError
 
 __author__ = 'ThorN, GrosBedo'
-__version__ = '1.5.1'
+__version__ = '1.6'
+
+
+class ClientStats(object):
+    """
+    Map statistics of a client.
+    """
+    __slots__ = ('shotsTeamHit', 'damageTeamHit', 'shotsHit', 'damageHit', 'shotsGot', 'damageGot', 'teamKills',
+                 'kills', 'deaths', 'assists', 'pointsWon', 'pointsLost', 'points', 'experience', 'oldexperience')
+
+    def __init__(self, points):
+        """
+        Object constructor.
+        :param points: The skill points the client starts with
+        """
+        self.points = points
+        self.pointsWon = 0
+        self.pointsLost = 0
+        self.experience = 0
+        self.oldexperience = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the counters of the current map.
+        """
+        self.shotsTeamHit = 0
+        self.damageTeamHit = 0
+        self.shotsHit = 0
+        self.damageHit = 0
+        self.shotsGot = 0
+        self.damageGot = 0
+        self.teamKills = 0
+        self.kills = 0
+        self.deaths = 0
+        self.assists = 0
+
+
+class StatsRanking(object):
+    """
+    Scores of the clients kept in a heap so that the best ones can be listed without sorting all of them.
+
+    Updating a score pushes a new entry and leaves the previous one in the heap: outdated entries are skipped (and
+    dropped) when the best scores are listed, and the heap is rebuilt when they outnumber the valid ones.
+    """
+
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self._heap = []     # (-score, cid)
+        self._scores = {}   # cid -> score
+
+    def __len__(self):
+        return len(self._scores)
+
+    def update(self, cid, score):
+        """
+        Set the score of a client.
+        """
+        self._scores[cid] = score
+        heapq.heappush(self._heap, (-score, cid))
+        if len(self._heap) > 2 * len(self._scores) + 64:
+            self._heap = [(-s, c) for c, s in self._scores.iteritems()]
+            heapq.heapify(self._heap)
+
+    def remove(self, cid):
+        """
+        Remove a client from the ranking.
+        """
+        self._scores.pop(cid, None)
+
+    def top(self, limit):
+        """
+        Return the best scores.
+        :param limit: The maximum number of scores to return
+        :return: list of (cid, score), best score first
+        """
+        result = []
+        while self._heap and len(result) < limit:
+            score, cid = heapq.heappop(self._heap)
+            if self._scores.get(cid) == -score and (cid, -score) not in result:
+                result.append((cid, -score))
+        for cid, score in result:
+            heapq.heappush(self._heap, (-score, cid))
+        return result
 
 
 class StatsPlugin(b3.plugin.Plugin):
@@ -60,6 +146,9 @@ class StatsPlugin(b3.plugin.Plugin):
         self.resetxp = False
         self.show_awards = False
         self.show_awards_xp = False
+        self._stats = {}    # client cid -> ClientStats
+        self._pointsRanking = StatsRanking()
+        self._xpRanking = StatsRanking()
 
     def onLoadConfig(self):
         """
@@ -196,6 +285,7 @@ class StatsPlugin(b3.plugin.Plugin):
         self.registerEvent('EVT_GAME_EXIT', self.onShowAwards)
         self.registerEvent('EVT_GAME_MAP_CHANGE', self.onShowAwards)
         self.registerEvent('EVT_GAME_ROUND_START', self.onRoundStart)
+        self.registerEvent('EVT_CLIENT_DISCONNECT', self.onDisconnect)
         if self.console.gameName == "iourt43":
             self.registerEvent('EVT_ASSIST', self.onAssist)
 
@@ -222,137 +312,159 @@ class StatsPlugin(b3.plugin.Plugin):
         for cid, c in self.console.clients.items():
             if c.maxLevel >= self.mapstatslevel:
                 try:
-                    c.setvar(self, 'shotsTeamHit', 0)
-                    c.setvar(self, 'damageTeamHit', 0)
-                    c.setvar(self, 'shotsHit', 0)
-                    c.setvar(self, 'damageHit', 0)
-                    c.setvar(self, 'shotsGot', 0)
-                    c.setvar(self, 'damageGot', 0)
-                    c.setvar(self, 'teamKills', 0)
-                    c.setvar(self, 'kills', 0)
-                    c.setvar(self, 'deaths', 0)
-                    if self.console.gameName == "iourt43":
-                        c.setvar(self, 'assists', 0)
+                    stats = self.getClientStats(c)
+                    stats.reset()
                     if self.resetscore:
                         # skill points are reset at the beginning of each map
-                        c.setvar(self, 'pointsLost', 0)
-                        c.setvar(self, 'pointsWon', 0)
-                        c.setvar(self, 'points', self.startPoints)
+                        stats.pointsLost = 0
+                        stats.pointsWon = 0
+                        stats.points = self.startPoints
+                        self._pointsRanking.update(cid, stats.points)
                     if self.resetxp:
-                        c.setvar(self, 'experience', 0)
+                        stats.experience = 0
                     else:
-                        c.var(self, 'oldexperience', 0).value += c.var(self, 'experience', 0).value
-                        c.setvar(self, 'experience', 0)
+                        stats.oldexperience += stats.experience
+                        stats.experience = 0
+                    self._xpRanking.update(cid, 0)
                 except Exception, e:
                     self.error(e)
 
+    def onDisconnect(self, event):
+        """
+        Handle EVT_CLIENT_DISCONNECT
+        """
+        self._stats.pop(event.data, None)
+        self._pointsRanking.remove(event.data)
+        self._xpRanking.remove(event.data)
+
     def onDamage(self, event):
         """
         Handle EVT_CLIENT_DAMAGE
         """
-        killer = event.client
-        victim = event.target
+        killer = self.getClientStats(event.client)
+        victim = self.getClientStats(event.target)
         points = int(event.data[0])
 
         if points > 100:
             points = 100
 
-        killer.var(self, 'shotsHit', 0).value  += 1
-        killer.var(self, 'damageHit', 0).value += points
-        victim.var(self, 'shotsGot', 0).value  += 1
-        victim.var(self, 'damageGot', 0).value += points
+        killer.shotsHit += 1
+        killer.damageHit += points
+        victim.shotsGot += 1
+        victim.damageGot += points
 
     def onDamageTeam(self, event):
         """
         Handle EVT_CLIENT_DAMAGE_TEAM
         """
-        killer = event.client
+        killer = self.getClientStats(event.client)
         points = int(event.data[0])
 
         if points > 100:
             points = 100
 
-        killer.var(self, 'shotsTeamHit', 0).value  += 1
-        killer.var(self, 'damageTeamHit', 0).value += points
+        killer.shotsTeamHit += 1
+        killer.damageTeamHit += points
 
     def onKill(self, event):
         """
         Handle EVT_CLIENT_KILL
         """
-        killer = event.client
-        victim = event.target
+        killer = self.getClientStats(event.client)
+        victim = self.getClientStats(event.target)
         points = int(event.data[0])
 
         if points > 100:
             points = 100
 
-        killer.var(self, 'shotsHit', 0).value  += 1
-        killer.var(self, 'damageHit', 0).value += points
+        killer.shotsHit += 1
+        killer.damageHit += points
 
-        victim.var(self, 'shotsGot', 0).value  += 1
-        victim.var(self, 'damageGot', 0).value += points
+        victim.shotsGot += 1
+        victim.damageGot += points
 
-        killer.var(self, 'kills', 0).value  += 1
-        victim.var(self, 'deaths', 0).value += 1
+        killer.kills += 1
+        victim.deaths += 1
 
-        val = self.score(killer, victim)
-        killer.var(self, 'points', self.startPoints).value += val
-        killer.var(self, 'pointsWon', 0).value += val
+        val = self.scorePoints(killer.points, victim.points)
+        killer.points += val
+        killer.pointsWon += val
 
-        victim.var(self, 'points', self.startPoints).value -= val
-        victim.var(self, 'pointsLost', 0).value += val
+        victim.points -= val
+        victim.pointsLost += val
 
-        self.updateXP(killer)
-        self.updateXP(victim)
+        self.updateXP(event.client.cid, killer)
+        self.updateXP(event.target.cid, victim)
 
     def onTeamKill(self, event):
         """
         Handle EVT_CLIENT_KILL_TEAM
         """
-        killer = event.client
-        victim = event.target
+        killer = self.getClientStats(event.client)
+        victim = self.getClientStats(event.target)
         points = int(event.data[0])
 
         if points > 100:
             points = 100
 
-        killer.var(self, 'shotsTeamHit', 0).value  += 1
-        killer.var(self, 'damageTeamHit', 0).value += points
+        killer.shotsTeamHit += 1
+        killer.damageTeamHit += points
+
+        killer.teamKills += 1
 
-        killer.var(self, 'teamKills', 0).value += 1
+        val = self.scorePoints(killer.points, victim.points)
+        killer.points -= val
+        killer.pointsLost += val
 
-        val = self.score(killer, victim)
-        killer.var(self, 'points', self.startPoints).value -= val
-        killer.var(self, 'pointsLost', 0).value += val
+        self.updateXP(event.client.cid, killer)
+        self.updateXP(event.target.cid, victim)
 
-        self.updateXP(killer)
-        self.updateXP(victim)
-		
     def onAssist(self, event):
+        """
+        Handle EVT_ASSIST
+        """
+        self.getClientStats(event.client).assists += 1
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #    OTHER METHODS                                                                                                 #
+    #                                                                                                                  #
+    ####################################################################################################################
 
-        client = event.client
-        victim = event.target
-        attacker = event.data
-        
-        client.var(self, 'assists', 0).value += 1
+    def getClientStats(self, client):
+        """
+        Return the map statistics of the given client.
+        """
+        stats = self._stats.get(client.cid)
+        if stats is None:
+            stats = self._stats[client.cid] = ClientStats(self.startPoints)
+        return stats
 
-    def updateXP(self, sclient):
+    def updateXP(self, cid, stats):
         """
-        Update client XP.
+        Update client XP and the rankings listed by !topstats and !topxp.
         """
-        realpoints = sclient.var(self, 'pointsWon', 0).value - sclient.var(self, 'pointsLost', 0).value
-        if sclient.var(self, 'deaths', 0).value != 0:
-            experience = (sclient.var(self, 'kills', 0).value * realpoints) / sclient.var(self, 'deaths', 0).value
+        realpoints = stats.pointsWon - stats.pointsLost
+        if stats.deaths != 0:
+            stats.experience = (stats.kills * realpoints) / stats.deaths
         else:
-            experience = sclient.var(self, 'kills', 0).value * realpoints
-        sclient.var(self, 'experience', 0).value = experience
+            stats.experience = stats.kills * realpoints
+        self._pointsRanking.update(cid, stats.points)
+        self._xpRanking.update(cid, stats.experience)
 
     def score(self, killer, victim):
         """
         Return the amount of points the killer scored for killing the victim.
         """
-        k = int(killer.var(self, 'points', self.startPoints).value)
-        v = int(victim.var(self, 'points', self.startPoints).value)
+        return self.scorePoints(self.getClientStats(killer).points, self.getClientStats(victim).points)
+
+    @staticmethod
+    def scorePoints(k, v):
+        """
+        Return the amount of points scored by a player having k skill points when killing a player having v.
+        """
+        k = int(k)
+        v = int(v)
 
         if k < 1:
             k = 1.00
@@ -369,6 +481,17 @@ class StatsPlugin(b3.plugin.Plugin):
 
         return round(points, 2)
 
+    def getTopList(self, ranking, limit=5):
+        """
+        Return the top list lines of the given ranking.
+        """
+        results = []
+        for cid, score in ranking.top(limit):
+            c = self.console.clients.getByCID(cid)
+            if c:
+                results.append('^3#%s^7 %s ^7[^3%s^7]' % (len(results) + 1, c.exactName, round(score, 2)))
+        return results
+
     ####################################################################################################################
     #                                                                                                                  #
     #   COMMANDS                                                                                                       #
@@ -386,21 +509,18 @@ class StatsPlugin(b3.plugin.Plugin):
         else:
             sclient = client
 			
+        stats = self.getClientStats(sclient)
         if self.console.gameName == "iourt43":
 
             message = '^3Stats ^7[ %s ^7] K ^2%s ^7D ^3%s ^7A ^5%s ^7TK ^1%s ^7Dmg ^5%s ^7Skill ^3%1.02f ^7XP ^6%s' % \
-                      (sclient.exactName, sclient.var(self, 'kills', 0).value, sclient.var(self, 'deaths', 0).value,
-                       sclient.var(self, 'assists', 0).value ,sclient.var(self, 'teamKills', 0).value, sclient.var(self, 'damageHit', 0).value,
-                       round(sclient.var(self, 'points', self.startPoints).value, 2),
-                       round(sclient.var(self, 'oldexperience', 0).value + sclient.var(self, 'experience', 0).value, 2))
-					   
+                      (sclient.exactName, stats.kills, stats.deaths, stats.assists, stats.teamKills, stats.damageHit,
+                       round(stats.points, 2), round(stats.oldexperience + stats.experience, 2))
+
         else:
 
             message = '^3Stats ^7[ %s ^7] K ^2%s ^7D ^3%s ^7TK ^1%s ^7Dmg ^5%s ^7Skill ^3%1.02f ^7XP ^6%s' % \
-                      (sclient.exactName, sclient.var(self, 'kills', 0).value, sclient.var(self, 'deaths', 0).value,
-                       sclient.var(self, 'teamKills', 0).value, sclient.var(self, 'damageHit', 0).value,
-                       round(sclient.var(self, 'points', self.startPoints).value, 2),
-                       round(sclient.var(self, 'oldexperience', 0).value + sclient.var(self, 'experience', 0).value, 2))
+                      (sclient.exactName, stats.kills, stats.deaths, stats.teamKills, stats.damageHit,
+                       round(stats.points, 2), round(stats.oldexperience + stats.experience, 2))
 
         cmd.sayLoudOrPM(client, message)
 
@@ -427,61 +547,25 @@ class StatsPlugin(b3.plugin.Plugin):
         """
         - list the top 5 map-stats players
         """
-        self.debug('Haha')
-        scores = []
-        for c in self.console.clients.getList():
-            if c.isvar(self, 'points'):
-                scores.append((c.exactName, round(c.var(self, 'points', self.startPoints).value, 2)))
-        
-        if len(scores):
-            tmplist = [(x[1], x) for x in scores]
-            tmplist.sort()
-            scores = [x for (key, x) in tmplist]
-            scores.reverse()
-
-            i = 0
-            results = []
-            for name, score in scores:
-                i += 1
-                if i >= 6:
-                    break
-
-                results.append('^3#%s^7 %s ^7[^3%s^7]' % (i, name, score))
-                
-            if client:        
-                client.message('^3Top Stats:^7 %s' % string.join(results,', '))
+        results = self.getTopList(self._pointsRanking)
+        if results:
+            if client:
+                client.message('^3Top Stats:^7 %s' % string.join(results, ', '))
             else:
-                self.console.say('^3Top Stats:^7 %s' % string.join(results,', '))
-        else:
+                self.console.say('^3Top Stats:^7 %s' % string.join(results, ', '))
+        elif client:
             client.message('^3Stats: ^7No top players')
 
     def cmd_topxp(self, data, client=None, cmd=None):
         """
         - list the top 5 map-stats most experienced players
         """
-        scores = []
-        for c in self.console.clients.getList():
-            if c.isvar(self, 'experience'):
-                scores.append((c.exactName, round(c.var(self, 'experience', self.startPoints).value, 2)))
-
-        if len(scores):
-            tmplist = [(x[1], x) for x in scores]
-            tmplist.sort()
-            scores = [x for (key, x) in tmplist]
-            scores.reverse()
-
-            i = 0
-            results = []
-            for name, score in scores:
-                i += 1
-                if i >= 6:
-                    break
-
-                results.append('^3#%s^7 %s ^7[^3%s^7]' % (i, name, score))
-
+        results = self.getTopList(self._xpRanking)
+        if results:
             if client:
                 client.message('^3Top Experienced Players:^7 %s' % string.join(results, ', '))
             else:
                 self.console.say('^3Top Experienced Players:^7 %s' % string.join(results, ', '))
-        else:
+        elif client:
             client.message('^3Stats: ^7No top experienced players')
+
@@ -23,22 +23,23 @@
 # ################################################################### #
 
 __author__ = 'ThorN'
-__version__ = '1.6.5'
+__version__ = '1.7'
 
 import b3
 import b3.cron
 import b3.plugin
 import b3.events
 import os
-import re
 import StringIO
 import time
 
 from b3 import functions
 from b3.functions import sanitizeMe
+from collections import OrderedDict
 from ConfigParser import NoOptionError
 from ftplib import FTP
-from xml.dom.minidom import Document
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
 
 
 class StatusPlugin(b3.plugin.Plugin):
@@ -51,6 +52,15 @@ class StatusPlugin(b3.plugin.Plugin):
     _outputFile = '~/status.xml'
     _enableDBsvarSaving = True
     _enableDBclientSaving = True
+    _batchSize = 100
+
+    # snapshot of the last status written to the XML file and rows stored in the database tables
+    _status = None
+    _svars = None
+    _cvars = None
+
+    _clientColumns = ('Name', 'ColorName', 'DBID', 'Connections', 'CID', 'Level', 'GUID', 'PBID', 'IP', 'Team',
+                      'Joined', 'Updated', 'Score', 'State')
 
     _tables = {
         'svars': 'current_svars',
@@ -227,12 +237,9 @@ class StatusPlugin(b3.plugin.Plugin):
 
     def onStop(self, event):
         self.info('B3 stop/exit.. updating status')
-        # create an empty status document
-        xml = Document()
-        b3status = xml.createElement("B3Status")
-        b3status.setAttribute("Time", time.asctime())
-        xml.appendChild(b3status)
-        self.writeXML(xml.toprettyxml(indent="        "))
+        # write an empty status document
+        self._status = None
+        self.writeXML()
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -270,16 +277,42 @@ class StatusPlugin(b3.plugin.Plugin):
         """
         Update XML/DB status.
         """
+        self.verbose('building status snapshot')
+        game, gamedata, clients = self.buildStatus()
+        svars = dict(game)
+        svars['lastupdate'] = str(int(time.time()))
+        for k, v in gamedata:
+            svars[k] = v
+
+        if self._enableDBsvarSaving:
+            self._svars = self.storeRows(self._tables['svars'], 'name', ('name', 'value'),
+                                         dict((k, (k, v[:255])) for k, v in svars.iteritems()), self._svars)
+
+        if self._enableDBclientSaving:
+            cvars = {}
+            for attributes, data, tkplugin in clients:
+                row = dict(attributes)
+                cvars[row['DBID']] = tuple(row[k] for k in self._clientColumns)
+            self._cvars = self.storeRows(self._tables['cvars'], 'DBID', self._clientColumns, cvars, self._cvars)
+
+        # most of the time nothing but the round and map time changes: do not rewrite nor upload the very same status
+        snapshot = (tuple(x for x in game if x[0] not in ('RoundTime', 'MapTime')), gamedata, clients)
+        if snapshot == self._status:
+            self.verbose('status did not change: skipping XML status update')
+            return
+        self.writeXML((game, gamedata, clients))
+        # remembered only once written: a failed upload is retried on next update
+        self._status = snapshot
+
+    def buildStatus(self):
+        """
+        Collect the current game and clients information.
+        :return: tuple (game attributes, game data, clients) where the game attributes and data are tuples of (name,
+                 value) pairs and clients a tuple of (attributes, data, tkplugin) where tkplugin is None or a tuple
+                 (points, attackers)
+        """
         clients = self.console.clients.getList()
         score_list = self.console.getPlayerScores()
-                 
-        self.verbose('building XML status')
-        xml = Document()
-
-        # --- Main section
-        b3status = xml.createElement("B3Status")
-        b3status.setAttribute("Time", time.asctime())
-        xml.appendChild(b3status)
 
         # --- Game section
         c = self.console.game
@@ -307,66 +340,28 @@ class StatusPlugin(b3.plugin.Plugin):
             capturelimit = c.captureLimit
         if c.rounds:
             rounds = c.rounds
-        if c.roundTime:
+        if c.roundTime():
             round_time = c.roundTime()
         if c.mapTime():
             map_time = c.mapTime()
 
-        # For XML:
-        game = xml.createElement("Game")
-        game.setAttribute("Ip", str(self.console._publicIp))
-        game.setAttribute("Port", str(self.console._port))
-        game.setAttribute("Name", str(gamename))
-        game.setAttribute("Type", str(gametype))
-        game.setAttribute("Map", str(mapname))
-        game.setAttribute("TimeLimit", str(timelimit))
-        game.setAttribute("FragLimit", str(fraglimit))
-        game.setAttribute("CaptureLimit", str(capturelimit))
-        game.setAttribute("Rounds", str(rounds))
-        game.setAttribute("RoundTime", str(round_time))
-        game.setAttribute("MapTime", str(map_time))
-        game.setAttribute("OnlinePlayers", str(len(clients)))
-        b3status.appendChild(game)
-
-        # For DB:
-        if self._enableDBsvarSaving:
-            # EMPTY DB SVARS TABLE
-            self.verbose('cleaning database table: %s...' % self._tables['svars'])
-            self.console.storage.truncateTable(self._tables['svars'])
-            # ADD NEW DATA
-            self.storeServerinfo("Ip", str(self.console._publicIp))
-            self.storeServerinfo("Port", str(self.console._port))
-            self.storeServerinfo("Name", str(gamename))
-            self.storeServerinfo("Type", str(gametype))
-            self.storeServerinfo("Map", str(mapname))
-            self.storeServerinfo("TimeLimit", str(timelimit))
-            self.storeServerinfo("FragLimit", str(fraglimit))
-            self.storeServerinfo("CaptureLimit",str(capturelimit) )
-            self.storeServerinfo("Rounds", str(rounds))
-            self.storeServerinfo("RoundTime", str(round_time))
-            self.storeServerinfo("MapTime", str(map_time))
-            self.storeServerinfo("OnlinePlayers", str(len(clients)))
-            self.storeServerinfo("lastupdate", str(int(time.time())))
-
-        for k, v in self.console.game.__dict__.items():
-            data = xml.createElement("Data")
-            data.setAttribute("Name", str(k))
-            data.setAttribute("Value", str(v))
-            game.appendChild(data)
-            self.storeServerinfo(k, v)
-
-        # --- End Game section        
+        game = (("Ip", str(self.console._publicIp)),
+                ("Port", str(self.console._port)),
+                ("Name", str(gamename)),
+                ("Type", str(gametype)),
+                ("Map", str(mapname)),
+                ("TimeLimit", str(timelimit)),
+                ("FragLimit", str(fraglimit)),
+                ("CaptureLimit", str(capturelimit)),
+                ("Rounds", str(rounds)),
+                ("RoundTime", str(round_time)),
+                ("MapTime", str(map_time)),
+                ("OnlinePlayers", str(len(clients))))
+
+        gamedata = tuple(sorted((str(k), str(v)) for k, v in self.console.game.__dict__.items()))
 
         # --- Clients section
-        b3clients = xml.createElement("Clients")
-        b3clients.setAttribute("Total", str(len(clients)))
-        b3status.appendChild(b3clients)
-
-        if self._enableDBclientSaving:
-            # EMPTY DB CVARS TABLE
-            self.verbose('cleaning database table: %s...' % self._tables['cvars'])
-            self.console.storage.truncateTable(self._tables['cvars'])
-
+        b3clients = []
         for c in clients:
 
             if not c.name:
@@ -380,127 +375,113 @@ class StatusPlugin(b3.plugin.Plugin):
             else:
                 level = c.maskedLevel
             try:
-                client = xml.createElement("Client")
-                client.setAttribute("Name", sanitizeMe(c.name))
-                client.setAttribute("ColorName", sanitizeMe(c.exactName))
-                client.setAttribute("DBID", str(c.id))
-                client.setAttribute("Connections", str(c.connections))
-                client.setAttribute("CID", c.cid)
-                client.setAttribute("Level", str(level))
-
-                if c.guid:
-                    client.setAttribute("GUID", c.guid)
-                else:
-                    client.setAttribute("GUID", '')
-                if c.pbid:
-                    client.setAttribute("PBID", c.pbid)
-                else:
-                    client.setAttribute("PBID", '')
-
-                client.setAttribute("IP", c.ip)
-                client.setAttribute("Team", str(c.team))
-                client.setAttribute("Joined", str(time.ctime(c.timeAdd)))
-                client.setAttribute("Updated", str(time.ctime(c.timeEdit)))
-
-                if score_list and c.cid in score_list:
-                    client.setAttribute("Score", str(score_list[c.cid]))
-                else:
-                    client.setAttribute("Score", 0)
-
-                client.setAttribute("State", str(c.state))
-
-                if self._enableDBclientSaving:
-                    builder_key = ""
-                    builder_value = ""
-                    # get our attributes
-                    for k, v in client.attributes.items():
-                        # build the qrystring
-                        builder_key = "%s%s," % (builder_key, k)
-                        if isinstance(v, basestring):
-                            if "'" in v:
-                                v = "%s" % v.replace("'", "\\'")
-                        builder_value = "%s'%s'," % (builder_value, v)
-
-                    # cut last ,
-                    builder_key = builder_key[:-1]
-                    builder_value = builder_value[:-1]
-
-                    try:
-                        self.console.storage.query("""INSERT INTO %s (%s) VALUES (%s);""" % (self._tables['cvars'], builder_key, builder_value))
-                    except Exception:
-                        # exception is already logged, just don't raise it again
-                        pass
-
-                b3clients.appendChild(client)
-
+                client = (("Name", sanitizeMe(c.name)),
+                          ("ColorName", sanitizeMe(c.exactName)),
+                          ("DBID", str(c.id)),
+                          ("Connections", str(c.connections)),
+                          ("CID", c.cid),
+                          ("Level", str(level)),
+                          ("GUID", c.guid or ''),
+                          ("PBID", c.pbid or ''),
+                          ("IP", c.ip),
+                          ("Team", str(c.team)),
+                          ("Joined", str(time.ctime(c.timeAdd))),
+                          ("Updated", str(time.ctime(c.timeEdit))),
+                          ("Score", str(score_list[c.cid]) if score_list and c.cid in score_list else '0'),
+                          ("State", str(c.state)))
+
+                data = []
                 for k, v in c.data.iteritems():
-                    data = xml.createElement("Data")
-                    data.setAttribute("Name", "%s" % k)
-
                     try:
                         clean_data = sanitizeMe(str(v))
                     except Exception, err:
                         self.error("could not sanitize %r" % v, exc_info=err)
-                        data.setAttribute("Value", "")
+                        data.append(("%s" % k, ""))
                     else:
-                        data.setAttribute("Value", clean_data)
+                        data.append(("%s" % k, clean_data))
 
-                    client.appendChild(data)
-                        
+                tkplugin = None
                 if self._tkPlugin:
                     if hasattr(c, 'tkplugin_points'):
-                        tkplugin = xml.createElement("TkPlugin")
-                        tkplugin.setAttribute("Points", str(c.var(self, 'points')))
-                        client.appendChild(tkplugin)            
+                        attackers = []
                         if hasattr(c, 'tkplugin_attackers'):
                             for acid, points in c.var(self, 'attackers').value.items():
                                 try:
-                                    attacker = xml.createElement("Attacker")
-                                    attacker.setAttribute("Name", sanitizeMe(self.console.clients[acid].name))
-                                    attacker.setAttribute("CID", str(acid))
-                                    attacker.setAttribute("Points", str(points))
-                                    tkplugin.appendChild(attacker)
+                                    attackers.append((sanitizeMe(self.console.clients[acid].name), str(acid),
+                                                      str(points)))
                                 except Exception, e:
-                                    self.warning('could not append child node in XML tree: %s' % e)
-                                    pass
-                                
+                                    self.warning('could not collect attacker information: %s' % e)
+                        tkplugin = (str(c.var(self, 'points')), tuple(attackers))
+
+                b3clients.append((client, tuple(sorted(data)), tkplugin))
+
             except Exception, err:
                 self.error('XML Failed: %r' % err, exc_info=err)
-                pass
-
-        # --- End Clients section
 
-        self.writeXML(xml.toprettyxml(encoding="UTF-8", indent="        "))
+        return game, gamedata, tuple(b3clients)
 
-    def storeServerinfo(self, k, v):
+    def storeRows(self, table, key, columns, rows, previous):
         """
-        Store server information in the database.
+        Bring a database table in line with the given rows, touching only the rows which changed since last update.
+        :param table: The name of the table
+        :param key: The name of the column identifying a row
+        :param columns: The names of the columns
+        :param rows: A dict mapping the value of the key column to the tuple of values of a row
+        :param previous: The rows dict stored by the previous update, or None if the table content is unknown
+        :return: The rows dict now stored in the table, or None if the table could not be updated
         """
-        if self._enableDBsvarSaving:
-            # remove forbidden sql characters
-            k = re.sub("'", "", str(k))
-            v = re.sub("'", "", str(v))[:255]  # length of the database varchar field
-            try:
-                if self.console.storage.dsnDict['protocol'] == 'postgresql':
-                    self.console.storage.query("""UPDATE %s SET value='%s' WHERE name='%s';""" % (self._tables['svars'], v, k))
-                    self.console.storage.query("""INSERT INTO %s (name, value) SELECT '%s', '%s' WHERE NOT EXISTS (
-                                                  SELECT 1 FROM %s WHERE name='%s');""" % (self._tables['svars'], k, v,
-                                                                                           self._tables['svars'], k))
-                else:
-                    self.console.storage.query("""INSERT INTO %s (name, value) VALUES ('%s','%s') ON DUPLICATE KEY
-                                                  UPDATE value = VALUES(value);""" % (self._tables['svars'], k, v))
-            except Exception:
-                # exception is already logged, just don't raise it again
-                pass
-
-    def writeXML(self, xml):
+        storage = self.console.storage
+        try:
+            if previous is None:
+                self.verbose('cleaning database table: %s...' % table)
+                storage.truncateTable(table)
+                previous = {}
+
+            changed = [k for k, v in rows.iteritems() if previous.get(k) != v]
+            # changed rows are deleted and inserted again: this works the same on every database
+            outdated = [k for k in previous if k not in rows or k in changed]
+            for i in xrange(0, len(outdated), self._batchSize):
+                keys = outdated[i:i + self._batchSize]
+                names = ['k%s' % j for j in xrange(len(keys))]
+                storage.query("DELETE FROM %s WHERE %s IN (%s)" % (table, key, ', '.join(self._bind(x) for x in names)),
+                              dict(zip(names, keys)))
+
+            for i in xrange(0, len(changed), self._batchSize):
+                values = []
+                data = {}
+                for j, k in enumerate(changed[i:i + self._batchSize]):
+                    names = ['v%s_%s' % (j, n) for n in xrange(len(columns))]
+                    values.append('(%s)' % ', '.join(self._bind(x) for x in names))
+                    data.update(zip(names, rows[k]))
+                storage.query("INSERT INTO %s (%s) VALUES %s" % (table, ', '.join(columns), ', '.join(values)), data)
+
+            if changed or outdated:
+                self.verbose('%s: %s rows updated, %s rows removed' % (table, len(changed),
+                                                                      len(outdated) - len(changed)))
+            return rows
+        except Exception, err:
+            # the table content is unknown: it will be rebuilt from scratch on next update
+            self.error('could not update database table %s: %s' % (table, err))
+            return None
+
+    def _bind(self, name):
+        """
+        Return the query placeholder of the given parameter name.
+        """
+        # sqlite does not understand the pyformat parameter style used by the other database modules
+        if self.console.storage.dsnDict['protocol'] == 'sqlite':
+            return ':%s' % name
+        return '%%(%s)s' % name
+
+    def writeXML(self, status=None):
         """
         Store server information in the XML file.
+        :param status: The status snapshot, as returned by buildStatus, or None to write an empty status document
         """
         if self._ftpstatus:
             self.debug('uploading XML status to FTP server')
             ftp_file = StringIO.StringIO()
-            ftp_file.write(xml)
+            self.renderXML(ftp_file, status)
             ftp_file.seek(0)
             ftp = FTP(self._ftpinfo['host'], self._ftpinfo['user'], passwd=self._ftpinfo['password'])
             ftp.cwd(os.path.dirname(self._ftpinfo['path']))
@@ -509,4 +490,83 @@ class StatusPlugin(b3.plugin.Plugin):
         else:
             self.debug('writing XML status to %s', self._outputFile)
             with open(self._outputFile, 'w') as f:
-                f.write(xml)
\ No newline at end of file
+                self.renderXML(f, status)
+
+    def renderXML(self, out, status=None):
+        """
+        Serialize a status snapshot as an XML document, straight into the given file object.
+        """
+        writer = XMLWriter(out)
+        writer.start("B3Status", (("Time", time.asctime()),))
+        if status is not None:
+            game, gamedata, clients = status
+            writer.start("Game", game)
+            for k, v in gamedata:
+                writer.element("Data", (("Name", k), ("Value", v)))
+            writer.end("Game")
+
+            writer.start("Clients", (("Total", str(len(clients))),))
+            for attributes, data, tkplugin in clients:
+                writer.start("Client", attributes)
+                for k, v in data:
+                    writer.element("Data", (("Name", k), ("Value", v)))
+                if tkplugin is not None:
+                    writer.start("TkPlugin", (("Points", tkplugin[0]),))
+                    for name, cid, points in tkplugin[1]:
+                        writer.element("Attacker", (("Name", name), ("CID", cid), ("Points", points)))
+                    writer.end("TkPlugin")
+                writer.end("Client")
+            writer.end("Clients")
+        writer.end("B3Status")
+        writer.close()
+
+
+class XMLWriter(object):
+    """
+    Write an indented XML document element by element, without building it in memory.
+    """
+
+    indent = '        '
+
+    def __init__(self, out):
+        """
+        Object constructor.
+        :param out: The file object where to write the document
+        """
+        self._generator = XMLGenerator(out, 'UTF-8')
+        self._generator.startDocument()
+        self._parents = []  # one flag per open element telling whether it has children
+
+    def start(self, name, attributes):
+        """
+        Open an element.
+        :param name: The element name
+        :param attributes: The element attributes, as (name, value) pairs
+        """
+        if self._parents:
+            self._parents[-1] = True
+            self._generator.ignorableWhitespace('\n' + self.indent * len(self._parents))
+        self._generator.startElement(name, AttributesImpl(OrderedDict(sorted(attributes))))
+        self._parents.append(False)
+
+    def end(self, name):
+        """
+        Close the last opened element.
+        """
+        if self._parents.pop():
+            self._generator.ignorableWhitespace('\n' + self.indent * len(self._parents))
+        self._generator.endElement(name)
+
+    def element(self, name, attributes):
+        """
+        Write an element without children.
+        """
+        self.start(name, attributes)
+        self.end(name)
+
+    def close(self):
+        """
+        Terminate the document.
+        """
+        self._generator.ignorableWhitespace('\n')
+        self._generator.endDocument()
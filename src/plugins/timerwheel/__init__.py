@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Timer service shared by the plugins.
+
+Plugins used to start a threading.Timer, thus an OS thread, for every delayed action (ie: kicking an AFK player,
+checking a teamkiller after 30 seconds). The callbacks scheduled here are all run by a single thread:
+
+    from b3.plugins.timerwheel import schedule
+    timer = schedule(self, 30, self.checkTKBan, (client,))
+    ...
+    timer.cancel()
+
+Callbacks run one after the other: they must not block for long.
+"""
+
+__author__ = 'XtremeIdiots'
+__version__ = '1.0'
+
+import math
+import threading
+import time
+
+
+class WheelTimer(object):
+    """
+    A callback scheduled on a TimerWheel.
+    """
+    __slots__ = ('wheel', 'owner', 'func', 'args', 'kwargs', 'tick', 'level', 'slot', 'active')
+
+    def __init__(self, wheel, owner, func, args, kwargs):
+        self.wheel = wheel
+        self.owner = owner
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.tick = 0
+        self.level = 0
+        self.slot = 0
+        self.active = False
+
+    def cancel(self):
+        """
+        Cancel the timer if it has not fired yet.
+        :return: True if the timer was pending, False otherwise
+        """
+        return self.wheel.cancel(self)
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel running the scheduled callbacks from a single thread.
+
+    Level 0 has one slot per tick, each upper level has slots covering a whole turn of the level below. A timer is put
+    in the lowest level its delay fits in and moved down (cascaded) when the level below starts the turn it expires
+    in, so scheduling and cancelling a timer only add it to or remove it from one slot whatever the number of timers.
+    """
+
+    _bits = (8, 6, 6, 6)
+
+    def __init__(self, resolution=0.1, clock=time.time):
+        """
+        Object constructor.
+        :param resolution: The duration of a tick in seconds
+        :param clock: The function returning the current time
+        """
+        self.resolution = resolution
+        self._clock = clock
+        self._cond = threading.Condition(threading.Lock())
+        self._shifts = []
+        self._masks = []
+        shift = 0
+        for bits in self._bits:
+            self._shifts.append(shift)
+            self._masks.append((1 << bits) - 1)
+            shift += bits
+        self._span = 1 << shift
+        self._slots = [[set() for x in xrange(1 << bits)] for bits in self._bits]
+        self._tick = self._now()
+        self._pending = 0
+        self._counts = {}   # owner name -> number of pending timers
+        self._thread = None
+
+    def __len__(self):
+        return self._pending
+
+    def _now(self):
+        return int(self._clock() / self.resolution)
+
+    def schedule(self, owner, delay, func, args=(), kwargs=None):
+        """
+        Schedule a callback.
+        :param owner: The plugin scheduling the callback (used for logging and counting)
+        :param delay: The number of seconds after which the callback is run
+        :param func: The callback
+        :param args: The callback positional arguments
+        :param kwargs: The callback keyword arguments
+        :return: The WheelTimer object
+        """
+        timer = WheelTimer(self, owner, func, tuple(args), kwargs or {})
+        with self._cond:
+            if not self._pending:
+                # the worker does not walk the ticks while the wheel is empty
+                self._tick = max(self._tick, self._now())
+            # never fire early: the first tick starting after the deadline
+            timer.tick = max(self._tick + 1, int(math.ceil((self._clock() + delay) / self.resolution)))
+            timer.active = True
+            self._place(timer)
+            self._pending += 1
+            name = self._name(owner)
+            self._counts[name] = self._counts.get(name, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='timerwheel')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a pending timer.
+        :return: True if the timer was pending, False otherwise
+        """
+        with self._cond:
+            if not timer.active:
+                return False
+            self._slots[timer.level][timer.slot].discard(timer)
+            self._release(timer)
+            return True
+
+    def counts(self):
+        """
+        Return the number of pending timers of each owner.
+        :return: dict<owner name, number of timers>
+        """
+        with self._cond:
+            return dict(self._counts)
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #   OTHER METHODS                                                                                                  #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    @staticmethod
+    def _name(owner):
+        if owner is None or isinstance(owner, basestring):
+            return owner
+        return owner.__class__.__name__
+
+    def _place(self, timer):
+        """
+        Put a timer in the slot matching its expiration tick.
+        """
+        delta = timer.tick - self._tick
+        if delta >= self._span:
+            # beyond the wheel range: wait in the last slot of the top level and get placed again when cascaded
+            delta = self._span - 1
+        tick = self._tick + delta
+        level = 0
+        while level < len(self._bits) - 1 and delta >> self._shifts[level + 1]:
+            level += 1
+        timer.level = level
+        timer.slot = (tick >> self._shifts[level]) & self._masks[level]
+        self._slots[level][timer.slot].add(timer)
+
+    def _release(self, timer):
+        timer.active = False
+        self._pending -= 1
+        name = self._name(timer.owner)
+        count = self._counts.get(name, 0) - 1
+        if count > 0:
+            self._counts[name] = count
+        else:
+            self._counts.pop(name, None)
+
+    def _advance(self):
+        """
+        Move to the next tick and return the timers expiring at it.
+        """
+        self._tick += 1
+        # cascade the upper levels when the level below starts a new turn
+        level = 1
+        while level < len(self._bits) and not self._tick & ((1 << self._shifts[level]) - 1):
+            slot = self._slots[level][(self._tick >> self._shifts[level]) & self._masks[level]]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+            level += 1
+
+        slot = self._slots[0][self._tick & self._masks[0]]
+        expired = [x for x in slot if x.tick <= self._tick]
+        slot.difference_update(expired)
+        for timer in expired:
+            self._release(timer)
+        return expired
+
+    def _nextTick(self):
+        """
+        Return the next tick the wheel has something to do at: an occupied level 0 slot or the next cascade.
+        """
+        turn = (self._tick | self._masks[0]) + 1
+        for tick in xrange(self._tick + 1, turn):
+            if self._slots[0][tick & self._masks[0]]:
+                return tick
+        return turn
+
+    def _run(self):
+        """
+        Run the expired callbacks.
+        """
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = self._now()
+                expired = []
+                while self._tick < now and self._pending:
+                    expired.extend(self._advance())
+                if not self._pending:
+                    # nothing left to wait for: no need to walk the idle ticks
+                    self._tick = max(self._tick, now)
+                elif not expired:
+                    self._cond.wait(max(0.0, self._nextTick() * self.resolution - self._clock()))
+
+            for timer in expired:
+                try:
+                    timer.func(*timer.args, **timer.kwargs)
+                except Exception, e:
+                    if hasattr(timer.owner, 'error'):
+                        timer.owner.error('timer callback %s failed: %s' % (getattr(timer.func, '__name__', timer.func), e))
+
+
+_wheel = TimerWheel()
+
+
+def schedule(owner, delay, func, args=(), kwargs=None):
+    """
+    Schedule a callback on the shared timer wheel.
+    :param owner: The plugin scheduling the callback
+    :param delay: The number of seconds after which the callback is run
+    :param func: The callback
+    :param args: The callback positional arguments
+    :param kwargs: The callback keyword arguments
+    :return: The WheelTimer object, which can be cancelled
+    """
+    return _wheel.schedule(owner, delay, func, args, kwargs)
+
+
+def counts():
+    """
+    Return the number of pending timers of each plugin.
+    :return: dict<plugin class name, number of timers>
+    """
+    return _wheel.counts()
@@ -25,23 +25,158 @@
 import b3
 import b3.events
 import b3.plugin
-import b3.cron
 import string
 import re
-import threading
 import time
 
 from ConfigParser import NoOptionError
+from b3.plugins.timerwheel import schedule
 
-__version__ = '1.5'
+__version__ = '1.7'
 __author__ = 'ThorN, mindriot, Courgette, xlr8or, SGT, 82ndab-Bravo17, ozon, Fenix'
 
 
+class TkMatrix(object):
+    """
+    Teamkill points of every attacker against every victim.
+
+    Points decay exponentially with the configured half-life: a cell stores the points it had when it was last changed
+    along with the decay counter at that time, and is decayed when read. Halving all the points (ie: at the end of a
+    map) only increments the decay counter, so nothing has to be done while nobody is teamkilling.
+    """
+
+    def __init__(self, halflife=0, clock=time.time):
+        """
+        Object constructor.
+        :param halflife: The number of seconds after which the points are halved (0 = no decay)
+        :param clock: The function returning the current time
+        """
+        self.halflife = halflife
+        self._clock = clock
+        self._halvings = 0
+        self._victims = {}      # victim cid -> {attacker cid: [points, decay counter]}
+        self._attackers = {}    # attacker cid -> set of victim cids
+
+    def _decay(self):
+        """
+        Return the decay counter: the number of times the points have been halved so far.
+        """
+        if self.halflife > 0:
+            return self._halvings + self._clock() / float(self.halflife)
+        return self._halvings
+
+    @staticmethod
+    def _value(cell, decay):
+        # rounded down like the halving always did: a single point is forgiven when halved
+        return int(cell[0] * 2 ** (cell[1] - decay))
+
+    def add(self, acid, vcid, points):
+        """
+        Add teamkill points to an attacker.
+        :param acid: The attacker cid
+        :param vcid: The victim cid
+        :param points: The number of points to add
+        """
+        decay = self._decay()
+        row = self._victims.setdefault(vcid, {})
+        cell = row.get(acid)
+        if cell is None:
+            row[acid] = [points, decay]
+            self._attackers.setdefault(acid, set()).add(vcid)
+        else:
+            cell[0] = cell[0] * 2 ** (cell[1] - decay) + points
+            cell[1] = decay
+
+    def get(self, acid, vcid):
+        """
+        Return the points an attacker has against a victim.
+        """
+        cell = self._victims.get(vcid, {}).get(acid)
+        if cell is None:
+            return 0
+        return self._value(cell, self._decay())
+
+    def attackers(self, vcid):
+        """
+        Return the points of the attackers of a victim.
+        :return: dict<attacker cid, points>
+        """
+        decay = self._decay()
+        result = {}
+        for acid, cell in self._victims.get(vcid, {}).iteritems():
+            points = self._value(cell, decay)
+            if points:
+                result[acid] = points
+        return result
+
+    def victims(self, acid):
+        """
+        Return the points an attacker has against each victim.
+        :return: dict<victim cid, points>
+        """
+        decay = self._decay()
+        result = {}
+        for vcid in self._attackers.get(acid, ()):
+            points = self._value(self._victims[vcid][acid], decay)
+            if points:
+                result[vcid] = points
+        return result
+
+    def points(self, acid):
+        """
+        Return the total points of an attacker.
+        """
+        return sum(self.victims(acid).itervalues())
+
+    def remove(self, acid, vcid):
+        """
+        Remove the points an attacker has against a victim.
+        :return: The removed points or None if the attacker has no points against the victim
+        """
+        row = self._victims.get(vcid)
+        if not row or acid not in row:
+            return None
+        points = self._value(row.pop(acid), self._decay())
+        if not row:
+            del self._victims[vcid]
+        victims = self._attackers[acid]
+        victims.discard(vcid)
+        if not victims:
+            del self._attackers[acid]
+        return points
+
+    def removeAttacker(self, acid):
+        """
+        Remove all the points of an attacker.
+        :return: The removed points
+        """
+        return sum(self.remove(acid, vcid) for vcid in list(self._attackers.get(acid, ())))
+
+    def removeVictim(self, vcid):
+        """
+        Remove the points of all the attackers of a victim.
+        """
+        for acid in list(self._victims.get(vcid, ())):
+            self.remove(acid, vcid)
+
+    def halve(self):
+        """
+        Halve all the points.
+        """
+        self._halvings += 1
+
+    def expired(self):
+        """
+        Return the (attacker cid, victim cid) pairs whose points decayed to zero.
+        """
+        decay = self._decay()
+        return [(acid, vcid) for vcid, row in self._victims.iteritems()
+                for acid, cell in row.iteritems() if not self._value(cell, decay)]
+
+
 class TkInfo(object):
 
     def __init__(self, plugin, cid):
-        self._attackers = {}
-        self._attacked = {}
         self._warnings = {}
         self._lastAttacker = None
         self._grudged = []
@@ -50,16 +185,14 @@ class TkInfo(object):
         self.lastwarntime = 0
 
     def _get_attackers(self):
-        return self._attackers
+        return self.plugin._tkPoints.attackers(self.cid)
 
     def _get_attacked(self):
-        return self._attacked
+        return self.plugin._tkPoints.victims(self.cid)
 
     def forgive(self, cid):
-        try:
-            points = self._attackers[cid]
-            del self._attackers[cid]
-        except KeyError:
+        points = self.plugin._tkPoints.remove(cid, self.cid)
+        if points is None:
             return 0
 
         if self._lastAttacker == cid:
@@ -78,11 +211,6 @@ class TkInfo(object):
         self._warnings[cid] = warning
 
     def forgiven(self, cid):
-        try:
-            del self._attacked[cid]
-        except KeyError:
-            pass
-
         try:
             w = self._warnings[cid]
         except KeyError:
@@ -95,14 +223,8 @@ class TkInfo(object):
             del w
             del self._warnings[cid]
 
-    def damage(self, cid, points):
-        self._attacked[cid] = True
-
     def damaged(self, cid, points):
-        try:
-            self._attackers[cid] += points
-        except KeyError:
-            self._attackers[cid] = points
+        self.plugin._tkPoints.add(cid, self.cid, points)
         self._lastAttacker = cid
 
     def _get_lastAttacker(self):
@@ -118,21 +240,10 @@ class TkInfo(object):
         return cid in self._grudged
 
     def getAttackerPoints(self, cid):
-        try:
-            return self._attackers[cid]
-        except KeyError:
-            return 0
+        return self.plugin._tkPoints.get(cid, self.cid)
 
     def _get_points(self):
-        points = 0
-        if len(self._attacked):
-            for cid, bol in self._attacked.items():
-                try:
-                    client = self.plugin.console.clients.getByCID(cid)
-                    points += self.plugin.getClientTkInfo(client).getAttackerPoints(self.cid)
-                except:
-                    pass
-        return points
+        return self.plugin._tkPoints.points(self.cid)
 
     attackers = property(_get_attackers)
     attacked = property(_get_attacked)
@@ -199,8 +310,8 @@ class TkPlugin(b3.plugin.Plugin):
         self._damage_threshold = 100
         self._warn_level = 2
         self._tkpointsHalflife = 0
-        self._cronTab_tkhalflife = None
         self._tk_warn_duration = '1h'
+        self._tkPoints = TkMatrix(clock=self.console.time)
 
     def onLoadConfig(self):
         """
@@ -214,6 +325,7 @@ class TkPlugin(b3.plugin.Plugin):
         self._tk_warn_duration = self.getSetting('settings', 'warn_duration', b3.STR, self._tk_warn_duration)
         self._warn_level = self.getSetting('settings', 'warn_level', b3.INT, self._warn_level)
         self._tkpointsHalflife = self.getSetting('settings', 'halflife', b3.INT, self._tkpointsHalflife)
+        self._tkPoints.halflife = self._tkpointsHalflife
         self._grudge_enable = self.getSetting('settings', 'grudge_enable', b3.BOOL, self._grudge_enable)
         self._grudge_level = self.getSetting('settings', 'grudge_level', b3.INT, self._grudge_level)
 
@@ -336,12 +448,6 @@ class TkPlugin(b3.plugin.Plugin):
         if self._grudge_enable:
             self._adminPlugin.registerCommand(self, 'grudge', self._grudge_level, self.cmd_grudge, 'grudge')
 
-        if self._tkpointsHalflife > 0:
-            minute, sec = self.crontab_time()
-            self._cronTab_tkhalflife = b3.cron.OneTimeCronTab(self.halveTKPoints, second=sec, minute=minute)
-            self.console.cron + self._cronTab_tkhalflife
-            self.debug('TK Crontab started')
-
     ####################################################################################################################
     #                                                                                                                  #
     #    EVENTS                                                                                                        #
@@ -365,26 +471,17 @@ class TkPlugin(b3.plugin.Plugin):
 
         elif event.type == self.console.getEventID('EVT_CLIENT_DISCONNECT'):
             self.forgiveAll(event.data)
+            self._tkPoints.removeVictim(event.data)
             return
 
         elif (event.type == self.console.getEventID('EVT_GAME_EXIT') and not self._use_round_end) or \
                 (event.type == self.console.getEventID('EVT_GAME_ROUND_END') and self._use_round_end):
-            if self._cronTab_tkhalflife:
-                # remove existing crontab
-                self.console.cron - self._cronTab_tkhalflife
             self.halveTKPoints('map end: cutting all teamkill points in half')
             return
 
         elif event.type == self.console.getEventID('EVT_GAME_ROUND_START'):
-            if self._tkpointsHalflife > 0:
-                if self._cronTab_tkhalflife:
-                    # remove existing crontab
-                    self.console.cron - self._cronTab_tkhalflife
-                (m, s) = self.crontab_time()
-                self._cronTab_tkhalflife = b3.cron.OneTimeCronTab(self.halveTKPoints, second=s, minute=m)
-                self.console.cron + self._cronTab_tkhalflife
-                self.debug('TK crontab started')
-
+            # points decayed over time: clear those which reached zero
+            self.forgiveExpired()
             return
         else:
             return
@@ -415,8 +512,7 @@ class TkPlugin(b3.plugin.Plugin):
                 self.console.say(self.getMessage('forgive_warning', {'name': event.client.exactName,
                                                                      'points': points, 'cid': event.client.cid}) + msg)
                 event.client.setvar(self, 'checkBan', True)
-                t = threading.Timer(30, self.checkTKBan, (event.client,))
-                t.start()
+                schedule(self, 30, self.checkTKBan, (event.client,))
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -450,39 +546,20 @@ class TkPlugin(b3.plugin.Plugin):
         if msg is None:
             msg = 'halving all TK Points'
         self.debug(msg)
-        for cid, c in self.console.clients.items():
-            tkinfo = self.getClientTkInfo(c)
-            for acid, points in tkinfo.attackers.items():
-                points = int(round(points / 2))
-                if points == 0:
-                    self.forgive(acid, c, True)
-                else:
-                    try:
-                        tkinfo.attackers[acid] = points
-                    except KeyError:
-                        pass
-
-        if self._tkpointsHalflife > 0: 
-            if self._cronTab_tkhalflife:
-                # remove existing crontab
-                self.console.cron - self._cronTab_tkhalflife
-            (m, s) = self.crontab_time()
-            self._cronTab_tkhalflife = b3.cron.OneTimeCronTab(self.halveTKPoints, second=s, minute=m)
-            self.console.cron + self._cronTab_tkhalflife
-            #self.console.say('TK Crontab re-started')
-            self.debug('TK crontab re-started')
-            
-    def crontab_time(self):
-        s = self._tkpointsHalflife
-        m = int(time.strftime('%M'))
-        s += int(time.strftime('%S'))
-        while s > 59:
-            m += 1
-            s -= 60
-        if m > 59:
-            m -= 60
-        return m, s
-    
+        self._tkPoints.halve()
+        self.forgiveExpired()
+
+    def forgiveExpired(self):
+        """
+        Silently forgive the attackers whose teamkill points decayed to zero.
+        """
+        for acid, vcid in self._tkPoints.expired():
+            victim = self.console.clients.getByCID(vcid)
+            if victim:
+                self.forgive(acid, victim, True)
+            else:
+                self._tkPoints.remove(acid, vcid)
+
     def getMultipliers(self, client):
         level = ()
         for lev, mult in self._levels.iteritems():
@@ -513,7 +590,6 @@ class TkPlugin(b3.plugin.Plugin):
         else:
             points = int(round(points * self.getMultipliers(attacker)[1]))
 
-        a.damage(v.cid, points)
         v.damaged(a.cid, points)
         
         self.debug('attacker: %s, TK points: %s, attacker.maxLevel: %s, last warn time: %s, console time: %s' % (
@@ -606,19 +682,18 @@ class TkPlugin(b3.plugin.Plugin):
         Forgive all the clients
         """
         attacker = self.console.clients.getByCID(acid)
-        if not attacker:
-            return
-
-        a = self.getClientTkInfo(attacker)
-        a._attacked = {}
+        a = self.getClientTkInfo(attacker) if attacker else None
 
-        # forgive all his points
+        # forgive all the attacker points
         points = 0
         for cid, c in self.console.clients.items():
             v = self.getClientTkInfo(c)
             points += v.forgive(acid)
-            a.forgiven(v.cid)
+            if a:
+                a.forgiven(v.cid)
 
+        # and those against victims who left the server
+        points += self._tkPoints.removeAttacker(acid)
         return points
 
     ####################################################################################################################
@@ -23,7 +23,7 @@
 # ################################################################### #
 
 __author__ = 'Fenix'
-__version__ = '3.2'
+__version__ = '3.3'
 
 import b3
 import b3.plugin
@@ -49,12 +49,16 @@ except ImportError:
     pass
 
 import json
+import Queue
 import re
 import sys
+import threading
 import time
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
+from .cache import TranslationCache
+
 try:
     # import the getCmd function
     import b3.functions.getCmd as getCmd
@@ -86,6 +90,11 @@ class TranslatorPlugin(b3.plugin.Plugin):
         'always_loud': False,
         'max_history': 10,
         'exclude_language': 'en',
+        'workers': 2,
+        'queue_size': 32,
+        'cache_size': 500,
+        'cache_ttl': 60,
+        'request_timeout': 5,
     }
 
     last_message_said = []
@@ -99,6 +108,17 @@ class TranslatorPlugin(b3.plugin.Plugin):
         'sv': 'Swedish', 'th': 'Thai', 'tr': 'Turkish', 'uk': 'Ukrainian', 'ru': 'Russian', 'zh': 'Chinese',
     }
 
+    def __init__(self, console, config=None):
+        """
+        Build the plugin object.
+        """
+        b3.plugin.Plugin.__init__(self, console, config)
+        self._cache = None
+        self._queue = None
+        self._threads = []
+        self._pending = {}  # (text, source, target) -> callbacks waiting for the translation
+        self._pending_lock = threading.Lock()
+
     def onLoadConfig(self):
         """
         Load the configuration file
@@ -127,6 +147,11 @@ class TranslatorPlugin(b3.plugin.Plugin):
         self.settings['always_loud'] = self.getSetting('settings', 'always_loud', b3.BOOL, True)
         self.settings['max_history'] = self.getSetting('settings', 'max_history', b3.INT, 10)
         self.settings['exclude_language'] = self.getSetting('settings', 'exclude_language', b3.STR, 'en', validate_target)
+        self.settings['workers'] = self.getSetting('settings', 'workers', b3.INT, 2, lambda x: max(1, min(8, x)))
+        self.settings['queue_size'] = self.getSetting('settings', 'queue_size', b3.INT, 32, lambda x: max(1, x))
+        self.settings['cache_size'] = self.getSetting('settings', 'cache_size', b3.INT, 500, lambda x: max(1, x))
+        self.settings['cache_ttl'] = self.getSetting('settings', 'cache_ttl', b3.DURATION, 60, lambda x: max(1, x))
+        self.settings['request_timeout'] = self.getSetting('settings', 'request_timeout', b3.INT, 5, lambda x: max(1, x))
 
     def onStartup(self):
         """
@@ -153,6 +178,15 @@ class TranslatorPlugin(b3.plugin.Plugin):
         self.cmdPrefix = (self.adminPlugin.cmdPrefix, self.adminPlugin.cmdPrefixLoud,
                           self.adminPlugin.cmdPrefixBig, self.adminPlugin.cmdPrefixPrivate)
 
+        # translations are requested by a fixed number of threads so that the chat events are never blocked
+        self._cache = TranslationCache(self.settings['cache_size'], int(self.settings['cache_ttl'] * 60))
+        self._queue = Queue.Queue(self.settings['queue_size'])
+        for i in range(self.settings['workers']):
+            t = threading.Thread(target=self._worker, name='translator-%s' % i)
+            t.daemon = True  # won't prevent B3 from exiting
+            t.start()
+            self._threads.append(t)
+
         # notice plugin startup
         self.debug('plugin started')
 
@@ -162,6 +196,18 @@ class TranslatorPlugin(b3.plugin.Plugin):
     #                                                                                                                  #
     ####################################################################################################################
 
+    def onStop(self, event):
+        """
+        Handle EVT_STOP.
+        """
+        self.stop_workers()
+
+    def onExit(self, event):
+        """
+        Handle EVT_EXIT.
+        """
+        self.stop_workers()
+
     def onSay(self, event):
         """
         Handle EVT_CLIENT_SAY and EVT_CLIENT_SAY_TEAM
@@ -173,22 +219,14 @@ class TranslatorPlugin(b3.plugin.Plugin):
         if len(message) < self.settings['min_sentence_length']:
             return
 
-        # check if we are not spamming requests
-        curTime = time.time()
-        if self.lastTime and curTime - self.lastTime <= self.settings['min_time_between']:
-            return
-        else:
-            # update last time with current time
-            self.lastTime = curTime
-
         # if it's not a B3 command
         if message[0] not in self.cmdPrefix:
 
             # save for future use
             self.last_message_said.append(message)
             # remove old messages
-            if len(self.last_message) > self.settings['max_history']:
-                self.last_message.pop(0)
+            if len(self.last_message_said) > self.settings['max_history']:
+                self.last_message_said.pop(0)
 
             # we have now to send a translation to all the
             # clients that enabled the automatic translation
@@ -201,15 +239,27 @@ class TranslatorPlugin(b3.plugin.Plugin):
                 # no one has transauto enabled
                 return
 
-            translation = self.translate(message, to_lang=self.settings['default_target_language'])
-            if not translation:
-                # we didn't managed to get a valid translation
-                # no need to spam the chat of everyone with a silly message
-                return
+            # check if we are not spamming requests: cached and pending translations do not need a new one
+            key = (message, 'auto', self.settings['default_target_language'])
+            if not self.is_translation_available(key):
+                curTime = time.time()
+                if self.lastTime and curTime - self.lastTime <= self.settings['min_time_between']:
+                    return
+                else:
+                    # update last time with current time
+                    self.lastTime = curTime
+
+            def deliver(translation):
+                if not translation:
+                    # we didn't managed to get a valid translation
+                    # no need to spam the chat of everyone with a silly message
+                    return
+
+                for c in collection:
+                    # send the translation to all the clients
+                    self.send_translation(c, translation)
 
-            for c in collection:
-                # send the translation to all the clients
-                self.send_translation(c, translation)
+            self.translate_async(message, deliver, to_lang=self.settings['default_target_language'])
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -282,7 +332,7 @@ class TranslatorPlugin(b3.plugin.Plugin):
         request = urllib2.Request(url)
         browser = "Mozilla/5.0 (X11; Linux x86_64; rv:45.0) Gecko/20100101 Firefox/45.0"
         request.add_header('User-Agent', browser)
-        response = urllib2.urlopen(request)
+        response = urllib2.urlopen(request, timeout=self.settings['request_timeout'])
         rtn = json.loads(response.read().decode('utf8'))
         self.verbose('translation done and received, sanitizing...')
 
@@ -297,6 +347,85 @@ class TranslatorPlugin(b3.plugin.Plugin):
         self.verbose('message translated [ source <%s> : %s | result <%s> : %s ]' % (from_lang, text, to_lang, msg))
         return msg
 
+    def translate_async(self, text, callback, from_lang='auto', to_lang='en'):
+        """
+        Translate text without blocking the caller.
+        The callback is given the translation, or None if the translation failed, as soon as it is available: right
+        away if it is cached, else from a translation thread. Concurrent requests for the same translation wait for
+        a single request to the translation service.
+        """
+        key = (text, from_lang, to_lang)
+        translation = self._cache.get(key)
+        if translation is not None:
+            callback(translation)
+            return
+
+        with self._pending_lock:
+            callbacks = self._pending.get(key)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return
+            self._pending[key] = [callback]
+
+        try:
+            self._queue.put_nowait(key)
+        except Queue.Full:
+            self.warning('translation queue is full: could not translate message (%s)' % text)
+            self._deliver(key, None)
+
+    def is_translation_available(self, key):
+        """
+        Tell whether a translation is cached or being requested already.
+        :param key: The (text, source language, target language) tuple
+        """
+        with self._pending_lock:
+            if key in self._pending:
+                return True
+        return key in self._cache
+
+    def stop_workers(self):
+        """
+        Stop the translation threads.
+        """
+        if self._queue is not None:
+            for t in self._threads:
+                try:
+                    self._queue.put(None, timeout=1)
+                except Queue.Full:
+                    break
+            for t in self._threads:
+                t.join(5)
+            self._threads = []
+
+    def _worker(self):
+        """
+        Translate the messages found in the queue until a None item is received.
+        """
+        while True:
+            key = self._queue.get()
+            if key is None:
+                break
+            translation = None
+            try:
+                translation = self.translate(*key)
+            except Exception, e:
+                self.warning('could not translate message (%s): %s' % (key[0], e))
+            if translation:
+                self._cache.put(key, translation)
+            self._deliver(key, translation)
+
+    def _deliver(self, key, translation):
+        """
+        Give a translation to the callbacks waiting for it.
+        """
+        with self._pending_lock:
+            callbacks = self._pending.pop(key, [])
+        for callback in callbacks:
+            try:
+                callback(translation)
+            except Exception, e:
+                self.error('could not deliver translation of message (%s): %s' % (key[0], e))
+
     def voice(self, text, lang='en'):
         """return the sound of an word, in mp3 bytes"""
         url = 'https://translate.googleapis.com/translate_tts?'
@@ -382,13 +511,15 @@ class TranslatorPlugin(b3.plugin.Plugin):
             # get the real message to be translated
             data = m.group('message')
 
-        translation = self.translate(data, src, tar)
-        if not translation:
-            client.message('^7unable to translate')
-            return
+        def deliver(translation):
+            if not translation:
+                client.message('^7unable to translate')
+                return
 
-        # send the translation to the given client
-        self.send_translation(client, translation, cmd)
+            # send the translation to the given client
+            self.send_translation(client, translation, cmd)
+
+        self.translate_async(data, deliver, src, tar)
 
     def cmd_translast(self, data, client, cmd=None):
         """
@@ -426,14 +557,16 @@ class TranslatorPlugin(b3.plugin.Plugin):
             # else, just pick the last message in the list
             last_msg = self.last_message_said[-1]
 
-        # translate
-        message = self.translate(last_msg, to_lang=tar)
-        if not message:
-            client.message('^7unable to translate')
-            return
+        def deliver(message):
+            if not message:
+                client.message('^7unable to translate')
+                return
+
+            # send the translation to the given client
+            self.send_translation(client, message, cmd)
 
-        # send the translation to the given client
-        self.send_translation(client, message, cmd)
+        # translate
+        self.translate_async(last_msg, deliver, to_lang=tar)
     
     def cmd_transauto(self, data, client, cmd=None):
         """
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TranslationCache(object):
+    """
+    (text, source language, target language) to translation cache with time to live and least recently used eviction.
+    """
+
+    def __init__(self, size=500, ttl=3600):
+        """
+        Object constructor.
+        :param size: The maximum number of translations kept
+        :param ttl: The number of seconds a translation is valid for
+        """
+        self._size = max(1, size)
+        self._ttl = max(1, ttl)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, translation), least recently used first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key):
+        """
+        Return the cached translation for the given key.
+        :param key: The (text, source language, target language) tuple
+        :return: The translation or None if it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return None
+            # re-insert to mark it as the most recently used
+            self._entries[key] = entry
+            return entry[1]
+
+    def put(self, key, translation):
+        """
+        Store a translation.
+        :param key: The (text, source language, target language) tuple
+        :param translation: The translated text
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self._ttl, translation)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
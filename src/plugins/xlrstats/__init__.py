@@ -23,7 +23,7 @@
 # ################################################################### #
 
 __author__ = 'xlr8or & ttlogic'
-__version__ = '3.0.0-beta.17'
+__version__ = '3.0.0-beta.21'
 
 import b3
 import b3.events
@@ -42,6 +42,15 @@ from b3.functions import escape
 from b3.functions import getCmd
 from b3.functions import right_cut
 from ConfigParser import NoOptionError
+from .replay import EVENT_KILL
+from .replay import EVENT_ASSIST
+from .replay import EVENT_TEAMASSIST
+from .replay import EVENT_SUICIDE
+from .replay import EVENT_TEAMKILL
+from .replay import EVENT_ACTION
+from .replay import SkillReplay
+from .replay import loadEvents
+from .replay import writeSkills
 
 KILLER = "killer"
 VICTIM = "victim"
@@ -109,6 +118,15 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     _auto_correct_ignore_days = 60      # How many days before ignoring a players skill in the auto-correct calculation
     auto_purge = False                  # Purge players and associated data automatically (cannot be undone!)
     _purge_player_days = 365            # Number of days after which players will be auto-purged
+    purge_dry_run = False               # only count the players (and rows) the auto-purge would delete
+    purge_batch_size = 1000             # number of players deleted by each batch of queries
+    _purge_pause = 0.5                  # number of seconds between two batches
+    write_behind = True                 # keep the stats of the connected players in memory and write them in batches
+    flush_interval = 10                 # number of seconds between two writes of the cached stats
+    _flush_batch_size = 100             # maximum number of rows written by a single query
+    record_events = False               # record the skill affecting events so skills can be recomputed (see replay.py)
+    toplist_refresh = 10                # number of minutes between two reloads of the toplist from the database
+    _toplist_size = 50                  # number of players kept in the toplist cache
 
     # keep some private map data to detect prematches and restarts
     _last_map = None
@@ -125,6 +143,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     playermaps_table = 'xlr_playermaps'
     actionstats_table = 'xlr_actionstats'
     playeractions_table = 'xlr_playeractions'
+    killevents_table = 'xlr_killevents'
     clients_table = 'clients'
     penalties_table = 'penalties'
     # default tablenames for the history subplugin
@@ -159,6 +178,15 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         self._ctimePlugin = None
         self._xlrstatstables = []           # will contain a list of the xlrstats database tables
         self._cronTabCorrectStats = None
+        self._cronTabFlushStats = None
+        self._statsCache = None             # write-behind cache (None when disabled)
+        self._flushLock = threading.Lock()  # serializes the cache flushes
+        self._leaderboard = None            # toplist cache
+        self._cronTabLeaderboard = None
+        self._purgeThread = None
+        self._purgeAbort = threading.Event()
+        self._eventBuffer = []              # recorded events waiting to be written to the database
+        self._eventLock = threading.Lock()
         self.query = None                   # shortcut to the storage.query function
         b3.plugin.Plugin.__init__(self, console, config)
 
@@ -200,6 +228,11 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         ActionStats._table = self.actionstats_table
         PlayerActions._table = self.playeractions_table
 
+        if self.write_behind:
+            self._statsCache = StatsCache()
+            for cls in (WeaponStats, Bodyparts, ActionStats):
+                self._preloadTable(cls)
+
         # register the events we're interested in.
         self.registerEvent('EVT_CLIENT_JOIN', self.onJoin)
         self.registerEvent('EVT_CLIENT_KILL', self.onKill)
@@ -208,6 +241,11 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         self.registerEvent('EVT_GAME_ROUND_START', self.onRoundStart)
         self.registerEvent('EVT_CLIENT_ACTION', self.onAction)       # for game-events/actions
         self.registerEvent('EVT_CLIENT_DAMAGE', self.onDamage)       # for assist recognition
+        self.registerEvent('EVT_CLIENT_DISCONNECT', self.onDisconnect)
+        self.registerEvent('EVT_GAME_ROUND_END', self.onRoundEnd)
+        self.registerEvent('EVT_CLIENT_BAN', self.onBan)
+        self.registerEvent('EVT_CLIENT_BAN_TEMP', self.onBan)
+        self.registerEvent('EVT_CLIENT_UNBAN', self.onUnban)
 
         # get the Client.id for the bot itself (guid: WORLD or Server(bfbc2/moh/hf))
         sclient = self.console.clients.getByGUID("WORLD")
@@ -231,13 +269,15 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         # investigate if we can and want to keep a history
         self._xlrstatstables = [self.playerstats_table, self.weaponstats_table, self.weaponusage_table,
                                 self.bodyparts_table, self.playerbody_table, self.opponents_table, self.mapstats_table,
-                                self.playermaps_table, self.actionstats_table, self.playeractions_table]
+                                self.playermaps_table, self.actionstats_table, self.playeractions_table,
+                                self.killevents_table]
 
         if self.keep_history:
             self._xlrstatstables = [self.playerstats_table, self.weaponstats_table, self.weaponusage_table,
                                     self.bodyparts_table, self.playerbody_table, self.opponents_table,
                                     self.mapstats_table, self.playermaps_table, self.actionstats_table,
-                                    self.playeractions_table, self.history_monthly_table, self.history_weekly_table]
+                                    self.playeractions_table, self.killevents_table, self.history_monthly_table,
+                                    self.history_weekly_table]
 
             self.verbose('starting subplugin XLRstats History')
             self._xlrstatsHistoryPlugin = XlrstatshistoryPlugin(self.console, self.history_weekly_table,
@@ -279,6 +319,24 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         if mapstats:
             self.verbose('map %s ready' % mapstats.name)
 
+        if self._statsCache:
+            # load the stats of the players who are already connected
+            for client in self.console.clients.getList():
+                player = self.get_PlayerStats(client)
+                if player and not hasattr(player, '_new'):
+                    self._preloadPlayer(player.id)
+
+        if self._statsCache or self.record_events:
+            # start writing the cached stats and the recorded events periodically
+            self._cronTabFlushStats = b3.cron.PluginCronTab(self, self.flushStats, '*/%s' % self.flush_interval)
+            self.console.cron + self._cronTabFlushStats
+
+        # answer the toplist commands from memory
+        self._leaderboard = Leaderboard(self._toplist_size, self._minKills, self._minRounds, self._maxDays)
+        self.loadLeaderboard()
+        self._cronTabLeaderboard = b3.cron.PluginCronTab(self, self.loadLeaderboard, 0, '*/%s' % self.toplist_refresh)
+        self.console.cron + self._cronTabLeaderboard
+
         # check number of online players (if available)
         self.checkMinPlayers()
 
@@ -298,6 +356,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         self.provisional_ranking = self.getSetting('settings', 'provisional_ranking', b3.BOOL, self.provisional_ranking)
         self.auto_correct = self.getSetting('settings', 'auto_correct', b3.BOOL, self.auto_correct)
         self.auto_purge = self.getSetting('settings', 'auto_purge', b3.BOOL, self.auto_purge)
+        self.purge_dry_run = self.getSetting('settings', 'purge_dry_run', b3.BOOL, self.purge_dry_run)
+        self.purge_batch_size = self.getSetting('settings', 'purge_batch_size', b3.INT, self.purge_batch_size, lambda x: int(max(x, 1)))
         self.silent = self.getSetting('settings', 'silent', b3.BOOL, self.silent)
         self.hide_bots = self.getSetting('settings', 'hide_bots', b3.BOOL, self.hide_bots)
         self.exclude_bots = self.getSetting('settings', 'exclude_bots', b3.BOOL, self.exclude_bots)
@@ -320,6 +380,10 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         self.prematch_maxtime = self.getSetting('settings', 'prematch_maxtime', b3.INT, self.prematch_maxtime)
         self.announce = self.getSetting('settings', 'announce', b3.BOOL, self.announce)
         self.keep_time = self.getSetting('settings', 'keep_time', b3.BOOL, self.keep_time)
+        self.write_behind = self.getSetting('settings', 'write_behind', b3.BOOL, self.write_behind)
+        self.flush_interval = self.getSetting('settings', 'flush_interval', b3.INT, self.flush_interval, lambda x: int(min(max(x, 1), 60)))
+        self.record_events = self.getSetting('settings', 'record_events', b3.BOOL, self.record_events)
+        self.toplist_refresh = self.getSetting('settings', 'toplist_refresh', b3.INT, self.toplist_refresh, lambda x: int(min(max(x, 1), 59)))
 
         # load custom table names
         self.load_config_tables()
@@ -405,6 +469,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         load_conf('mapstats_table', 'mapstats')
         load_conf('playermaps_table', 'playermaps')
         load_conf('playeractions_table', 'playeractions')
+        load_conf('killevents_table', 'killevents')
         load_conf('history_monthly_table', 'history_monthly')
         load_conf('history_weekly_table', 'history_weekly')
         load_conf('ctime_table', 'ctime')
@@ -468,6 +533,53 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         if self._xlrstats_active:
             self.action(event.client, event.data)
 
+    def onDisconnect(self, event):
+        """
+        Handle EVT_CLIENT_DISCONNECT
+        """
+        if self._statsCache:
+            # write the pending changes and forget about the players who are gone
+            self.flushStats()
+            self._statsCache.evict(self._connectedPlayerIds(exclude=event.client))
+
+    def onRoundEnd(self, _):
+        """
+        Handle EVT_GAME_ROUND_END
+        """
+        self.flushStats()
+
+    def onBan(self, event):
+        """
+        Handle EVT_CLIENT_BAN and EVT_CLIENT_BAN_TEMP
+        """
+        if self._leaderboard and event.client and event.client.id is not None:
+            expire = -1
+            if isinstance(event.data, dict) and event.data.get('duration'):
+                # temp ban duration is expressed in minutes
+                expire = int(time.time() + float(event.data['duration']) * 60)
+            self._leaderboard.ban(event.client.id, expire)
+
+    def onUnban(self, event):
+        """
+        Handle EVT_CLIENT_UNBAN
+        """
+        if self._leaderboard and event.client and event.client.id is not None:
+            self._leaderboard.unban(event.client.id)
+
+    def onStop(self, event):
+        """
+        Write the cached stats before B3 stops.
+        """
+        self.stopPurge()
+        self.flushStats()
+
+    def onExit(self, event):
+        """
+        Write the cached stats before B3 exits.
+        """
+        self.stopPurge()
+        self.flushStats()
+
     ####################################################################################################################
     #                                                                                                                  #
     #    OTHER METHODS                                                                                                 #
@@ -535,9 +647,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
             client_id = client.id
 
         q = """SELECT * from %s WHERE client_id = %s LIMIT 1""" % (self.playerstats_table, client_id)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(PlayerStats, (client_id,), q)
+        if r is not None:
             s = PlayerStats()
             s.id = r['id']
             s.client_id = r['client_id']
@@ -578,9 +689,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_WeaponStats(self, name):
         s = WeaponStats()
         q = """SELECT * from %s WHERE name = '%s' LIMIT 1""" % (self.weaponstats_table, name)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(WeaponStats, (name,), q)
+        if r is not None:
             s.id = r['id']
             s.name = r['name']
             s.kills = r['kills']
@@ -595,9 +705,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_Bodypart(self, name):
         s = Bodyparts()
         q = """SELECT * from %s WHERE name = '%s' LIMIT 1""" % (self.bodyparts_table, name)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(Bodyparts, (name,), q)
+        if r is not None:
             s.id = r['id']
             s.name = r['name']
             s.kills = r['kills']
@@ -613,9 +722,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         assert name is not None
         s = MapStats()
         q = """SELECT * from %s WHERE name = '%s' LIMIT 1""" % (self.mapstats_table, name)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(MapStats, (name,), q)
+        if r is not None:
             s.id = r['id']
             s.name = r['name']
             s.kills = r['kills']
@@ -631,9 +739,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_WeaponUsage(self, weaponid, playerid):
         s = WeaponUsage()
         q = """SELECT * from %s WHERE weapon_id = %s AND player_id = %s LIMIT 1""" % (self.weaponusage_table, weaponid, playerid)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(WeaponUsage, (playerid, weaponid), q)
+        if r is not None:
             s.id = r['id']
             s.player_id = r['player_id']
             s.weapon_id = r['weapon_id']
@@ -652,9 +759,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_Opponent(self, killerid, targetid):
         s = Opponents()
         q = """SELECT * from %s WHERE killer_id = %s AND target_id = %s LIMIT 1""" % (self.opponents_table, killerid, targetid)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(Opponents, (killerid, targetid), q)
+        if r is not None:
             s.id = r['id']
             s.killer_id = r['killer_id']
             s.target_id = r['target_id']
@@ -670,9 +776,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_PlayerBody(self, playerid, bodypartid):
         s = PlayerBody()
         q = """SELECT * from %s WHERE bodypart_id = %s AND player_id = %s LIMIT 1""" % (self.playerbody_table, bodypartid, playerid)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(PlayerBody, (playerid, bodypartid), q)
+        if r is not None:
             s.id = r['id']
             s.player_id = r['player_id']
             s.bodypart_id = r['bodypart_id']
@@ -703,9 +808,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         s = PlayerMaps()
         q = """SELECT * from %s WHERE map_id = %s AND player_id = %s LIMIT 1""" % (self.playermaps_table, mapid, playerid)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(PlayerMaps, (playerid, mapid), q)
+        if r is not None:
             s.id = r['id']
             s.player_id = r['player_id']
             s.map_id = r['map_id']
@@ -725,9 +829,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_ActionStats(self, name):
         s = ActionStats()
         q = """SELECT * from %s WHERE name = '%s' LIMIT 1""" % (self.actionstats_table, name)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(ActionStats, (name,), q)
+        if r is not None:
             s.id = r['id']
             s.name = r['name']
             s.count = r['count']
@@ -740,9 +843,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def get_PlayerActions(self, playerid, actionid):
         s = PlayerActions()
         q = """SELECT * from %s WHERE action_id = %s AND player_id = %s LIMIT 1""" % (self.playeractions_table, actionid, playerid)
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            r = cursor.getRow()
+        r = self._getStatRow(PlayerActions, (playerid, actionid), q)
+        if r is not None:
             s.id = r['id']
             s.player_id = r['player_id']
             s.action_id = r['action_id']
@@ -757,6 +859,9 @@ class XlrstatsPlugin(b3.plugin.Plugin):
     def save_Stat(self, stat):
         #self.verbose('*----> XLRstats: saving statistics for %s' % type(stat))
         #self.verbose('*----> Contents: %s' %stat)
+        if self._leaderboard and isinstance(stat, PlayerStats):
+            self._leaderboard.update(self._statRow(stat), self._clientName)
+
         if hasattr(stat, '_new'):
             q = stat._insertquery()
             #self.debug('Inserting using: %r', q)
@@ -764,7 +869,17 @@ class XlrstatsPlugin(b3.plugin.Plugin):
             if cursor.rowcount > 0:
                 stat.id = cursor.lastrowid
                 delattr(stat, '_new')
+                if self._statsCache and stat._naturalkey:
+                    self._statsCache.put(stat.__class__, self._statRow(stat))
         else:
+            if self._statsCache and stat._naturalkey:
+                # update the cached copy and let flushStats() write it
+                row = self._statRow(stat)
+                with self._statsCache.lock:
+                    if self._statsCache.has(stat.__class__, StatsCache.key(stat.__class__, row)):
+                        self._statsCache.put(stat.__class__, row, dirty=True)
+                        return
+
             q = stat._updatequery()
             #self.debug('Updating using: %r', q)
             self.query(q)
@@ -775,6 +890,275 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         # If it fails, that's just bad luck.
         return
 
+    def _getStatRow(self, cls, key, q):
+        """
+        Return the database row of a stats object, or None if it doesn't exist yet.
+        When the write-behind cache is enabled the row is looked up there first.
+        :param cls: The StatObject class
+        :param key: The natural key of the row
+        :param q: The query retrieving the row from the database
+        """
+        if self._statsCache:
+            hit, row = self._statsCache.get(cls, key)
+            if hit:
+                return row
+
+        cursor = self.query(q)
+        if cursor and not cursor.EOF:
+            row = cursor.getRow()
+            if self._statsCache:
+                self._statsCache.load(cls, row)
+            return row
+
+        return None
+
+    @staticmethod
+    def _statRow(stat):
+        """
+        Return the row (as a dict) matching the given stats object.
+        FLOAT columns are converted like the database would do (ie: win_prob() relies on skill being a float).
+        """
+        row = dict((x, getattr(stat, x)) for x in stat._fields)
+        for x in stat._floatfields:
+            row[x] = float(row[x])
+        row['id'] = stat.id
+        return row
+
+    @staticmethod
+    def _statFromRow(cls, row):
+        """
+        Build a stats object from a row.
+        """
+        stat = cls()
+        stat.id = row['id']
+        for x in cls._fields:
+            setattr(stat, x, row[x])
+        return stat
+
+    @staticmethod
+    def _sqlValue(value):
+        """
+        Format a value to be used in a SQL query.
+        """
+        if value is None:
+            return 'NULL'
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, basestring):
+            return "'%s'" % escape(value, "'")
+        return '%s' % value
+
+    def flushStats(self):
+        """
+        Write the stats changed since the last flush (and the recorded events) to the database.
+        :return: True if all the pending stats changes have been written, False otherwise
+        """
+        # flushes run from the cron, event and purge threads: a flush must not write older rows over the newer
+        # ones written by another flush, the database would then keep them while the cache holds them as clean
+        with self._flushLock:
+            self._flushEvents()
+            if not self._statsCache:
+                return True
+
+            result = True
+            for cls, rows in self._statsCache.takeDirty().items():
+                try:
+                    self._writeStatRows(cls, rows)
+                except Exception, e:
+                    self.error('could not write %s rows to table %s: %s', len(rows), cls._table, e)
+                    self._statsCache.restoreDirty(cls, rows)
+                    result = False
+                else:
+                    self.verbose('written %s rows to table %s', len(rows), cls._table)
+
+            return result
+
+    def _recordEvent(self, etype, player_id, target_id, name=''):
+        """
+        Record a skill affecting event (when enabled) so it can be replayed by SkillReplay.
+        """
+        if not self.record_events or player_id is None or target_id is None:
+            return
+        with self._eventLock:
+            self._eventBuffer.append((int(time.time()), etype, player_id, target_id, name or ''))
+
+    def _recordAnonymousEvent(self, etype):
+        """
+        Record an event which didn't affect any skill because only anonymous players were involved.
+        The replay needs it anyway to know that the assists recorded before it have been dealt with.
+        """
+        if self.record_events:
+            anonymous = self.get_PlayerAnon()
+            if anonymous:
+                self._recordEvent(etype, anonymous.id, anonymous.id)
+
+    def _flushEvents(self):
+        """
+        Write the recorded events to the database.
+        :return: True if all the recorded events have been written, False otherwise
+        """
+        with self._eventLock:
+            events, self._eventBuffer = self._eventBuffer, []
+
+        written = 0
+        try:
+            for i in range(0, len(events), self._flush_batch_size):
+                values = ', '.join('(%s)' % ', '.join(self._sqlValue(x) for x in e)
+                                   for e in events[i:i + self._flush_batch_size])
+                self.query("""INSERT INTO %s (time_add, type, player_id, target_id, name) VALUES %s""" % (
+                           self.killevents_table, values))
+                written = i + self._flush_batch_size
+        except Exception, e:
+            self.error('could not write %s events to table %s: %s', len(events) - written, self.killevents_table, e)
+            # keep them (in order) for the next attempt
+            with self._eventLock:
+                self._eventBuffer[0:0] = events[written:]
+            return False
+
+        return True
+
+    def _writeStatRows(self, cls, rows):
+        """
+        Write the given rows of a stats table.
+        On MySQL rows are written using multi-row upserts, on other databases one UPDATE query per row is needed.
+        """
+        if self.console.storage.protocol != 'mysql':
+            for row in rows:
+                self.query(self._statFromRow(cls, row)._updatequery())
+            return
+
+        columns = ('id',) + cls._fields
+        updates = ', '.join('%s=VALUES(%s)' % (x, x) for x in cls._fields)
+        for i in range(0, len(rows), self._flush_batch_size):
+            values = ', '.join('(%s)' % ', '.join(self._sqlValue(row[x]) for x in columns)
+                               for row in rows[i:i + self._flush_batch_size])
+            self.query("""INSERT INTO %s (%s) VALUES %s ON DUPLICATE KEY UPDATE %s""" % (
+                       cls._table, ', '.join(columns), values, updates))
+
+    def _preloadTable(self, cls):
+        """
+        Load a whole (small) stats table in the write-behind cache.
+        """
+        cursor = self.query("""SELECT * FROM %s""" % cls._table)
+        while cursor and not cursor.EOF:
+            self._statsCache.load(cls, cursor.getRow())
+            cursor.moveNext()
+
+    def _preloadPlayer(self, player_id, new=False):
+        """
+        Load the stats rows of a player (and those shared with the other connected players) in the write-behind cache.
+        :param player_id: The playerstats id of the player
+        :param new: True if the player has just been created (so there's nothing to load)
+        """
+        for cls in (WeaponUsage, PlayerBody, PlayerMaps, PlayerActions):
+            if self._statsCache.loaded(cls, player_id):
+                continue
+            if not new:
+                cursor = self.query("""SELECT * FROM %s WHERE player_id = %s""" % (cls._table, player_id))
+                while cursor and not cursor.EOF:
+                    self._statsCache.load(cls, cursor.getRow())
+                    cursor.moveNext()
+            self._statsCache.markLoaded(cls, player_id)
+
+        opponents = [x for x in self._connectedPlayerIds() if x != player_id and
+                     not self._statsCache.loaded(Opponents, (player_id, x))]
+        if not opponents:
+            return
+
+        if not new:
+            ids = ', '.join(str(x) for x in opponents)
+            q = """SELECT * FROM %s WHERE (killer_id = %s AND target_id IN (%s))
+                   OR (target_id = %s AND killer_id IN (%s))""" % (Opponents._table, player_id, ids, player_id, ids)
+            cursor = self.query(q)
+            while cursor and not cursor.EOF:
+                self._statsCache.load(Opponents, cursor.getRow())
+                cursor.moveNext()
+
+        for x in opponents:
+            self._statsCache.markLoaded(Opponents, (player_id, x))
+            self._statsCache.markLoaded(Opponents, (x, player_id))
+
+    def _connectedPlayerIds(self, exclude=None):
+        """
+        Return the playerstats ids of the connected players (and of B3 itself) found in the write-behind cache.
+        :param exclude: A client to leave out
+        """
+        client_ids = [x.id for x in self.console.clients.getList() if x is not exclude]
+        if self._world_clientid is not None:
+            client_ids.append(self._world_clientid)
+
+        player_ids = set()
+        for client_id in client_ids:
+            hit, row = self._statsCache.get(PlayerStats, (client_id,))
+            if row:
+                player_ids.add(row['id'])
+        return player_ids
+
+    def _clientName(self, client_id):
+        """
+        Return the name of a connected client or None if the client is not connected.
+        """
+        for client in self.console.clients.getList():
+            if client.id == client_id:
+                return client.name
+        return None
+
+    def loadLeaderboard(self):
+        """
+        Reload the toplist cache from the database.
+        """
+        if not self._leaderboard:
+            return
+
+        # make sure the toplist reflects the cached stats
+        self.flushStats()
+
+        now = int(time.time())
+        q = """SELECT %s.id AS client_id, %s.name, %s.time_edit, kills, deaths, ratio, skill, rounds, hide
+               FROM %s, %s
+               WHERE %s.id = %s.client_id
+               AND %s.kills > %s
+               AND %s.rounds > %s
+               AND %s.hide = 0
+               AND %s - %s.time_edit <= %s
+               ORDER BY %s.skill DESC LIMIT %s""" % (
+               self.clients_table, self.clients_table, self.clients_table,
+               self.clients_table, self.playerstats_table,
+               self.clients_table, self.playerstats_table,
+               self.playerstats_table, self._minKills,
+               self.playerstats_table, self._minRounds,
+               self.playerstats_table,
+               now, self.clients_table, self._maxDays * 86400,
+               self.playerstats_table, self._leaderboard.size)
+
+        try:
+            rows = []
+            cursor = self.query(q)
+            while cursor and not cursor.EOF:
+                rows.append(cursor.getRow())
+                cursor.moveNext()
+
+            # bans are checked when the toplist is displayed: only those of the listed players are needed
+            bans = []
+            if rows:
+                q = """SELECT client_id, time_expire FROM %s
+                       WHERE type IN ('Ban', 'TempBan')
+                       AND inactive = 0
+                       AND (time_expire = -1 OR time_expire > %s)
+                       AND client_id IN (%s)""" % (self.penalties_table, now,
+                                                   ', '.join(str(r['client_id']) for r in rows))
+                cursor = self.query(q)
+                while cursor and not cursor.EOF:
+                    r = cursor.getRow()
+                    bans.append((r['client_id'], r['time_expire']))
+                    cursor.moveNext()
+        except Exception, e:
+            self.error('could not load the toplist: %s', e)
+            return
+
+        self._leaderboard.load(rows, bans)
+        self.verbose('loaded %s players in the toplist cache', len(rows))
+
     def check_Assists(self, client, target, data, etype=None):
         # determine eventual assists // an assist only counts if damage was done within # secs. before death
         # it will also punish teammates that have a 'negative' assist!
@@ -887,6 +1271,11 @@ class XlrstatsPlugin(b3.plugin.Plugin):
                         _vsum += _assistdeduction
                     self.save_Stat(victimstats)
 
+                    if target.team == assister.team and self.console.game.gameType not in self._ffa:
+                        self._recordEvent(EVENT_TEAMASSIST, assiststats.id, victimstats.id, actualweapon)
+                    else:
+                        self._recordEvent(EVENT_ASSIST, assiststats.id, victimstats.id, actualweapon)
+
         # end of assist reward function, return the number of assists
         return _count, _sum, _vsum
 
@@ -916,6 +1305,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         # if both should be anonymous, we have no work to do
         if (killerstats is None) and (victimstats is None):
+            self._recordAnonymousEvent(EVENT_KILL)
             return
 
         if killerstats is None:
@@ -1061,6 +1451,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
             elif (anonymous == VICTIM) and (hasattr(victimstats, '_new')):
                 self.save_Stat(victimstats)
 
+        self._recordEvent(EVENT_KILL, killerstats.id, victimstats.id, actualweapon)
+
         # adjust the "opponents" table to register who killed who
         opponent = self.get_Opponent(targetid=victimstats.id, killerid=killerstats.id)
         retal = self.get_Opponent(targetid=killerstats.id, killerid=victimstats.id)
@@ -1163,6 +1555,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         if playerstats is None:
             # anonymous player. We're not interested :)
+            self._recordAnonymousEvent(EVENT_SUICIDE)
             return
 
         playerstats.suicides += 1
@@ -1179,6 +1572,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
             client.message('^5XLRstats:^7 Suicide -> skill: ^1%.3f^7 -> ^2%.1f^7',
                            playerstats.skill - oldskill, playerstats.skill)
         self.save_Stat(playerstats)
+        self._recordEvent(EVENT_SUICIDE, playerstats.id, playerstats.id)
 
         # get applicable weapon replacement
         actualweapon = data[1]
@@ -1244,6 +1638,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         # if both should be anonymous, we have no work to do
         if (killerstats is None) and (victimstats is None):
+            self._recordAnonymousEvent(EVENT_TEAMKILL)
             return
 
         if killerstats is None:
@@ -1276,6 +1671,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
             victimstats.teamdeaths += 1
             self.save_Stat(victimstats)
 
+        self._recordEvent(EVENT_TEAMKILL, killerstats.id, victimstats.id)
+
         # do not register a teamkill in the "opponents" table
         # get applicable weapon replacement
         actualweapon = data[1]
@@ -1339,6 +1736,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         player = self.get_PlayerStats(client)
         if player:
+            new = hasattr(player, '_new')
             player.rounds = int(player.rounds) + 1
             if client.bot:
                 if self.hide_bots:
@@ -1349,6 +1747,9 @@ class XlrstatsPlugin(b3.plugin.Plugin):
                     player.hide = False
             self.save_Stat(player)
 
+            if self._statsCache and player.id is not None:
+                self._preloadPlayer(player.id, new=new)
+
             mapstats = self.get_MapStats(self.console.game.mapName)
             if mapstats:
                 playermap = self.get_PlayerMaps(player.id, mapstats.id)
@@ -1415,6 +1816,8 @@ class XlrstatsPlugin(b3.plugin.Plugin):
             #    self.verbose('----> XLRstats: updatequery: %s' %playeractions._updatequery())
             self.save_Stat(playeractions)
 
+        self._recordEvent(EVENT_ACTION, playerstats.id, playerstats.id, action.name)
+
         # get applicable action bonus
         try:
             _action_bonus = self.config.getfloat('actions', action.name)
@@ -1539,6 +1942,7 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
     def correctStats(self):
         self.debug('gathering XLRstats statistics')
+        self.flushStats()
         _seconds = self._auto_correct_ignore_days * 86400
         q = """SELECT MAX(%s.skill) AS max_skill, MIN(%s.skill) AS min_skill, SUM(%s.skill) AS sum_skill,
                AVG(%s.skill) AS avg_skill , COUNT(%s.id) AS cnt
@@ -1597,41 +2001,143 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         if self.auto_correct and round(_correction_factor, _factor_decimals) < 1:
             self.debug('correcting overall skill with factor %s...' % round(_correction_factor, _factor_decimals))
-            self.query("""UPDATE %s SET skill=(SELECT skill * %s ) WHERE %s.client_id <> %s""" % (
-                       self.playerstats_table, _correction_factor, self.playerstats_table, self._world_clientid))
+            q = """UPDATE %s SET skill=(SELECT skill * %s ) WHERE %s.client_id <> %s""" % (
+                self.playerstats_table, _correction_factor, self.playerstats_table, self._world_clientid)
+
+            if not self._statsCache:
+                self.query(q)
+                self.loadLeaderboard()
+                return
+
+            # the cached skills must be written before and reloaded after the correction
+            with self._statsCache.lock:
+                if not self.flushStats():
+                    self.warning('could not write the cached stats: skipping skill correction')
+                    return
+                self.query(q)
+                self._statsCache.clear(PlayerStats)
+            self.loadLeaderboard()
 
     def purgePlayers(self):
+        """
+        Purge the players who haven't been online for _purge_player_days days (in a background thread).
+        """
         if not self.auto_purge:
             return None
 
-        self.debug('purgin players who haven\'t been online for %s days...', self._purge_player_days)
+        if self._purgeThread and self._purgeThread.isAlive():
+            self.warning('previous purge still running: skipping')
+            return None
 
-        # find players who haven't been online for a long time
-        _seconds = self._purge_player_days * 86400
-        q = """SELECT %s.id, %s.time_edit, %s.client_id, %s.id as player_id FROM %s, %s
-               WHERE %s.id = %s.client_id
-               AND %s - %s.time_edit > %s""" % (
-               self.clients_table, self.clients_table, self.playerstats_table, self.playerstats_table,
-               self.clients_table, self.playerstats_table, self.clients_table, self.playerstats_table,
-               int(time.time()), self.clients_table, _seconds)
+        self._purgeAbort.clear()
+        self._purgeThread = threading.Thread(target=self._purgePlayers, name='xlrstats-purge')
+        self._purgeThread.setDaemon(True)
+        self._purgeThread.start()
 
+    def _purgePlayers(self):
+        """
+        Delete the stale players and their associated data, purge_batch_size players at a time.
+        """
+        before = int(time.time()) - self._purge_player_days * 86400
+        purged = 0
+        try:
+            if self.purge_dry_run:
+                self.countStalePlayers(before)
+                return
+
+            self.debug('purgin players who haven\'t been online for %s days...', self._purge_player_days)
+            self.flushStats()
+
+            start = time.time()
+            batches = 0
+            last = 0
+            while True:
+                ids = self._getStalePlayerIds(before, last, self.purge_batch_size)
+                if not ids:
+                    break
+                last = ids[-1]
+                for table in (self.playeractions_table, self.playerbody_table, self.playermaps_table,
+                              self.weaponusage_table):
+                    self.purgeAssociated(table, ids)
+                # playerstats last: the next batch is selected joining it
+                self.purgePlayerStats(ids)
+                purged += len(ids)
+                batches += 1
+                if batches % 10 == 0:
+                    self.debug('purge in progress: %s players deleted, resuming from player id %s', purged, last)
+                if len(ids) < self.purge_batch_size:
+                    break
+                if self._purgeAbort.wait(self._purge_pause):
+                    self.info('purge interrupted after %s players (player id %s)', purged, last)
+                    break
+
+            self.info('purged %s players in %s batches (%.1fs)', purged, batches, time.time() - start)
+        except Exception, e:
+            self.error('could not purge players: %s', e)
+
+        if purged:
+            # purged rows must not be served (or written back) by the write-behind cache
+            if self._statsCache:
+                with self._statsCache.lock:
+                    self.flushStats()
+                    self._statsCache.clear()
+            if not self._purgeAbort.is_set():
+                # interrupted by stopPurge: B3 is stopping, no need to query the storage again
+                self.loadLeaderboard()
+
+    def _stalePlayersCondition(self, before):
+        """
+        Return the SQL condition matching the playerstats rows of the players not seen since the given time.
+        """
+        return """%s.id = %s.client_id AND %s.time_edit < %s""" % (self.clients_table, self.playerstats_table,
+                                                                  self.clients_table, before)
+
+    def _getStalePlayerIds(self, before, after, limit):
+        """
+        Return the playerstats ids (above the given one) of the players not seen since the given time.
+        """
+        q = """SELECT %s.id AS player_id FROM %s, %s WHERE %s AND %s.id > %s ORDER BY %s.id LIMIT %s""" % (
+            self.playerstats_table, self.playerstats_table, self.clients_table, self._stalePlayersCondition(before),
+            self.playerstats_table, after, self.playerstats_table, limit)
+        ids = []
         cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            while not cursor.EOF:
-                r = cursor.getRow()
-                self.verbose(r)
-                self.purgePlayerStats(r['player_id'])
-                self.purgeAssociated(self.playeractions_table, r['player_id'])
-                self.purgeAssociated(self.playerbody_table, r['player_id'])
-                self.purgeAssociated(self.playermaps_table, r['player_id'])
-                self.purgeAssociated(self.weaponusage_table, r['player_id'])
-                cursor.moveNext()
+        while cursor and not cursor.EOF:
+            ids.append(int(cursor.getRow()['player_id']))
+            cursor.moveNext()
+        return ids
 
-    def purgePlayerStats(self, _id):
-        self.query("""DELETE FROM %s WHERE id = %s""" % (self.playerstats_table, _id))
+    def countStalePlayers(self, before):
+        """
+        Log the number of players (and associated rows) the purge would delete.
+        """
+        condition = self._stalePlayersCondition(before)
+        cursor = self.query("""SELECT COUNT(*) AS cnt FROM %s, %s WHERE %s""" % (
+                            self.playerstats_table, self.clients_table, condition))
+        players = cursor.getRow()['cnt']
+        counts = []
+        for table in (self.playeractions_table, self.playerbody_table, self.playermaps_table, self.weaponusage_table):
+            cursor = self.query("""SELECT COUNT(*) AS cnt FROM %s, %s, %s WHERE %s.player_id = %s.id AND %s""" % (
+                                table, self.playerstats_table, self.clients_table, table, self.playerstats_table,
+                                condition))
+            counts.append('%s rows from %s' % (cursor.getRow()['cnt'], table))
+        self.info('purge dry run: %s players not seen for %s days would be purged (%s)', players,
+                  self._purge_player_days, ', '.join(counts))
+        return players
 
-    def purgeAssociated(self, _table, _id):
-        self.query("""DELETE FROM %s WHERE player_id = %s""" % (_table, _id))
+    def stopPurge(self):
+        """
+        Interrupt the running purge.
+        """
+        if self._purgeThread:
+            self._purgeAbort.set()
+            self._purgeThread.join(10)
+            self._purgeThread = None
+
+    def purgePlayerStats(self, ids):
+        self.query("""DELETE FROM %s WHERE id IN (%s)""" % (self.playerstats_table, ', '.join(str(x) for x in ids)))
+
+    def purgeAssociated(self, _table, ids):
+        self.query("""DELETE FROM %s WHERE player_id IN (%s)""" % (_table, ', '.join(str(x) for x in ids)))
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -1688,57 +2194,46 @@ class XlrstatsPlugin(b3.plugin.Plugin):
                 if limit > 10:
                     limit = 10
 
-        q = 'SELECT %s.name, %s.time_edit, %s.id, kills, deaths, ratio, skill, winstreak, losestreak, rounds, fixed_name, ip \
-             FROM %s, %s \
-                 WHERE (%s.id = %s.client_id) \
-                 AND ((%s.kills > %s) \
-                 AND (%s.rounds > %s)) \
-                 AND (%s.hide = 0) \
-                 AND (%s - %s.time_edit  <= %s * 60 * 60 * 24) \
-                 AND %s.id NOT IN \
-                     ( SELECT distinct(target.id) FROM %s as penalties, %s as target \
-                     WHERE (penalties.type = "Ban" \
-                     OR penalties.type = "TempBan") \
-                     AND inactive = 0 \
-                     AND penalties.client_id = target.id \
-                     AND ( penalties.time_expire = -1 \
-                     OR penalties.time_expire > %s ) ) \
-             ORDER BY %s.skill DESC LIMIT %s'\
-             % (self.clients_table, self.clients_table, self.playerstats_table, self.clients_table, self.playerstats_table,
-                self.clients_table, self.playerstats_table, self.playerstats_table, self._minKills, self.playerstats_table,
-                self._minRounds, self.playerstats_table, int(time.time()), self.clients_table, self._maxDays, self.clients_table,
-                self.penalties_table, self.clients_table,
-                int(time.time()),
-                self.playerstats_table, limit)
+        entries, complete = self._leaderboard.top(limit)
+        if not complete and time.time() - self._leaderboard.loadTime > 60:
+            # players may have been left out of the cache: reload it (at most once a minute)
+            self.loadLeaderboard()
+            entries, complete = self._leaderboard.top(limit)
 
-        cursor = self.query(q)
-        if cursor and not cursor.EOF:
-            message = '^3XLR Stats Top %s Players:' % limit
-            if ext:
-                self.console.say(message)
-            else:
-                cmd.sayLoudOrPM(client, message)
-            c = 1
-            while not cursor.EOF:
-                r = cursor.getRow()
-                message = self.getMessage('cmd_xlrtopstats', {'number': c, 'name': r['name'], 'skill': '%1.02f' % r['skill'],
-                                                              'ratio': '%1.02f' % r['ratio'], 'kills': r['kills']})
-                if ext:
-                    self.console.say(message)
-                else:
-                    cmd.sayLoudOrPM(client, message)
-
-                cursor.moveNext()
-                c += 1
-                time.sleep(1)
+        if ext:
+            say = self.console.say
+        else:
+            say = lambda message: cmd.sayLoudOrPM(client, message)
+
+        if entries:
+            messages = ['^3XLR Stats Top %s Players:' % limit]
+            for c, r in enumerate(entries, 1):
+                messages.append(self.getMessage('cmd_xlrtopstats', {'number': c, 'name': r['name'],
+                                                                    'skill': '%1.02f' % r['skill'],
+                                                                    'ratio': '%1.02f' % r['ratio'],
+                                                                    'kills': r['kills']}))
+            # the header and the first player right away, then one line per second
+            say(messages.pop(0))
+            self.sayPaced(say, messages)
         else:
             self.debug('no players qualified for the toplist yet...')
-            message = 'Qualify for the toplist by making at least %i kills and playing %i rounds!' % (
-                      self._minKills, self._minRounds)
-            if ext:
-                self.console.say(message)
-            else:
-                cmd.sayLoudOrPM(client, message)
+            say('Qualify for the toplist by making at least %i kills and playing %i rounds!' % (
+                self._minKills, self._minRounds))
+
+    def sayPaced(self, say, messages, delay=1):
+        """
+        Say the first message now and each of the following ones after the given delay, without blocking.
+        :param say: The function saying a message
+        :param messages: The list of messages
+        :param delay: The number of seconds between two messages
+        """
+        if not messages:
+            return
+        say(messages[0])
+        if len(messages) > 1:
+            t = threading.Timer(delay, self.sayPaced, (say, messages[1:], delay))
+            t.daemon = True
+            t.start()
 
     def cmd_xlrhide(self, data, client, cmd=None):
         """
@@ -1823,6 +2318,10 @@ class XlrstatsPlugin(b3.plugin.Plugin):
         xlr_tables = [getattr(self, x) for x in dir(self) if x.endswith('_table')]
         current_tables = self.console.storage.getTables()
 
+        # drop the cached stats along with their pending changes
+        if self._statsCache:
+            self._statsCache.clear()
+
         # truncate database tables
         for table in xlr_tables:
             if table in current_tables:
@@ -1831,8 +2330,49 @@ class XlrstatsPlugin(b3.plugin.Plugin):
 
         # eventually rebuild missing tables
         self.build_database_schema()
+        self.loadLeaderboard()
         client.message('^3XLRstats database schema initialized')
 
+    def cmd_xlrrecompute(self, data, client, cmd=None):
+        """
+        [apply] - recompute the skills replaying the recorded events (they are saved only with 'apply')
+        """
+        apply = bool(data) and data.strip().lower() == 'apply'
+        client.message('^3XLRstats: ^7recomputing skills from the recorded events...')
+        thread.start_new_thread(self.doRecompute, (client, apply))
+
+    def doRecompute(self, client, apply=False):
+        """
+        Recompute the skills using the current configuration and optionally save them.
+        """
+        try:
+            self.flushStats()
+            result = SkillReplay.fromPlugin(self).replay(loadEvents(self.query, self.killevents_table))
+        except Exception, e:
+            self.error('could not recompute skills: %s', e)
+            client.message('^3XLRstats: ^7could not recompute skills: %s' % e)
+            return
+
+        self.info('replayed %s events in %.2f seconds: %s players', result.events, result.elapsed, len(result))
+        client.message('^3XLRstats: ^7replayed %s events: %s players, skill min ^3%.1f^7 avg ^3%.1f^7 max ^3%.1f' %
+                       ((result.events, len(result)) + result.summary()))
+
+        if not apply:
+            client.message('^3XLRstats: ^7type !xlrrecompute apply to save the recomputed skills')
+            return
+
+        if self._statsCache:
+            # cached skills must not overwrite the recomputed ones
+            with self._statsCache.lock:
+                self.flushStats()
+                writeSkills(self.query, self.playerstats_table, result)
+                self._statsCache.clear(PlayerStats)
+        else:
+            writeSkills(self.query, self.playerstats_table, result)
+
+        self.loadLeaderboard()
+        client.message('^3XLRstats: ^7recomputed skills saved')
+
 ########################################################################################################################
 #                                                                                                                      #
 #   SUB PLUGIN CONTROLLER - CONTROLS STARTING AND STOPPING OF MAIN XLRSTATS PLUGIN BASED ON PLAYERCOUNT                #
@@ -2274,7 +2814,275 @@ class BattlestatsPlugin(b3.plugin.Plugin):
 
 ########################################################################################################################
 #                                                                                                                      #
-#   ABSTRACT CLASSES TO AID XLRSTATS PLUGIN CLASS                                                                      #
+#   WRITE-BEHIND CACHE FOR THE XLRSTATS DATA OBJECTS                                                                   #
+#                                                                                                                      #
+########################################################################################################################
+
+class StatsCache(object):
+    """
+    In-memory copy of the statistics rows used by the connected players.
+    Rows are stored per StatObject class and indexed by their natural key (ie: player_id + weapon_id). Updates
+    are kept in memory and marked dirty until the plugin flushes them to the database in batches.
+    A 'scope' (a player id or an opponents pair) is marked as loaded once all of its rows have been read from the
+    database: a miss within a loaded scope means the row does not exist yet, so no query is needed to find out.
+    """
+
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self.lock = threading.RLock()
+        self._rows = {}     # StatObject class -> { natural key: row dict }
+        self._scopes = {}   # StatObject class -> set of loaded scopes
+        self._dirty = {}    # (StatObject class, row id) -> row dict
+
+    @staticmethod
+    def scope(cls, key):
+        """
+        Return the scope a natural key belongs to (None for the tables which are not loaded per player).
+        """
+        if cls is Opponents:
+            return key
+        if len(cls._naturalkey) == 2:
+            return key[0]
+        return None
+
+    @staticmethod
+    def key(cls, row):
+        """
+        Return the natural key of a row.
+        """
+        return tuple(row[x] for x in cls._naturalkey)
+
+    def get(self, cls, key):
+        """
+        Lookup a row by natural key.
+        :return: a (hit, row) tuple: row is a copy of the cached row or None if it's known not to exist
+        """
+        with self.lock:
+            row = self._rows.get(cls, {}).get(key)
+            if row is not None:
+                return True, dict(row)
+            if self.loaded(cls, self.scope(cls, key)):
+                return True, None
+            return False, None
+
+    def has(self, cls, key):
+        with self.lock:
+            return key in self._rows.get(cls, {})
+
+    def loaded(self, cls, scope):
+        with self.lock:
+            return scope is not None and scope in self._scopes.get(cls, ())
+
+    def load(self, cls, row):
+        """
+        Store a row read from the database unless the cache already holds a (possibly newer) copy of it.
+        """
+        with self.lock:
+            rows = self._rows.setdefault(cls, {})
+            key = self.key(cls, row)
+            if key not in rows:
+                rows[key] = dict(row)
+
+    def put(self, cls, row, dirty=False):
+        """
+        Store a row in the cache, optionally marking it as needing to be written to the database.
+        """
+        with self.lock:
+            row = dict(row)
+            self._rows.setdefault(cls, {})[self.key(cls, row)] = row
+            if dirty:
+                self._dirty[(cls, row['id'])] = row
+
+    def markLoaded(self, cls, scope):
+        with self.lock:
+            self._scopes.setdefault(cls, set()).add(scope)
+
+    def takeDirty(self):
+        """
+        Return all the dirty rows grouped by class and mark them clean.
+        """
+        with self.lock:
+            dirty, self._dirty = self._dirty, {}
+        grouped = {}
+        for (cls, _), row in dirty.items():
+            grouped.setdefault(cls, []).append(dict(row))
+        return grouped
+
+    def restoreDirty(self, cls, rows):
+        """
+        Mark rows which failed to be written as dirty again (unless they have been modified in the meantime).
+        """
+        with self.lock:
+            for row in rows:
+                self._dirty.setdefault((cls, row['id']), row)
+
+    def clear(self, cls=None):
+        """
+        Drop the cached rows (and their pending changes) of the given class or of all classes.
+        """
+        with self.lock:
+            classes = [cls] if cls else list(self._rows.keys())
+            for c in classes:
+                self._rows.pop(c, None)
+                self._scopes.pop(c, None)
+            self._dirty = dict((k, v) for k, v in self._dirty.items() if k[0] not in classes)
+
+    def evict(self, player_ids):
+        """
+        Drop the clean rows of all the players but the given ones.
+        :param player_ids: the playerstats ids of the players whose rows should be kept
+        """
+        player_ids = set(player_ids)
+
+        def keep(cls, row):
+            if (cls, row['id']) in self._dirty:
+                return True
+            if cls is PlayerStats:
+                return row['id'] in player_ids
+            if cls is Opponents:
+                return row['killer_id'] in player_ids and row['target_id'] in player_ids
+            if 'player_id' in cls._naturalkey:
+                return row['player_id'] in player_ids
+            return True
+
+        with self.lock:
+            for cls, rows in self._rows.items():
+                for k in [k for k, row in rows.items() if not keep(cls, row)]:
+                    del rows[k]
+            for cls, scopes in self._scopes.items():
+                if cls is Opponents:
+                    scopes.intersection_update([s for s in scopes if s[0] in player_ids and s[1] in player_ids])
+                elif len(cls._naturalkey) == 2:
+                    scopes.intersection_update(player_ids)
+
+class Leaderboard(object):
+    """
+    In-memory copy of the best players qualifying for the toplist.
+    The list is reloaded from the database periodically and kept up to date in between with the skills saved by the
+    plugin and with the bans issued and lifted, so that the toplist commands do not need to query the database.
+    When the database holds more qualifying players than the list keeps, those left out all have a skill lower than
+    'floor': entries falling below it may have been overtaken, the list can't be trusted for them until it's reloaded.
+    """
+
+    def __init__(self, size, minKills, minRounds, maxDays):
+        """
+        Object constructor.
+        :param size: The maximum number of players kept
+        :param minKills: The number of kills a player needs to qualify
+        :param minRounds: The number of rounds a player needs to qualify
+        :param maxDays: The number of days after which an inactive player does not qualify anymore
+        """
+        self.lock = threading.RLock()
+        self.size = size
+        self.floor = None
+        self.loaded = False
+        self.loadTime = 0
+        self._minKills = minKills
+        self._minRounds = minRounds
+        self._maxDays = maxDays
+        self._entries = {}  # client id -> row dict
+        self._bans = {}     # client id -> ban expiration time (-1 for permanent bans)
+
+    def load(self, rows, bans):
+        """
+        Replace the content of the list.
+        :param rows: The best qualifying players (client_id, name, time_edit, kills, deaths, ratio, skill, rounds, hide)
+        :param bans: The (client id, expiration time) tuples of the active bans of those players
+        """
+        with self.lock:
+            self._entries = dict((r['client_id'], dict(r)) for r in rows)
+            self._bans = {}
+            for client_id, expire in bans:
+                self.ban(client_id, expire)
+            self.floor = None
+            if len(rows) >= self.size:
+                self.floor = min(r['skill'] for r in rows)
+            self.loaded = True
+            self.loadTime = time.time()
+
+    def update(self, row, getName):
+        """
+        Update the list with a playerstats row saved by the plugin.
+        :param row: The playerstats row
+        :param getName: A function returning the name of a player from its client id (or None if not known)
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+
+            entry = self._entries.get(row['client_id'])
+            if entry is None:
+                if row['kills'] <= self._minKills or row['rounds'] <= self._minRounds or row['hide']:
+                    return
+                if self.floor is not None and row['skill'] < self.floor:
+                    return
+                name = getName(row['client_id'])
+                if name is None:
+                    return
+                entry = self._entries[row['client_id']] = {'client_id': row['client_id'], 'name': name}
+
+            for x in ('kills', 'deaths', 'ratio', 'skill', 'rounds', 'hide'):
+                entry[x] = row[x]
+            # the player is playing: the client record is being updated too
+            entry['time_edit'] = int(time.time())
+
+            if len(self._entries) > self.size:
+                # forget the weakest player: the ones left out are now below his skill
+                weakest = min(self._entries.itervalues(), key=lambda x: x['skill'])
+                del self._entries[weakest['client_id']]
+                self.floor = max(self.floor, weakest['skill']) if self.floor is not None else weakest['skill']
+
+    def ban(self, client_id, expire):
+        """
+        Exclude a player from the list until the given time (-1 for permanent bans).
+        """
+        with self.lock:
+            current = self._bans.get(client_id)
+            if current == -1 or expire == -1:
+                self._bans[client_id] = -1
+            else:
+                self._bans[client_id] = max(current, expire)
+
+    def unban(self, client_id):
+        """
+        Stop excluding a player from the list.
+        """
+        with self.lock:
+            self._bans.pop(client_id, None)
+
+    def top(self, limit):
+        """
+        Return the best qualifying players.
+        :param limit: The number of players wanted
+        :return: a (rows, complete) tuple: complete is False when players left out of the list may belong to the top
+        """
+        now = time.time()
+        since = now - self._maxDays * 86400
+        with self.lock:
+            if not self.loaded:
+                return [], False
+
+            rows = []
+            for entry in self._entries.itervalues():
+                if entry['kills'] <= self._minKills or entry['rounds'] <= self._minRounds or entry['hide']:
+                    continue
+                if entry['time_edit'] < since:
+                    continue
+                expire = self._bans.get(entry['client_id'])
+                if expire is not None and (expire == -1 or expire > now):
+                    continue
+                rows.append(dict(entry))
+
+            rows.sort(key=lambda x: x['skill'], reverse=True)
+            rows = rows[:limit]
+            complete = self.floor is None or (len(rows) == limit and rows[-1]['skill'] >= self.floor)
+            return rows, complete
+
+########################################################################################################################
+#                                                                                                                      #
+#   ABSTRACT CLASSES TO AID XLRSTATS PLUGIN CLASS                                                                    #
 #                                                                                                                      #
 ########################################################################################################################
 
@@ -2282,6 +3090,9 @@ class BattlestatsPlugin(b3.plugin.Plugin):
 class StatObject(object):
 
     _table = None
+    _naturalkey = ()
+    _fields = ()
+    _floatfields = ()
 
     def _insertquery(self):
         return None
@@ -2295,6 +3106,12 @@ class PlayerStats(StatObject):
     # default name of the table for this data object
     _table = 'playerstats'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('client_id',)
+    _fields = ('client_id', 'kills', 'deaths', 'teamkills', 'teamdeaths', 'suicides', 'ratio', 'skill', 'assists',
+               'assistskill', 'curstreak', 'winstreak', 'losestreak', 'rounds', 'hide', 'fixed_name', 'id_token')
+    _floatfields = ('ratio', 'skill', 'assistskill')
+
     # fields of the table
     id = None
     client_id = 0
@@ -2345,6 +3162,10 @@ class WeaponStats(StatObject):
     # default name of the table for this data object
     _table = 'weaponstats'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('name',)
+    _fields = ('name', 'kills', 'suicides', 'teamkills')
+
     # fields of the table
     id = None
     name = ''
@@ -2368,6 +3189,10 @@ class WeaponUsage(StatObject):
     # default name of the table for this data object
     _table = 'weaponusage'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('player_id', 'weapon_id')
+    _fields = ('player_id', 'weapon_id', 'kills', 'deaths', 'suicides', 'teamkills', 'teamdeaths')
+
     # fields of the table
     id = None
     player_id = 0
@@ -2396,6 +3221,10 @@ class Bodyparts(StatObject):
     # default name of the table for this data object
     _table = 'bodyparts'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('name',)
+    _fields = ('name', 'kills', 'suicides', 'teamkills')
+
     # fields of the table
     id = None
     name = ''
@@ -2419,6 +3248,10 @@ class MapStats(StatObject):
     # default name of the table for this data object
     _table = 'mapstats'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('name',)
+    _fields = ('name', 'kills', 'suicides', 'teamkills', 'rounds')
+
     # fields of the table
     id = None
     name = ''
@@ -2443,6 +3276,10 @@ class PlayerBody(StatObject):
     # default name of the table for this data object
     _table = 'playerbody'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('player_id', 'bodypart_id')
+    _fields = ('player_id', 'bodypart_id', 'kills', 'deaths', 'suicides', 'teamkills', 'teamdeaths')
+
     # fields of the table
     id = None
     player_id = 0
@@ -2471,6 +3308,10 @@ class PlayerMaps(StatObject):
     # default name of the table for this data object
     _table = 'playermaps'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('player_id', 'map_id')
+    _fields = ('player_id', 'map_id', 'kills', 'deaths', 'suicides', 'teamkills', 'teamdeaths', 'rounds')
+
     # fields of the table
     id = 0
     player_id = 0
@@ -2500,6 +3341,10 @@ class Opponents(StatObject):
     # default name of the table for this data object
     _table = 'opponents'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('killer_id', 'target_id')
+    _fields = ('killer_id', 'target_id', 'kills', 'retals')
+
     # fields of the table
     id = None
     killer_id = 0
@@ -2523,6 +3368,10 @@ class ActionStats(StatObject):
     # default name of the table for this data object
     _table = 'actionstats'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('name',)
+    _fields = ('name', 'count')
+
     # fields of the table
     id = None
     name = ''
@@ -2542,6 +3391,10 @@ class PlayerActions(StatObject):
     # default name of the table for this data object
     _table = 'playeractions'
 
+    # natural key and columns (besides id) used by the write-behind cache
+    _naturalkey = ('player_id', 'action_id')
+    _fields = ('player_id', 'action_id', 'count')
+
     # fields of the table
     id = None
     player_id = 0
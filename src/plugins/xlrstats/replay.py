@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+# ################################################################### #
+#                                                                     #
+#  BigBrotherBot(B3) (www.bigbrotherbot.net)                          #
+#  Copyright (C) 2005 Michael "ThorN" Thornton                        #
+#                                                                     #
+#  This program is free software; you can redistribute it and/or      #
+#  modify it under the terms of the GNU General Public License        #
+#  as published by the Free Software Foundation; either version 2     #
+#  of the License, or (at your option) any later version.             #
+#                                                                     #
+#  This program is distributed in the hope that it will be useful,    #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the       #
+#  GNU General Public License for more details.                       #
+#                                                                     #
+#  You should have received a copy of the GNU General Public License  #
+#  along with this program; if not, write to the Free Software        #
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA      #
+#  02110-1301, USA.                                                   #
+#                                                                     #
+# ################################################################### #
+
+"""
+Offline recomputation of the XLRstats skill points.
+
+The main plugin can record every skill affecting event in the killevents table (see the record_events setting).
+SkillReplay replays that stream in chronological order using the same rules as XlrstatsPlugin.kill(),
+check_Assists(), suicide(), teamkill() and action(), so skills can be rebuilt after changing the rating
+parameters, or different parameters can be compared without touching the live stats.
+
+NumPy is used (when available) to index the event stream and to gather the weapon multipliers; the ELO
+recurrence itself is sequential by nature and runs as a tight loop over plain lists.
+"""
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EVENT_KILL = 0
+EVENT_ASSIST = 1
+EVENT_TEAMASSIST = 2
+EVENT_SUICIDE = 3
+EVENT_TEAMKILL = 4
+EVENT_ACTION = 5
+
+
+def loadEvents(query, table, batch_size=50000):
+    """
+    Read the recorded events in chronological order.
+    :param query: The storage query function
+    :param table: The name of the killevents table
+    :param batch_size: Number of rows read by each query
+    :return: A generator of (type, player_id, target_id, name) tuples
+    """
+    last_id = 0
+    while True:
+        cursor = query("""SELECT id, type, player_id, target_id, name FROM %s WHERE id > %s
+                          ORDER BY id LIMIT %s""" % (table, last_id, batch_size))
+        rows = 0
+        while cursor and not cursor.EOF:
+            r = cursor.getRow()
+            last_id = r['id']
+            rows += 1
+            yield r['type'], r['player_id'], r['target_id'], r['name']
+            cursor.moveNext()
+        if rows < batch_size:
+            return
+
+
+def writeSkills(query, table, result, batch_size=500):
+    """
+    Write recomputed skills to the playerstats table.
+    A single UPDATE ... CASE query is issued for every batch_size players (this works on all the supported databases).
+    :param query: The storage query function
+    :param table: The name of the playerstats table
+    :param result: The SkillReplayResult to write
+    :param batch_size: Number of players updated by each query
+    """
+    rows = zip(result.player_ids, result.skills, result.assistskills)
+    for i in range(0, len(rows), batch_size):
+        chunk = rows[i:i + batch_size]
+        skill = ' '.join('WHEN %s THEN %r' % (r[0], float(r[1])) for r in chunk)
+        assistskill = ' '.join('WHEN %s THEN %r' % (r[0], float(r[2])) for r in chunk)
+        ids = ', '.join(str(r[0]) for r in chunk)
+        query("""UPDATE %s SET skill = CASE id %s END, assistskill = CASE id %s END WHERE id IN (%s)""" % (
+              table, skill, assistskill, ids))
+
+
+class SkillReplayResult(object):
+    """
+    Skills computed by SkillReplay.replay(): the Nth player_id has the Nth skill and assistskill.
+    Values are NumPy arrays when NumPy is available, lists otherwise.
+    """
+
+    def __init__(self, player_ids, skills, assistskills, events, elapsed):
+        self.player_ids = player_ids
+        self.skills = skills
+        self.assistskills = assistskills
+        self.events = events
+        self.elapsed = elapsed
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    def summary(self):
+        """
+        Return a (min, average, max) tuple of the computed skills.
+        """
+        if not len(self.skills):
+            return 0.0, 0.0, 0.0
+        if numpy is not None:
+            return float(self.skills.min()), float(self.skills.mean()), float(self.skills.max())
+        return min(self.skills), sum(self.skills) / len(self.skills), max(self.skills)
+
+
+class SkillReplay(object):
+    """
+    Replay a recorded event stream and compute the resulting player skills.
+    Every player starts at defaultskill; the parameters mirror the XLRstats plugin settings.
+    """
+
+    defaultskill = 1000
+    Kfactor_high = 16
+    Kfactor_low = 4
+    Kswitch_confrontations = 50
+    steepness = 600
+    suicide_penalty_percent = 0.05
+    tk_penalty_percent = 0.1
+    action_bonus = 1.0
+    kill_bonus = 1.5
+    assist_bonus = 0.5
+    provisional_ranking = True
+
+    def __init__(self, anonymous_id=None, weapon_factors=None, action_bonuses=None, **kwargs):
+        """
+        Object constructor.
+        :param anonymous_id: The playerstats id used for the players not participating in XLRstats
+        :param weapon_factors: A dict of weapon multipliers (weapons not listed use 1.0)
+        :param action_bonuses: A dict of action bonuses (actions not listed use action_bonus)
+        :param kwargs: Overrides of the rating parameters (ie: Kfactor_high=20)
+        """
+        for k, v in kwargs.items():
+            if not hasattr(SkillReplay, k):
+                raise TypeError('unknown replay parameter: %s' % k)
+            setattr(self, k, v)
+        self.anonymous_id = anonymous_id
+        # names are matched case insensitively, like the plugin configuration options
+        self.weapon_factors = dict((k.lower(), v) for k, v in (weapon_factors or {}).items())
+        self.action_bonuses = dict((k.lower(), v) for k, v in (action_bonuses or {}).items())
+
+    @classmethod
+    def fromPlugin(cls, plugin, **kwargs):
+        """
+        Create a replay using the current configuration of a XLRstats plugin.
+        :param plugin: The XlrstatsPlugin instance
+        :param kwargs: Parameters to override
+        """
+        def section(name):
+            values = {}
+            if plugin.config.has_section(name):
+                for option in plugin.config.options(name):
+                    try:
+                        values[option] = plugin.config.getfloat(name, option)
+                    except ValueError:
+                        pass
+            return values
+
+        params = dict((k, getattr(plugin, k)) for k in ('defaultskill', 'Kfactor_high', 'Kfactor_low',
+                      'Kswitch_confrontations', 'steepness', 'suicide_penalty_percent', 'tk_penalty_percent',
+                      'action_bonus', 'kill_bonus', 'assist_bonus', 'provisional_ranking'))
+        params.update(kwargs)
+        anonymous = plugin.get_PlayerAnon()
+        return cls(anonymous_id=anonymous.id if anonymous else None, weapon_factors=section('weapons'),
+                   action_bonuses=section('actions'), **params)
+
+    def _index(self, events):
+        """
+        Turn the event stream into columns of dense player and name indexes.
+        :return: (types, actors, targets, factors, names, player_ids) where factors holds the weapon multiplier
+                 (or the action bonus for actions) of each event
+        """
+        types, players, targets, names = [], [], [], []
+        for e in events:
+            types.append(e[0])
+            players.append(e[1])
+            targets.append(e[2])
+            names.append(e[3] or '')
+
+        # there are only a few distinct names: number them and look their factors up once
+        name_index = {}
+        names = [name_index.setdefault(x, len(name_index)) for x in names]
+        unique_names = sorted(name_index, key=name_index.get)
+        weapon = [self.weapon_factors.get(x.lower(), 1.0) for x in unique_names]
+        action = [self.action_bonuses.get(x.lower(), self.action_bonus) for x in unique_names]
+
+        n = len(types)
+        if numpy is not None:
+            player_ids, inverse = numpy.unique(numpy.array(players + targets, dtype=numpy.int64), return_inverse=True)
+            types = numpy.array(types, dtype=numpy.int8)
+            names = numpy.array(names, dtype=numpy.int32)
+            factors = numpy.where(types == EVENT_ACTION, numpy.array(action)[names], numpy.array(weapon)[names])
+            return (types.tolist(), inverse[:n].tolist(), inverse[n:].tolist(), factors.tolist(), player_ids)
+
+        player_ids = sorted(set(players) | set(targets))
+        position = dict((x, i) for i, x in enumerate(player_ids))
+        factors = [action[x] if t == EVENT_ACTION else weapon[x] for t, x in zip(types, names)]
+        return (types, [position[x] for x in players], [position[x] for x in targets], factors, player_ids)
+
+    def replay(self, events):
+        """
+        Replay the given events.
+        :param events: An iterable of (type, player_id, target_id, name) tuples in chronological order
+        :return: A SkillReplayResult
+        """
+        started = time.time()
+        types, actors, targets, factors, player_ids = self._index(events)
+
+        m = len(player_ids)
+        skill = [float(self.defaultskill)] * m
+        assistskill = [0.0] * m
+        kills = [0] * m
+        deaths = [0] * m
+        # assists are recorded right before the death they belong to: [victim, assists bonus sum, victim deduction sum]
+        pending = [None, 0, 0]
+
+        anonymous = -1
+        if self.anonymous_id is not None:
+            for i, x in enumerate(player_ids):
+                if x == self.anonymous_id:
+                    anonymous = i
+                    break
+
+        steepness = float(self.steepness)
+        kswitch = self.Kswitch_confrontations
+        provisional = self.provisional_ranking
+        k_high, k_low = self.Kfactor_high, self.Kfactor_low
+        kill_bonus = self.kill_bonus
+        assist_bonus = self.assist_bonus
+        suicide_factor = 1 - (self.suicide_penalty_percent / 100.0)
+        tk_factor = 1 - (self.tk_penalty_percent / 100.0)
+        defaultskill = float(self.defaultskill)
+
+        for t, a, v, f in zip(types, actors, targets, factors):
+
+            if t == EVENT_ASSIST or t == EVENT_TEAMASSIST:
+                if pending[0] != v:
+                    pending = [v, 0, 0]
+                assist_prob = 1 / (10 ** ((skill[v] - skill[a]) / steepness) + 1)
+                kfactor = k_low if kills[a] > kswitch else k_high
+                if t == EVENT_TEAMASSIST:
+                    bonus = assist_bonus * kfactor * f * (0 - assist_prob)
+                else:
+                    bonus = assist_bonus * kfactor * f * (1 - assist_prob)
+                    kfactor = k_low if kills[v] > kswitch else k_high
+                    deduction = assist_bonus * kfactor * f * (assist_prob - 1)
+                    skill[v] += deduction
+                    pending[2] += deduction
+                skill[a] += bonus
+                assistskill[a] += bonus
+                pending[1] += bonus
+                continue
+
+            if t == EVENT_KILL and (a != anonymous or v != anonymous):
+                if pending[0] == v:
+                    assists_sum, victim_sum = pending[1], pending[2]
+                else:
+                    assists_sum, victim_sum = 0, 0
+                killer_skill = defaultskill if a == anonymous else skill[a]
+                killer_prob = 1 / (10 ** ((skill[v] - killer_skill) / steepness) + 1)
+                both_provisional = False
+                killer_confrontations = kills[a] + deaths[a]
+
+                if a != anonymous:
+                    # get_PlayerStats() computes the Kfactor from the kills only
+                    kfactor = k_low if kills[a] > kswitch else k_high
+                    addition = kill_bonus * kfactor * f * (1 - killer_prob)
+                    if assists_sum == 0:
+                        pass
+                    elif assists_sum >= addition / 2:
+                        addition /= 2
+                    else:
+                        addition -= assists_sum
+                    killer_confrontations += 1
+                    victim_confrontations = kills[v] + deaths[v]
+                    if victim_confrontations < kswitch and killer_confrontations < kswitch and provisional:
+                        both_provisional = True
+                    if both_provisional or victim_confrontations > kswitch or not provisional or v == anonymous:
+                        skill[a] += addition
+                        kills[a] += 1
+
+                if v != anonymous:
+                    kfactor = k_low if kills[v] > kswitch else k_high
+                    deduction = kfactor * f * (killer_prob - 1)
+                    if victim_sum == 0:
+                        pass
+                    elif victim_sum <= deduction / 2:
+                        deduction /= 2
+                    else:
+                        deduction -= victim_sum
+                    victim_confrontations = kills[v] + deaths[v] + 1
+                    if victim_confrontations < kswitch and killer_confrontations < kswitch and provisional:
+                        both_provisional = True
+                    if both_provisional or killer_confrontations > kswitch or not provisional or a == anonymous:
+                        skill[v] += deduction
+                        deaths[v] += 1
+
+            elif t == EVENT_SUICIDE and a != anonymous:
+                skill[a] *= suicide_factor
+
+            elif t == EVENT_TEAMKILL and a != anonymous:
+                skill[a] *= tk_factor
+
+            elif t == EVENT_ACTION:
+                skill[a] += f
+
+            # whatever happened, the assists recorded so far have been dealt with
+            pending = [None, 0, 0]
+
+        # the anonymous record is shared by all the players not participating in XLRstats: leave it alone
+        if numpy is not None:
+            keep = numpy.arange(m) != anonymous
+            return SkillReplayResult(player_ids[keep], numpy.array(skill)[keep], numpy.array(assistskill)[keep],
+                                     len(types), time.time() - started)
+
+        keep = [i for i in range(m) if i != anonymous]
+        return SkillReplayResult([player_ids[i] for i in keep], [skill[i] for i in keep],
+                                 [assistskill[i] for i in keep], len(types), time.time() - started)
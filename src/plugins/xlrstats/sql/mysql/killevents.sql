@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS `%s` (
+  `id` INT(11) UNSIGNED NOT NULL AUTO_INCREMENT,
+  `time_add` INT(10) UNSIGNED NOT NULL DEFAULT '0',
+  `type` TINYINT(3) UNSIGNED NOT NULL DEFAULT '0',
+  `player_id` SMALLINT(5) UNSIGNED NOT NULL DEFAULT '0',
+  `target_id` SMALLINT(5) UNSIGNED NOT NULL DEFAULT '0',
+  `name` VARCHAR(64) NOT NULL DEFAULT '',
+  PRIMARY KEY (`id`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
\ No newline at end of file
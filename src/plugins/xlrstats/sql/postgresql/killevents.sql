@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS %s (
+  id SERIAL PRIMARY KEY,
+  time_add INTEGER NOT NULL DEFAULT '0',
+  type SMALLINT NOT NULL DEFAULT '0',
+  player_id SMALLINT NOT NULL DEFAULT '0',
+  target_id SMALLINT NOT NULL DEFAULT '0',
+  name VARCHAR(64) NOT NULL DEFAULT ''
+);
\ No newline at end of file
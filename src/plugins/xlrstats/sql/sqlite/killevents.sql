@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS `%s` (
+  `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+  `time_add` INT(10) NOT NULL DEFAULT '0',
+  `type` TINYINT(3) NOT NULL DEFAULT '0',
+  `player_id` SMALLINT(5) NOT NULL DEFAULT '0',
+  `target_id` SMALLINT(5) NOT NULL DEFAULT '0',
+  `name` VARCHAR(64) NOT NULL DEFAULT ''
+);
\ No newline at end of file